@@ -0,0 +1,118 @@
+"""
+Per-operation latency of the db_operations API on the two storage backends.
+
+Runs the same operations, on the same number of users and messages, against
+an embedded SQLite file (a temporary one, WAL mode, as storage.py opens it)
+and against the PostgreSQL benchmark database, and prints the mean and p95
+latency of each with the SQLite/PostgreSQL ratio. Every write is a separate
+autocommitted statement, as in the CLIs, so the cost of durably committing
+is part of the numbers.
+
+The users created here are named bench-<pid>-N and are deleted again (their
+messages cascade) at the end. PostgreSQL is skipped when the benchmark
+database cannot be reached (see benchmarks/datagen.py to create it).
+
+Usage:
+    python benchmarks/bench_backends.py [-n ITERATIONS] [--users N] [--messages N] [--database NAME]
+"""
+import argparse
+import contextlib
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import create_db
+import storage
+from db_operations import User, Message
+from datagen import BENCH_DATABASE, bench_connection
+
+
+def measure(function, iterations):
+    timings = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        function(i)
+        timings.append(time.perf_counter() - started)
+    return statistics.mean(timings), statistics.quantiles(timings, n=20)[-1]
+
+
+def run(cursor, iterations, users, messages):
+    """Seed the users and messages, then time each operation on `cursor`."""
+    prefix = f"bench-{os.getpid()}-"
+    # a fixed hash: password hashing is not what is compared here
+    hashed = User("", "password").hashed_password
+    ids = []
+    for i in range(users):
+        user = User.from_row((None, f"{prefix}{i}", hashed))
+        user.save_to_db(cursor)
+        ids.append(user.id)
+    rng = random.Random(42)
+    Message.save_many(cursor, [Message(rng.choice(ids), rng.choice(ids), "benchmark message")
+                               for _ in range(messages)])
+
+    created = itertools.count()
+
+    def new_user(i):
+        User.from_row((None, f"{prefix}new-{next(created)}", hashed)).save_to_db(cursor)
+
+    operations = [
+        ("User.save_to_db", new_user),
+        ("User.load_user_by_username", lambda i: User.load_user_by_username(cursor, f"{prefix}{i % users}")),
+        ("User.load_user_by_id", lambda i: User.load_user_by_id(cursor, ids[i % users])),
+        ("User.load_users_by_usernames",
+         lambda i: User.load_users_by_usernames(cursor, [f"{prefix}{(i + k) % users}" for k in range(10)])),
+        ("Message.save_to_db", lambda i: Message(ids[i % users], ids[-i % users], "benchmark").save_to_db(cursor)),
+        ("Message.load_inbox", lambda i: Message.load_inbox(cursor, ids[i % users])),
+    ]
+
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, operation in operations:
+            operation(0)  # warm up
+            results[name] = measure(operation, iterations)
+
+        cursor.execute("DELETE FROM users WHERE username LIKE %s", (prefix + "%",))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', help='runs per operation and backend (default 2000)', type=int,
+                        default=2000)
+    parser.add_argument('--users', help='users to seed (default 1000)', type=int, default=1000)
+    parser.add_argument('--messages', help='messages to seed (default 20000)', type=int, default=20000)
+    parser.add_argument('--database', help=f'PostgreSQL benchmark database (default {BENCH_DATABASE})',
+                        default=BENCH_DATABASE)
+    args = parser.parse_args()
+
+    backends = {}
+    with tempfile.TemporaryDirectory() as directory:
+        connection = storage.SQLiteConnection(os.path.join(directory, "bench.db"))
+        connection.autocommit = True
+        backends["sqlite"] = run(connection.cursor(), args.iterations, args.users, args.messages)
+        connection.close()
+
+    try:
+        connection = bench_connection(args.database)
+    except storage.CONNECTION_ERRORS as err:
+        print(f"Skipping PostgreSQL, {args.database} is not reachable: {str(err).strip()}\n")
+    else:
+        create_db.upgrade(connection)
+        connection.autocommit = True
+        backends["postgres"] = run(connection.cursor(), args.iterations, args.users, args.messages)
+        connection.close()
+
+    header = "".join(f"{f'{backend} mean':>16}{f'{backend} p95':>15}" for backend in backends)
+    print(f"{'operation':<30}{header}" + (f"{'sqlite/pg':>11}" if len(backends) == 2 else ""))
+    for name in backends["sqlite"]:
+        row = "".join(f"{results[name][0] * 1e6:>14.0f}us{results[name][1] * 1e6:>13.0f}us"
+                      for results in backends.values())
+        if len(backends) == 2:
+            row += f"{backends['sqlite'][name][0] / backends['postgres'][name][0]:>10.2f}x"
+        print(f"{name:<30}{row}")
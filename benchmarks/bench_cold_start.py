@@ -0,0 +1,49 @@
+"""
+Cold-start benchmark of the command line entry points.
+
+Starts each command in a fresh interpreter several times and reports the
+median and best wall time. The legacy CLIs import psycopg2 (through
+db_operations) before doing anything, while messenger.py only imports what a
+subcommand needs, so the comparison shows what the lazy imports save on
+every invocation. No database is needed: the commands only print their help
+or run a command that never connects.
+
+Usage:
+    python benchmarks/bench_cold_start.py [-r RUNS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+COMMANDS = [
+    ("interpreter only", ["-c", "pass"]),
+    ("mess_app.py --help", ["mess_app.py", "--help"]),
+    ("user_app.py --help", ["user_app.py", "--help"]),
+    ("messenger.py --help", ["messenger.py", "--help"]),
+    ("messenger.py send --help", ["messenger.py", "send", "--help"]),
+]
+
+
+def time_command(argv, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--runs', help='runs per command (default 20)', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'command':<28}{'median ms':>12}{'best ms':>10}")
+    for name, argv in COMMANDS:
+        timings = time_command(argv, args.runs)
+        print(f"{name:<28}{statistics.median(timings) * 1000:>12.1f}{min(timings) * 1000:>10.1f}")
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of the row-to-object path used by the User and Message loaders.
+
+Compares building objects the way the loaders used to (through the
+constructor, which salts and hashes an empty password for every User) with
+User.from_row / Message.from_row, and reports the memory held per object.
+No database is needed: the rows are generated in memory.
+
+Usage:
+    python benchmarks/bench_loaders.py [-n ROWS] [-r REPEAT]
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import crypto
+from db_operations import User, Message
+
+
+def user_via_constructor(rows):
+    users = []
+    for id_, username, hashed_password in rows:
+        loaded_user = User(username)
+        loaded_user._id = id_
+        loaded_user._hashed_password = hashed_password
+        users.append(loaded_user)
+    return users
+
+
+def user_via_from_row(rows):
+    return [User.from_row(row) for row in rows]
+
+
+def message_via_constructor(rows):
+    messages = []
+    for id_, from_id, to_id, text, creation_date in rows:
+        loaded_message = Message(from_id, to_id, text)
+        loaded_message._id = id_
+        loaded_message._creation_date = creation_date
+        messages.append(loaded_message)
+    return messages
+
+
+def message_via_from_row(rows):
+    return [Message.from_row(row) for row in rows]
+
+
+def best_of(function, rows, repeat):
+    return min(timeit.repeat(lambda: function(rows), number=1, repeat=repeat))
+
+
+def bytes_per_object(function, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = function(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rows', help='number of rows to materialize (default 100000)', type=int, default=100000)
+    parser.add_argument('-r', '--repeat', help='number of timed runs, the best one is reported (default 5)',
+                        type=int, default=5)
+    args = parser.parse_args()
+
+    hashed = crypto.hash_password("password123")
+    now = datetime.datetime.now()
+    user_rows = [(i, f"user{i}", hashed) for i in range(args.rows)]
+    message_rows = [(i, i % 1000, (i + 1) % 1000, "Hello, how are you?", now) for i in range(args.rows)]
+
+    print(f"{'loader':<28}{'seconds':>10}{'rows/s':>14}{'bytes/object':>14}")
+    for name, function, rows in (
+            ("User via __init__", user_via_constructor, user_rows),
+            ("User.from_row", user_via_from_row, user_rows),
+            ("Message via __init__", message_via_constructor, message_rows),
+            ("Message.from_row", message_via_from_row, message_rows),
+    ):
+        seconds = best_of(function, rows, args.repeat)
+        print(f"{name:<28}{seconds:>10.4f}{len(rows) / seconds:>14,.0f}{bytes_per_object(function, rows):>14.1f}")
@@ -0,0 +1,71 @@
+"""
+Per-query latency of the hot db_operations statements with and without
+server-side prepared statements.
+
+Runs every query many times on one connection, first as plain text and then
+with db_operations.PREPARE switched on, and prints the mean and p95 latency.
+The message inserts happen inside a transaction that is rolled back at the
+end, so the database is left unchanged.
+
+Needs a database with at least one user (see config.py for the connection
+settings; create_db.py and a few user_app calls are enough).
+
+Usage:
+    python benchmarks/bench_prepared.py -u USERNAME [-n ITERATIONS]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from psycopg2 import connect
+
+import config
+import db_operations
+from db_operations import User, Message
+
+
+def measure(function, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.mean(timings), statistics.quantiles(timings, n=20)[-1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-u', '--username', help='an existing user to query', required=True)
+    parser.add_argument('-n', '--iterations', help='runs per query and mode (default 2000)', type=int, default=2000)
+    args = parser.parse_args()
+
+    connection = connect(**config.connection_kwargs())
+    cursor = connection.cursor()
+    user = User.load_user_by_username(cursor, args.username)
+    if user is None:
+        sys.exit(1)
+
+    queries = [
+        ("load_user_by_username", lambda: User.load_user_by_username(cursor, args.username)),
+        ("load_user_by_id", lambda: User.load_user_by_id(cursor, user.id)),
+        ("load_inbox", lambda: Message.load_inbox(cursor, user.id)),
+        ("Message.save_to_db", lambda: Message(user.id, user.id, "benchmark").save_to_db(cursor)),
+    ]
+
+    print(f"{'query':<24}{'plain mean':>12}{'plain p95':>12}{'prep. mean':>12}{'prep. p95':>12}{'speedup':>9}")
+    for name, query in queries:
+        results = []
+        for prepare in (False, True):
+            db_operations.PREPARE = prepare
+            query()  # warm up: connection caches, and the PREPARE itself
+            results.append(measure(query, args.iterations))
+        (plain_mean, plain_p95), (prepared_mean, prepared_p95) = results
+        print(f"{name:<24}{plain_mean * 1e6:>10.0f}us{plain_p95 * 1e6:>10.0f}us"
+              f"{prepared_mean * 1e6:>10.0f}us{prepared_p95 * 1e6:>10.0f}us{plain_mean / prepared_mean:>8.2f}x")
+
+    connection.rollback()
+    connection.close()
@@ -0,0 +1,164 @@
+"""
+Seeded synthetic data generator for the benchmark database.
+
+Creates (or recreates) a throwaway database, migrates it with create_db.py
+and fills it with COPY:
+
+    users     user1 .. userN, the password of userK is "passwordK"
+    messages  random sender and recipient, creation dates spread over the
+              last year, short random texts
+
+The same seed always produces the same rows, so results measured on
+different commits are comparable. Rows are generated while COPY consumes
+them, so memory use does not depend on the scale.
+
+Usage:
+    python benchmarks/datagen.py [--database NAME] [--users N] [--messages N] [--seed S] [--recreate]
+"""
+import argparse
+import datetime
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from psycopg2 import connect, sql
+from psycopg2.errors import DuplicateDatabase
+
+import config
+import create_db
+import crypto
+
+BENCH_DATABASE = "messenger_bench"
+
+WORDS = ("hello how are you see tomorrow meeting lunch thanks great call me later "
+         "ok sure report deadline project coffee weekend news send file").split()
+
+COPY_CHUNK = 100000
+
+
+class IteratorFile(io.RawIOBase):
+    """A read-only file whose content is produced by an iterator of str lines."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while len(self._buffer) < len(target):
+            try:
+                self._buffer += next(self._lines).encode("utf-8")
+            except StopIteration:
+                break
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def bench_connection(database):
+    """Connect to the benchmark database, refusing to touch the real one."""
+    if database == config.DB_NAME:
+        raise SystemExit(f"Refusing to use {database}, the application database; pick a throwaway one.")
+    kwargs = config.connection_kwargs()
+    kwargs["database"] = database
+    return connect(**kwargs)
+
+
+def create_database(database, recreate):
+    kwargs = config.connection_kwargs()
+    kwargs["database"] = "postgres"
+    connection = connect(**kwargs)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        if recreate:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(database)))
+        try:
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
+        except DuplicateDatabase:
+            pass
+    connection.close()
+
+
+def user_lines(rng, users):
+    # crypto draws salts from the global random module, seed it too
+    random.seed(rng.random())
+    for i in range(1, users + 1):
+        yield f"user{i}\t{crypto.hash_password(f'password{i}')}\n"
+
+
+NOW = datetime.datetime(2026, 1, 1)
+"""
+NOW is the end of the year the generated messages are spread over.
+"""
+
+
+def message_lines(rng, users, messages):
+    now = NOW
+    year = 365 * 24 * 60 * 60
+    for _ in range(messages):
+        from_id = rng.randint(1, users)
+        to_id = rng.randint(1, users)
+        created = now - datetime.timedelta(seconds=rng.randrange(year))
+        text = " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))
+        yield f"{from_id}\t{to_id}\t{created.isoformat(sep=' ')}\t{text}\n"
+
+
+def copy_in_chunks(cursor, table, columns, lines, total):
+    started = time.perf_counter()
+    done = 0
+    while done < total:
+        size = min(COPY_CHUNK, total - done)
+        chunk = (next(lines) for _ in range(size))
+        cursor.copy_expert(f"COPY {table}({columns}) FROM STDIN", IteratorFile(chunk))
+        cursor.connection.commit()
+        done += size
+        rate = done / (time.perf_counter() - started)
+        print(f"\r{table}: {done}/{total} rows ({rate:,.0f} rows/s)", end="", flush=True)
+    print()
+
+
+def generate(database, users, messages, seed):
+    """Fill an empty, migrated benchmark database."""
+    connection = bench_connection(database)
+    create_db.upgrade(connection)
+    connection.autocommit = False
+    cursor = connection.cursor()
+
+    cursor.execute("SELECT (SELECT count(*) FROM users) + (SELECT count(*) FROM messages)")
+    if cursor.fetchone()[0]:
+        raise SystemExit(f"{database} already contains data, use --recreate to start over.")
+
+    # the year of messages goes to its monthly partitions, not the default one
+    create_db.create_partitions(cursor, (NOW - datetime.timedelta(days=366)).date())
+    connection.commit()
+
+    rng = random.Random(seed)
+    copy_in_chunks(cursor, "users", "username, hashed_password", user_lines(rng, users), users)
+    copy_in_chunks(cursor, "messages", "from_id, to_id, creation_date, text",
+                   message_lines(rng, users, messages), messages)
+
+    connection.autocommit = True
+    cursor.execute("ANALYZE")
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help=f'benchmark database (default {BENCH_DATABASE})', default=BENCH_DATABASE)
+    parser.add_argument('--users', help='number of users (default 10000)', type=int, default=10000)
+    parser.add_argument('--messages', help='number of messages (default 1000000)', type=int, default=1000000)
+    parser.add_argument('--seed', help='random seed (default 42)', type=int, default=42)
+    parser.add_argument('--recreate', help='drop and recreate the database first', action='store_true')
+    args = parser.parse_args()
+
+    if args.database == config.DB_NAME:
+        raise SystemExit(f"Refusing to use {args.database}, the application database; pick a throwaway one.")
+    create_database(args.database, args.recreate)
+    generate(args.database, args.users, args.messages, args.seed)
@@ -0,0 +1,229 @@
+"""
+Concurrent load test: many clients sending, reading, signing up and changing
+passwords at once.
+
+For every concurrency level of --ramp, starts that many worker processes,
+each with its own connection, running a weighted mix of operations through
+the db_operations API for --duration seconds:
+
+    send     look up the recipient by username, Message.save_to_db
+    inbox    Message.load_inbox of a random user
+    create   hash a password, User.save_to_db of a new user
+    passwd   load a user, hash a password, User.save_to_db (the password
+             stays "passwordK", so run.py can still log in afterwards)
+
+and reports throughput and p50/p95/p99 latency per operation and level, so
+the point where adding clients stops adding throughput (sequence or row lock
+contention, connection limits, cascading foreign keys, CPU) is visible.
+
+With --buffered, every worker sends through a write_buffer writer instead
+of one autocommitted INSERT per message; a send then does not wait for its
+commit, and its latency is measured from the submit to the commit of its
+batch.
+
+Runs against the throwaway benchmark database filled by datagen.py; unlike
+run.py it does not roll its writes back.
+
+Usage:
+    python benchmarks/loadtest.py [--ramp 1,2,4,8,16,32] [--duration 10] [--buffered]
+                                  [--mix send=60,inbox=30,create=5,passwd=5] [--output results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from psycopg2 import Error
+
+from db_operations import User, Message
+from datagen import BENCH_DATABASE, bench_connection
+from write_buffer import BufferedMessageWriter
+
+OPERATIONS = ("send", "inbox", "create", "passwd")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def run_operation(cursor, name, rng, users, worker_id, counter, writer=None):
+    """Run one operation; a send through `writer` returns the future of its commit."""
+    if name == "send":
+        recipient = User.load_user_by_username(cursor, f"user{rng.randint(1, users)}")
+        message = Message(rng.randint(1, users), recipient.id, "load test message")
+        if writer is not None:
+            return writer.submit(message)
+        message.save_to_db(cursor)
+    elif name == "inbox":
+        Message.load_inbox(cursor, rng.randint(1, users))
+    elif name == "create":
+        User(f"load-{os.getpid()}-{worker_id}-{counter}", "password123").save_to_db(cursor)
+    elif name == "passwd":
+        number = rng.randint(1, users)
+        user = User.load_user_by_username(cursor, f"user{number}")
+        user.new_password(f"password{number}")
+        user.save_to_db(cursor)
+
+
+def worker(worker_id, database, users, mix, duration, seed, buffered, ready, start, results):
+    """Run the operation mix until the stage ends and report the latencies."""
+    rng = random.Random(seed * 1000 + worker_id)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    connection = writer = None
+    connect_error = None
+    # always report, and always let the stage start: run_stage waits for both
+    try:
+        try:
+            connection = bench_connection(database)
+            connection.autocommit = True
+            cursor = connection.cursor()
+        except Error as err:
+            connect_error = str(err)
+            return
+        writer = BufferedMessageWriter(lambda: bench_connection(database)) if buffered else None
+
+        def committed(future, name, started):
+            if future.exception() is None:
+                latencies[name].append(time.perf_counter() - started)
+            else:
+                errors[name] += 1
+
+        ready.set()
+        start.wait()
+        deadline = time.perf_counter() + duration
+        counter = 0
+
+        # the printed "There is no user" style messages of the loaders are noise here
+        sys.stdout = open(os.devnull, "w")
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            counter += 1
+            started = time.perf_counter()
+            try:
+                future = run_operation(cursor, name, rng, users, worker_id, counter, writer)
+                if future is None:
+                    latencies[name].append(time.perf_counter() - started)
+                else:
+                    future.add_done_callback(lambda future, name=name, started=started: committed(future, name,
+                                                                                                  started))
+            except Exception:
+                # database errors, but also e.g. the AttributeError of a user
+                # that was not found: an error of this operation, not the end
+                # of the worker
+                errors[name] += 1
+    finally:
+        ready.set()
+        if writer is not None:
+            writer.close()
+        if connection is not None:
+            connection.close()
+        results.put({"worker": worker_id, "latencies": latencies, "errors": errors, "connect_error": connect_error})
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_stage(concurrency, database, users, mix, duration, seed, buffered=False):
+    """Run one concurrency level and aggregate the workers' results."""
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    processes = []
+    for worker_id in range(concurrency):
+        ready = context.Event()
+        process = context.Process(target=worker,
+                                  args=(worker_id, database, users, mix, duration, seed, buffered, ready, start,
+                                        results))
+        process.start()
+        processes.append((process, ready))
+    for _, ready in processes:
+        ready.wait()
+
+    start.set()
+    reports = [results.get() for _ in processes]
+    for process, _ in processes:
+        process.join()
+
+    stage = {"concurrency": concurrency, "connect_errors": 0, "operations": {}}
+    for report in reports:
+        if report["connect_error"]:
+            stage["connect_errors"] += 1
+    for name in mix:
+        values = sorted(value for report in reports for value in report["latencies"][name])
+        stage["operations"][name] = {
+            "count": len(values),
+            "errors": sum(report["errors"][name] for report in reports),
+            "throughput": len(values) / duration,
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "mean": statistics.mean(values) if values else 0.0,
+        }
+    stage["throughput"] = sum(stats["throughput"] for stats in stage["operations"].values())
+    return stage
+
+
+def print_stage(stage):
+    print(f"\nconcurrency {stage['concurrency']}: {stage['throughput']:,.0f} ops/s"
+          + (f", {stage['connect_errors']} workers could not connect" if stage["connect_errors"] else ""))
+    print(f"  {'operation':<10}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, stats in stage["operations"].items():
+        print(f"  {name:<10}{stats['throughput']:>10,.1f}{stats['p50'] * 1000:>10.2f}"
+              f"{stats['p95'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}{stats['errors']:>8}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help=f'benchmark database (default {BENCH_DATABASE})', default=BENCH_DATABASE)
+    parser.add_argument('--ramp', help='comma separated worker counts (default 1,2,4,8,16,32)', default='1,2,4,8,16,32',
+                        type=lambda text: [int(value) for value in text.split(",")])
+    parser.add_argument('--duration', help='seconds per concurrency level (default 10)', type=float, default=10)
+    parser.add_argument('--mix', help='operation weights (default send=60,inbox=30,create=5,passwd=5)',
+                        type=parse_mix, default=parse_mix("send=60,inbox=30,create=5,passwd=5"))
+    parser.add_argument('--seed', help='random seed (default 42)', type=int, default=42)
+    parser.add_argument('--buffered', help='send through a write-behind writer with group commit (flag)',
+                        action='store_true')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    connection = bench_connection(args.database)
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM users WHERE username LIKE 'user%'")
+    users = cursor.fetchone()[0]
+    connection.close()
+    if not users:
+        raise SystemExit(f"{args.database} has no users, fill it with benchmarks/datagen.py first.")
+
+    stages = []
+    for concurrency in args.ramp:
+        stage = run_stage(concurrency, args.database, users, args.mix, args.duration, args.seed, args.buffered)
+        print_stage(stage)
+        stages.append(stage)
+
+    best = max(stages, key=lambda stage: stage["throughput"])
+    print(f"\nPeak throughput {best['throughput']:,.0f} ops/s at {best['concurrency']} workers.")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"database": args.database, "mix": args.mix, "duration": args.duration,
+                       "buffered": args.buffered, "stages": stages},
+                      file, indent=2)
@@ -0,0 +1,156 @@
+"""
+Reproducible benchmark suite for the real entry points of the application.
+
+1. Fill a throwaway database (never the application one):
+       python benchmarks/datagen.py --recreate --users 10000 --messages 10000000
+2. Time the entry points and store the results:
+       python benchmarks/run.py --output before.json
+3. Check out another commit, run again and compare:
+       python benchmarks/run.py --output after.json --compare before.json
+
+Every benchmark picks its users with a seeded random generator, so two runs
+on the same data issue the same queries. Writes (send_message) happen in a
+transaction that is rolled back, so the data stays identical between runs.
+The printed output of the CLI functions is discarded.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import crypto
+import mess_app
+import user_app
+from db_operations import User, Message, Conversation
+from datagen import BENCH_DATABASE, bench_connection
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(function, iterations, warmup=3):
+    """Call `function(i)` and return latency statistics in seconds."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(warmup):
+            function(i)
+        timings = []
+        for i in range(iterations):
+            started = time.perf_counter()
+            function(i)
+            timings.append(time.perf_counter() - started)
+
+    return {
+        "iterations": iterations,
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "p95": statistics.quantiles(timings, n=20)[-1] if iterations > 1 else timings[0],
+        "min": min(timings),
+    }
+
+
+def benchmarks(cursor, users, seed):
+    """The timed entry points, as (name, function of the iteration number, heavy)."""
+    rng = random.Random(seed)
+    picks = [rng.randint(1, users) for _ in range(10000)]
+
+    def pick(i):
+        return picks[i % len(picks)]
+
+    hashed = crypto.hash_password("password1")
+
+    return [
+        ("crypto.hash_password", lambda i: crypto.hash_password("password1"), False),
+        ("crypto.check_password", lambda i: crypto.check_password("password1", hashed), False),
+        ("User.load_user_by_username", lambda i: User.load_user_by_username(cursor, f"user{pick(i)}"), False),
+        ("Message.load_all_messages(user_id)", lambda i: Message.load_all_messages(cursor, pick(i)), False),
+        ("Message.load_all_messages(one month)",
+         lambda i: Message.load_all_messages(cursor, since=datetime.datetime(2025, 6, 1),
+                                             until=datetime.datetime(2025, 7, 1)), True),
+        ("Message.load_inbox", lambda i: Message.load_inbox(cursor, pick(i)), False),
+        ("Conversation.load_conversations", lambda i: Conversation.load_conversations(cursor, pick(i)), False),
+        ("Message.load_thread", lambda i: Message.load_thread(cursor, pick(i), pick(i + 1)), False),
+        ("Message.load_unread", lambda i: Message.load_unread(cursor, pick(i), 20), False),
+        ("Message.search", lambda i: Message.search(cursor, pick(i), "meeting tomorrow"), False),
+        ("mess_app.list_user_messages",
+         lambda i: mess_app.list_user_messages(cursor, f"user{pick(i)}", f"password{pick(i)}"), False),
+        ("mess_app.send_message",
+         lambda i: mess_app.send_message(cursor, f"user{pick(i)}", f"password{pick(i)}",
+                                         f"user{pick(i + 1)}", "benchmark message"), False),
+        ("user_app.show_users", lambda i: user_app.show_users(cursor), True),
+    ]
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    print(f"\nCompared with {baseline['commit']} ({baseline_path}):")
+    print(f"{'benchmark':<38}{'before ms':>12}{'after ms':>12}{'change':>9}")
+    for name, stats in results["results"].items():
+        before = baseline["results"].get(name)
+        if before:
+            change = stats["median"] / before["median"]
+            print(f"{name:<38}{before['median'] * 1000:>12.3f}{stats['median'] * 1000:>12.3f}{change:>8.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help=f'benchmark database (default {BENCH_DATABASE})', default=BENCH_DATABASE)
+    parser.add_argument('-n', '--iterations', help='runs per benchmark (default 200)', type=int, default=200)
+    parser.add_argument('--heavy-iterations', help='runs of the full-table benchmarks (default 3)', type=int, default=3)
+    parser.add_argument('--seed', help='random seed for the users picked (default 42)', type=int, default=42)
+    parser.add_argument('--only', help='run only benchmarks whose name contains this text')
+    parser.add_argument('--output', help='JSON file to write (default benchmarks/results-<commit>.json)')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    connection = bench_connection(args.database)
+    connection.autocommit = False
+    cursor = connection.cursor()
+    cursor.execute("SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM messages)")
+    user_count, message_count = cursor.fetchone()
+    if not user_count:
+        raise SystemExit(f"{args.database} has no users, fill it with benchmarks/datagen.py first.")
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": {"name": args.database, "users": user_count, "messages": message_count},
+        "results": {},
+    }
+
+    print(f"{'benchmark':<38}{'median ms':>12}{'p95 ms':>10}{'min ms':>10}")
+    for name, function, heavy in benchmarks(cursor, user_count, args.seed):
+        if args.only and args.only not in name:
+            continue
+        iterations = args.heavy_iterations if heavy else args.iterations
+        stats = measure(function, iterations, warmup=1 if heavy else 3)
+        # leave the data exactly as it was for the next benchmark and run
+        connection.rollback()
+        results["results"][name] = stats
+        print(f"{name:<38}{stats['median'] * 1000:>12.3f}{stats['p95'] * 1000:>10.3f}{stats['min'] * 1000:>10.3f}")
+    connection.close()
+
+    output = args.output or os.path.join(ROOT, "benchmarks", f"results-{commit}.json")
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,170 @@
+import os
+import tempfile
+
+
+DB_USER = os.environ.get("MESSENGER_DB_USER", "postgres")
+DB_PASSWORD = os.environ.get("MESSENGER_DB_PASSWORD", "coderslab")
+DB_HOST = os.environ.get("MESSENGER_DB_HOST", "localhost")
+DB_NAME = os.environ.get("MESSENGER_DB_NAME", "messanger_db")
+"""
+Connection settings of the messenger database. Every setting can be
+overridden with the environment variable of the same name prefixed with
+MESSENGER_, e.g. MESSENGER_DB_HOST.
+"""
+
+DAEMON_SOCKET = os.environ.get(
+    "MESSENGER_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"messenger-{os.getuid()}"),
+                 f"messenger-{os.getuid()}.sock"))
+"""
+DAEMON_SOCKET is the path of the Unix-domain socket the daemon listens on and
+the CLIs look for. Without XDG_RUNTIME_DIR it lives in a directory of its own
+in the temporary directory, which the daemon creates private to its user: the
+CLIs send passwords over the socket.
+"""
+
+USE_DAEMON = os.environ.get("MESSENGER_USE_DAEMON", "1") != "0"
+"""
+USE_DAEMON lets the CLIs forward commands to a running daemon. Set
+MESSENGER_USE_DAEMON=0 to always connect to the database directly.
+"""
+
+POOL_MIN_CONNECTIONS = int(os.environ.get("MESSENGER_POOL_MIN_CONNECTIONS", "1"))
+POOL_MAX_CONNECTIONS = int(os.environ.get("MESSENGER_POOL_MAX_CONNECTIONS", "10"))
+"""
+Size of the connection pool held by the daemon.
+"""
+
+
+def libpq_dsn(**params):
+    """Build a libpq connection string.
+
+        Args:
+            **params: The connection parameters, e.g. host and dbname.
+
+        Returns:
+            str: The parameters as key='value' pairs, quoted and escaped the way libpq expects.
+        """
+    return " ".join("{}='{}'".format(key, str(value).replace("\\", "\\\\").replace("'", "\\'"))
+                    for key, value in params.items())
+
+
+def connection_kwargs():
+    """Get the keyword arguments for psycopg2.connect.
+
+        Returns:
+            dict: user, password, host and database of the messenger database.
+        """
+    return dict(user=DB_USER, password=DB_PASSWORD, host=DB_HOST, database=DB_NAME)
+
+
+CACHE_DIR = os.environ.get(
+    "MESSENGER_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "messenger"))
+"""
+CACHE_DIR holds the per-user state of the CLIs: the session signing key and
+the session tokens issued by --login.
+"""
+
+SESSION_TTL = int(os.environ.get("MESSENGER_SESSION_TTL", str(8 * 60 * 60)))
+"""
+SESSION_TTL is the number of seconds a session token stays valid.
+"""
+
+PREPARED_STATEMENTS = os.environ.get("MESSENGER_PREPARED_STATEMENTS", "1") != "0"
+"""
+PREPARED_STATEMENTS lets long-lived processes (the daemon and the interactive
+shell) run the hot queries as server-side prepared statements. One-shot CLI
+invocations never prepare.
+"""
+
+BACKEND = os.environ.get("MESSENGER_BACKEND", "postgres")
+"""
+BACKEND selects the storage backend: "postgres" (the server configured above)
+or "sqlite" (an embedded database file, see storage.py).
+"""
+
+SQLITE_PATH = os.environ.get(
+    "MESSENGER_SQLITE_PATH",
+    os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"),
+                 "messenger", "messenger.db"))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("MESSENGER_SQLITE_BUSY_TIMEOUT", "5000"))
+"""
+Database file of the sqlite backend, and how many milliseconds a writer waits
+for another process's write lock before failing.
+"""
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get("MESSENGER_PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_MAINTENANCE_INTERVAL = int(os.environ.get("MESSENGER_PARTITION_MAINTENANCE_INTERVAL", str(24 * 60 * 60)))
+"""
+The monthly partitions of messages are created this many months ahead, by
+`create_db.py maintain` and by the daemon every PARTITION_MAINTENANCE_INTERVAL
+seconds.
+"""
+
+ARCHIVE_DIR = os.environ.get(
+    "MESSENGER_ARCHIVE_DIR",
+    os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"),
+                 "messenger", "archive"))
+"""
+ARCHIVE_DIR is where `create_db.py archive` writes the partitions it drops.
+"""
+
+PURGE_BATCH_SIZE = int(os.environ.get("MESSENGER_PURGE_BATCH_SIZE", "5000"))
+PURGE_PAUSE = float(os.environ.get("MESSENGER_PURGE_PAUSE", "0.1"))
+"""
+`user_app --purge` deletes the messages of deleted accounts PURGE_BATCH_SIZE
+at a time and sleeps PURGE_PAUSE seconds between two batches, leaving room
+for everyone else's queries.
+"""
+
+MAX_BODY_LENGTH = int(os.environ.get("MESSENGER_MAX_BODY_LENGTH", str(1024 * 1024)))
+BODY_COMPRESS_THRESHOLD = int(os.environ.get("MESSENGER_BODY_COMPRESS_THRESHOLD", "1024"))
+"""
+Messages longer than messages.text (255 characters) keep a preview there and
+their full text, of at most MAX_BODY_LENGTH characters, in message_bodies.
+Bodies of more than BODY_COMPRESS_THRESHOLD bytes are stored zlib-compressed.
+"""
+
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get("MESSENGER_ATTACHMENT_CHUNK_SIZE", str(256 * 1024)))
+"""
+ATTACHMENT_CHUNK_SIZE is the number of bytes per attachment_chunks row, and so
+the most of an attachment held in memory while it is sent or saved.
+"""
+
+WRITE_BUFFER = os.environ.get("MESSENGER_WRITE_BUFFER", "0") != "0"
+WRITE_BUFFER_MAX_ROWS = int(os.environ.get("MESSENGER_WRITE_BUFFER_MAX_ROWS", "500"))
+WRITE_BUFFER_MAX_DELAY = float(os.environ.get("MESSENGER_WRITE_BUFFER_MAX_DELAY", "0.02"))
+WRITE_BUFFER_QUEUE_SIZE = int(os.environ.get("MESSENGER_WRITE_BUFFER_QUEUE_SIZE", "10000"))
+"""
+WRITE_BUFFER makes the daemon save new messages through a write_buffer
+writer: batches of up to WRITE_BUFFER_MAX_ROWS messages, each waiting at most
+WRITE_BUFFER_MAX_DELAY seconds, committed together. Senders wait for the
+writer once WRITE_BUFFER_QUEUE_SIZE messages are queued. Off by default, set
+MESSENGER_WRITE_BUFFER=1 to switch it on.
+"""
+
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get("MESSENGER_REPLICA_DSNS", "").split(",") if dsn.strip()]
+REPLICA_MAX_LAG = float(os.environ.get("MESSENGER_REPLICA_MAX_LAG", "1.0"))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("MESSENGER_REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_STICKY_SECONDS = float(os.environ.get("MESSENGER_REPLICA_STICKY_SECONDS", "5"))
+"""
+Read replicas of the PostgreSQL database, as comma separated libpq connection
+strings (see replicas.py); none by default. A replica more than
+REPLICA_MAX_LAG seconds behind is skipped, replication lag is checked every
+REPLICA_CHECK_INTERVAL seconds, and the reads of a user who wrote stay on the
+primary for REPLICA_STICKY_SECONDS.
+"""
+
+SHARD_COUNT = int(os.environ.get("MESSENGER_SHARD_COUNT", "0"))
+SHARD_DSNS = [dsn.strip() for dsn in os.environ.get("MESSENGER_SHARD_DSNS", "").split(",") if dsn.strip()] or [
+    libpq_dsn(user=DB_USER, password=DB_PASSWORD, host=DB_HOST, dbname=f"{DB_NAME}_{number}")
+    for number in range(SHARD_COUNT)]
+"""
+SHARD_DSNS is the shard map: the PostgreSQL databases users and messages are
+spread over (see shards.py), as comma separated libpq connection strings,
+shard 0 first. The order must never change, shards are only ever added at
+the end. Without MESSENGER_SHARD_DSNS, MESSENGER_SHARD_COUNT=N shards over
+the databases DB_NAME_0 ... DB_NAME_<N-1> of the server above, e.g. to try
+sharding on one local PostgreSQL. Empty by default: one database, DB_NAME.
+"""
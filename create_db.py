@@ -1,18 +1,28 @@
+import argparse
+import datetime
+import gzip
 import os
+import re
+import sys
+from collections import namedtuple
 
-from psycopg2 import connect, OperationalError
-from psycopg2.errors import DuplicateDatabase, DuplicateTable
+from psycopg2 import connect, OperationalError, Error
+from psycopg2.errors import DuplicateDatabase
 
+import config
+import storage
 
-username = "postgres"
-passwd = "coderslab"
-server = "localhost"
 
+username = config.DB_USER
+passwd = config.DB_PASSWORD
+server = config.DB_HOST
+database = config.DB_NAME
 
 
-CREATE_DATABASE = "CREATE DATABASE messanger_db"
 
-CREATE_TABLE_USERS = """CREATE TABLE users
+CREATE_DATABASE = f"CREATE DATABASE {database}"
+
+CREATE_TABLE_USERS = """CREATE TABLE IF NOT EXISTS users
                     (
                         user_id serial ,
                         username varchar(255),
@@ -20,7 +30,7 @@ CREATE_TABLE_USERS = """CREATE TABLE users
                         PRIMARY KEY(user_id)
                     );"""
 
-CREATE_TABLE_MESSAGES = """CREATE TABLE messages 
+CREATE_TABLE_MESSAGES = """CREATE TABLE IF NOT EXISTS messages
                     (
                         message_id serial ,
                         from_id int,
@@ -29,39 +39,863 @@ CREATE_TABLE_MESSAGES = """CREATE TABLE messages
                         text varchar(255),
                         PRIMARY KEY(message_id),
                         FOREIGN KEY(from_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                        FOREIGN KEY(to_id) REFERENCES users(user_id) ON DELETE CASCADE 
+                        FOREIGN KEY(to_id) REFERENCES users(user_id) ON DELETE CASCADE
                     );"""
 
+CREATE_TABLE_SCHEMA_VERSION = """CREATE TABLE IF NOT EXISTS schema_version
+                    (
+                        version int,
+                        description varchar(255),
+                        applied_at timestamp DEFAULT current_timestamp,
+                        PRIMARY KEY(version)
+                    );"""
 
-try:
-    connection = connect(user=username, password=passwd, host=server)
-    connection.autocommit = True
-    cursor = connection.cursor()
+CREATE_TABLE_CONVERSATIONS = """CREATE TABLE IF NOT EXISTS conversations
+                    (
+                        user_id int,
+                        counterpart_id int,
+                        last_message_id int,
+                        last_date timestamp,
+                        message_count int NOT NULL DEFAULT 0,
+                        unread_count int NOT NULL DEFAULT 0,
+                        PRIMARY KEY(user_id, counterpart_id),
+                        FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+                        FOREIGN KEY(counterpart_id) REFERENCES users(user_id) ON DELETE CASCADE
+                    );"""
+
+CONVERSATIONS_UPSERT = """INSERT INTO conversations AS c
+                        (user_id, counterpart_id, last_message_id, last_date, message_count, unread_count)
+                    SELECT user_id, counterpart_id,
+                           (array_agg(message_id ORDER BY creation_date DESC, message_id DESC))[1],
+                           max(creation_date), count(*), sum(unread)
+                    FROM (SELECT to_id AS user_id, from_id AS counterpart_id, message_id, creation_date, 1 AS unread
+                          FROM {source} WHERE to_id IS NOT NULL
+                          UNION ALL
+                          SELECT from_id, to_id, message_id, creation_date, 0
+                          FROM {source} WHERE from_id <> to_id) AS sides
+                    GROUP BY user_id, counterpart_id
+                    ORDER BY user_id, counterpart_id
+                    ON CONFLICT (user_id, counterpart_id) DO UPDATE SET
+                        last_message_id = CASE WHEN (excluded.last_date, excluded.last_message_id)
+                                                    > (c.last_date, c.last_message_id)
+                                               THEN excluded.last_message_id ELSE c.last_message_id END,
+                        last_date = greatest(c.last_date, excluded.last_date),
+                        message_count = c.message_count + excluded.message_count,
+                        unread_count = c.unread_count + excluded.unread_count"""
+"""
+CONVERSATIONS_UPSERT adds the messages of {source} to the conversation
+summaries: one row per (user, counterpart) pair for each side of every
+message, the recipient's side counted as unread. Group messages have no
+recipient user and belong to no conversation. The pairs are upserted in
+key order, so concurrent inserts lock the summary rows in the same order
+and cannot deadlock.
+"""
+
+CREATE_FUNCTION_CONVERSATIONS_UPDATE = f"""CREATE OR REPLACE FUNCTION conversations_update() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        {CONVERSATIONS_UPSERT.format(source="inserted")};
+                        RETURN NULL;
+                    END
+                    $$;"""
+"""
+The statement level trigger function behind conversations: a multi-row
+INSERT or a COPY updates each pair once, not once per message.
+"""
+
+CREATE_TRIGGER_CONVERSATIONS_UPDATE = """CREATE TRIGGER messages_conversations_update
+                    AFTER INSERT ON messages REFERENCING NEW TABLE AS inserted
+                    FOR EACH STATEMENT EXECUTE FUNCTION conversations_update();"""
+
+CREATE_TABLE_READ_MARKS = """CREATE TABLE IF NOT EXISTS read_marks
+                    (
+                        user_id int,
+                        last_read_id int NOT NULL DEFAULT 0,
+                        PRIMARY KEY(user_id),
+                        FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+                    );"""
+
+CREATE_FUNCTION_MESSAGES_NOTIFY = """CREATE OR REPLACE FUNCTION messages_notify() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        PERFORM pg_notify('messages_' || to_id, max(message_id)::text)
+                        FROM inserted WHERE to_id IS NOT NULL GROUP BY to_id;
+                        PERFORM pg_notify('groups_' || group_id, max(message_id)::text)
+                        FROM inserted WHERE group_id IS NOT NULL GROUP BY group_id;
+                        RETURN NULL;
+                    END
+                    $$;"""
+"""
+The statement level trigger function that wakes up `mess_app --follow`: one
+notification on the channel messages_<to_id> per recipient of the inserted
+messages, and one on groups_<group_id> per group they were sent to, carrying
+the highest new message id. Notifications are delivered
+when the transaction commits.
+"""
+
+CREATE_TRIGGER_MESSAGES_NOTIFY = """CREATE TRIGGER messages_notify
+                    AFTER INSERT ON messages REFERENCING NEW TABLE AS inserted
+                    FOR EACH STATEMENT EXECUTE FUNCTION messages_notify();"""
+
+CREATE_TABLE_MESSAGES_PARTITIONED = """CREATE TABLE messages
+                    (
+                        message_id int NOT NULL DEFAULT nextval('messages_message_id_seq'),
+                        from_id int,
+                        to_id int,
+                        creation_date timestamp NOT NULL DEFAULT current_timestamp,
+                        text varchar(255),
+                        text_search tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED,
+                        PRIMARY KEY(message_id, creation_date),
+                        FOREIGN KEY(from_id) REFERENCES users(user_id) ON DELETE CASCADE,
+                        FOREIGN KEY(to_id) REFERENCES users(user_id) ON DELETE CASCADE
+                    ) PARTITION BY RANGE (creation_date);"""
+"""
+The partitioned messages table: one partition per calendar month, named
+messages_YYYY_MM, plus messages_default for dates no partition covers. The
+primary key of a partitioned table has to contain the partition key.
+"""
+
+CREATE_FUNCTION_CREATE_MESSAGE_PARTITIONS = """CREATE OR REPLACE FUNCTION create_message_partitions(
+                        first_month date, months_ahead int) RETURNS int
+                    LANGUAGE plpgsql AS $$
+                    DECLARE
+                        month_start date := date_trunc('month', first_month);
+                        last_month date := date_trunc('month', current_date) + make_interval(months => months_ahead);
+                        partition_name text;
+                        month_end date;
+                        columns text;
+                        stray boolean;
+                        created int := 0;
+                    BEGIN
+                        -- every stored column; generated ones are computed again
+                        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+                        FROM pg_attribute
+                        WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped
+                              AND attgenerated = '';
+
+                        WHILE month_start <= last_month LOOP
+                            partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+                            month_end := month_start + interval '1 month';
+                            IF to_regclass(partition_name) IS NULL THEN
+                                BEGIN
+                                    -- rows of the month that arrived before its partition would break the
+                                    -- new bound of the default one: move them over, addressing partitions
+                                    -- directly so that no trigger of messages fires
+                                    stray := EXISTS (SELECT 1 FROM messages_default
+                                                     WHERE creation_date >= month_start AND creation_date < month_end);
+                                    IF stray THEN
+                                        ALTER TABLE messages DETACH PARTITION messages_default;
+                                    END IF;
+                                    EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                                                   partition_name, month_start, month_end);
+                                    IF stray THEN
+                                        EXECUTE format('WITH moved AS (DELETE FROM messages_default
+                                                                       WHERE creation_date >= %L AND creation_date < %L
+                                                                       RETURNING %s)
+                                                        INSERT INTO %I (%s) SELECT %s FROM moved',
+                                                       month_start, month_end, columns,
+                                                       partition_name, columns, columns);
+                                        ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT;
+                                    END IF;
+                                    created := created + 1;
+                                EXCEPTION WHEN others THEN
+                                    -- undone up to the BEGIN above; the other months go on
+                                    RAISE WARNING 'partition % not created: %', partition_name, SQLERRM;
+                                END;
+                            END IF;
+                            month_start := month_end;
+                        END LOOP;
+                        RETURN created;
+                    END
+                    $$;"""
+"""
+create_message_partitions(first_month, months_ahead) creates the missing
+monthly partitions from first_month up to months_ahead months after the
+current one and returns how many it created. Rows of a month that arrived in
+messages_default before its partition existed are moved into the new
+partition, with messages locked meanwhile. A month that cannot be created is
+skipped with a warning, the others are still created.
+"""
+
+CREATE_TABLE_MESSAGE_BODIES = """CREATE TABLE IF NOT EXISTS message_bodies
+                    (
+                        message_id int,
+                        size int NOT NULL,
+                        compressed boolean NOT NULL,
+                        body bytea NOT NULL,
+                        PRIMARY KEY(message_id)
+                    );"""
+
+CREATE_TABLE_ATTACHMENTS = """CREATE TABLE IF NOT EXISTS attachments
+                    (
+                        attachment_id serial,
+                        message_id int NOT NULL,
+                        filename varchar(255) NOT NULL,
+                        size bigint NOT NULL DEFAULT 0,
+                        PRIMARY KEY(attachment_id)
+                    );"""
+
+CREATE_TABLE_ATTACHMENT_CHUNKS = """CREATE TABLE IF NOT EXISTS attachment_chunks
+                    (
+                        attachment_id int,
+                        chunk_no int,
+                        data bytea NOT NULL,
+                        PRIMARY KEY(attachment_id, chunk_no),
+                        FOREIGN KEY(attachment_id) REFERENCES attachments(attachment_id) ON DELETE CASCADE
+                    );"""
+"""
+The full text of messages longer than messages.text can hold, and files
+attached to messages, split into chunks of config.ATTACHMENT_CHUNK_SIZE
+bytes. A foreign key to the partitioned messages table would have to carry
+creation_date, so the messages_delete_content trigger removes them instead.
+"""
+
+CREATE_FUNCTION_MESSAGES_DELETE_CONTENT = """CREATE OR REPLACE FUNCTION messages_delete_content() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        DELETE FROM message_bodies WHERE message_id IN (SELECT message_id FROM deleted);
+                        DELETE FROM attachments WHERE message_id IN (SELECT message_id FROM deleted);
+                        RETURN NULL;
+                    END
+                    $$;"""
+
+CREATE_TABLE_GROUPS = """CREATE TABLE IF NOT EXISTS groups
+                    (
+                        group_id serial,
+                        name varchar(255) NOT NULL,
+                        owner_id int,
+                        creation_date timestamp DEFAULT current_timestamp,
+                        PRIMARY KEY(group_id),
+                        UNIQUE(name),
+                        FOREIGN KEY(owner_id) REFERENCES users(user_id) ON DELETE SET NULL
+                    );"""
+
+CREATE_TABLE_GROUP_MEMBERS = """CREATE TABLE IF NOT EXISTS group_members
+                    (
+                        group_id int,
+                        user_id int,
+                        joined_date timestamp NOT NULL DEFAULT current_timestamp,
+                        PRIMARY KEY(group_id, user_id),
+                        FOREIGN KEY(group_id) REFERENCES groups(group_id) ON DELETE CASCADE,
+                        FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+                    );"""
+"""
+Groups and their members. A message sent to a group is stored once, with
+messages.group_id set and no to_id, and reaches the members when they read:
+the inbox queries merge it in through group_members, from the date each
+member joined. A purged owner leaves the group without an owner instead of
+deleting it and, with it, every message sent to it in one statement.
+"""
+
+RECIPIENT_LOCK = 7263003
+GROUP_LOCK = 7263004
+LOCK_BUCKETS = 256
+ID_FLOOR_LOCK = 1 << 62
+"""
+RECIPIENT_LOCK and GROUP_LOCK are the first keys of the shared advisory
+locks an insert into messages holds until it commits, the second being the
+recipient's or group's bucket: hashint8 of its id modulo LOCK_BUCKETS, which
+bounds the locks a transaction sending to many users takes. ID_FLOOR_LOCK
+plus the lowest message id the transaction can get is the key of one more
+shared lock, taken with the first of them. See CREATE_FUNCTION_MESSAGE_GATE.
+"""
+
+CREATE_FUNCTION_MESSAGES_ASSIGN_ID = f"""CREATE OR REPLACE FUNCTION messages_assign_id() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        IF NEW.message_id IS NOT NULL THEN
+                            RETURN NEW;
+                        END IF;
+                        IF coalesce(current_setting('messenger.id_floor', true), '') = '' THEN
+                            PERFORM set_config('messenger.id_floor', next_id::text, true),
+                                    pg_advisory_xact_lock_shared({ID_FLOOR_LOCK} + next_id)
+                            FROM (SELECT last_value + is_called::int AS next_id FROM messages_message_id_seq) s;
+                        END IF;
+                        IF NEW.to_id IS NOT NULL THEN
+                            PERFORM pg_advisory_xact_lock_shared({RECIPIENT_LOCK},
+                                                                 hashint8(NEW.to_id) & {LOCK_BUCKETS - 1});
+                        END IF;
+                        IF NEW.group_id IS NOT NULL THEN
+                            PERFORM pg_advisory_xact_lock_shared({GROUP_LOCK},
+                                                                 hashint8(NEW.group_id) & {LOCK_BUCKETS - 1});
+                        END IF;
+                        NEW.message_id := nextval('messages_message_id_seq');
+                        RETURN NEW;
+                    END
+                    $$;"""
+"""
+The row level trigger function that hands out message ids: it locks the
+recipient's bucket before drawing the id, and the first message of a
+transaction also publishes the lowest id the transaction can get. Rows that
+come with an id (moved between partitions or shards) are left alone.
+"""
+
+CREATE_TRIGGER_MESSAGES_ASSIGN_ID = """CREATE TRIGGER messages_assign_id
+                    BEFORE INSERT ON messages
+                    FOR EACH ROW EXECUTE FUNCTION messages_assign_id();"""
+
+CREATE_FUNCTION_MESSAGE_GATE = f"""CREATE OR REPLACE FUNCTION message_gate(reader bigint) RETURNS bigint
+                    LANGUAGE plpgsql AS $$
+                    DECLARE
+                        next_id bigint;
+                        lowest bigint;
+                    BEGIN
+                        -- first: an id below next_id was drawn after its insert locked its bucket
+                        SELECT last_value + is_called::int INTO next_id FROM messages_message_id_seq;
+                        WITH locks AS MATERIALIZED (
+                            SELECT pid, classid, objid, objsubid FROM pg_locks
+                            WHERE locktype = 'advisory'
+                              AND database = (SELECT oid FROM pg_database WHERE datname = current_database()))
+                        SELECT min(((f.classid::bigint << 32) | f.objid::bigint) - {ID_FLOOR_LOCK}) INTO lowest
+                        FROM locks r
+                        JOIN locks f ON f.pid = r.pid AND f.objsubid = 1 AND f.classid >= {ID_FLOOR_LOCK >> 32}
+                        WHERE r.objsubid = 2
+                          AND (r.classid = {RECIPIENT_LOCK} AND r.objid = (hashint8(reader) & {LOCK_BUCKETS - 1})::oid
+                               OR r.classid = {GROUP_LOCK}
+                                  AND r.objid IN (SELECT (hashint8(group_id) & {LOCK_BUCKETS - 1})::oid
+                                                  FROM group_members WHERE user_id = reader));
+                        RETURN least(next_id, lowest);
+                    END
+                    $$;"""
+"""
+message_gate(reader) returns the id below which no message to `reader`, or
+to their groups, can commit any more: the next id of the sequence, or the
+lowest id an insert still running into one of their buckets can get. Every
+id below it belongs to a transaction that has ended, so a statement started
+after message_gate returned sees all of them that committed. Ids are handed
+out before the insert commits, so without the gate a read mark could pass a
+message that commits later. Only a slow insert into the reader's buckets
+holds their messages back, and only those it could have overtaken. Reading
+the sequence only works while it hands out uncached ids (CACHE 1, the
+default).
+"""
+
+MIGRATION_LOCK = 7263001
+"""
+MIGRATION_LOCK is the key of the advisory lock held while migrations run, so
+two concurrent upgrades of the same database cannot interleave.
+"""
+
+
+Migration = namedtuple("Migration", "version description statements transactional")
+"""
+A numbered schema change.
+
+Transactional migrations run all their statements in one transaction.
+Migrations that build indexes CONCURRENTLY cannot run inside a transaction,
+so they run statement by statement in autocommit mode instead; each of them
+first drops the index it builds, so a run interrupted halfway (which leaves
+an INVALID index behind) can simply be retried.
+
+A statement can also be a function taking the migration's cursor and
+yielding the statements to run, for those that depend on what is in the
+database, like partitioned_index.
+"""
+
+
+def partitioned_index(name, definition, table="messages"):
+    """Build an index of a partitioned table without blocking writes to it.
+
+        CREATE INDEX CONCURRENTLY is not available for partitioned tables,
+        and a plain CREATE INDEX locks out inserts until every partition is
+        indexed. Instead, the index is created invalid ON ONLY the parent,
+        then built CONCURRENTLY on each partition and attached to it; the
+        parent index turns valid once every partition has one. Partitions
+        created meanwhile get theirs from the parent. Partitions whose index
+        is attached already are skipped, so an interrupted run can be
+        retried. For non-transactional migrations only.
+
+        Args:
+            name (str): The name of the index, starting with `table`.
+            definition (str): The column list of the index and its WHERE clause, if any.
+            table (str, optional): The partitioned table. Defaults to "messages".
+
+        Returns:
+            function: The migration statement, see Migration.
+        """
+    def statements(cursor):
+        yield f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}"
+        cursor.execute("""SELECT c.relname FROM pg_inherits p JOIN pg_class c ON c.oid = p.inhrelid
+                          WHERE p.inhparent = %s::regclass
+                            AND NOT EXISTS (SELECT 1 FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+                                            WHERE i.inhparent = %s::regclass AND x.indrelid = c.oid)
+                          ORDER BY c.relname""", (table, name))
+        for (partition,) in cursor.fetchall():
+            index = partition + name[len(table):]
+            yield f"DROP INDEX CONCURRENTLY IF EXISTS {index}"
+            yield f"CREATE INDEX CONCURRENTLY {index} ON {partition} {definition}"
+            yield f"ALTER INDEX {name} ATTACH PARTITION {index}"
+
+    return statements
+
+
+MIGRATIONS = [
+    Migration(1, "create users and messages tables",
+              [CREATE_TABLE_USERS, CREATE_TABLE_MESSAGES], True),
+    Migration(2, "index messages by recipient and date",
+              ["DROP INDEX CONCURRENTLY IF EXISTS messages_to_id_creation_date_idx",
+               """CREATE INDEX CONCURRENTLY messages_to_id_creation_date_idx
+                  ON messages(to_id, creation_date, message_id)"""], False),
+    Migration(3, "index messages by sender",
+              ["DROP INDEX CONCURRENTLY IF EXISTS messages_from_id_idx",
+               "CREATE INDEX CONCURRENTLY messages_from_id_idx ON messages(from_id)"], False),
+    Migration(4, "unique usernames",
+              ["DROP INDEX CONCURRENTLY IF EXISTS users_username_key",
+               "CREATE UNIQUE INDEX CONCURRENTLY users_username_key ON users(username)"], False),
+    # a stored generated column (PostgreSQL 12+) is computed on every insert
+    # and update, so the text is never re-parsed at query time; adding it
+    # rewrites the table once. 'simple' lowercases without stemming, messages
+    # are written in any language. Message.search must use the same config.
+    Migration(5, "full-text search of messages",
+              ["""ALTER TABLE messages ADD COLUMN IF NOT EXISTS text_search tsvector
+                  GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED""",
+               "DROP INDEX CONCURRENTLY IF EXISTS messages_text_search_idx",
+               "CREATE INDEX CONCURRENTLY messages_text_search_idx ON messages USING gin(text_search)"], False),
+    Migration(6, "conversation summaries",
+              [CREATE_TABLE_CONVERSATIONS,
+               """CREATE INDEX conversations_user_id_last_date_idx
+                  ON conversations(user_id, last_date, last_message_id)""",
+               CREATE_FUNCTION_CONVERSATIONS_UPDATE,
+               CREATE_TRIGGER_CONVERSATIONS_UPDATE,
+               # the trigger is already in place and the lock it took keeps
+               # new messages out until the backfill commits, so none is
+               # missed or counted twice
+               CONVERSATIONS_UPSERT.format(source="messages")], True),
+    Migration(7, "index messages by conversation",
+              ["DROP INDEX CONCURRENTLY IF EXISTS messages_thread_idx",
+               """CREATE INDEX CONCURRENTLY messages_thread_idx
+                  ON messages(least(from_id, to_id), greatest(from_id, to_id), creation_date, message_id)"""],
+              False),
+    Migration(8, "read marks",
+              [CREATE_TABLE_READ_MARKS,
+               "DROP INDEX CONCURRENTLY IF EXISTS messages_to_id_message_id_idx",
+               "CREATE INDEX CONCURRENTLY messages_to_id_message_id_idx ON messages(to_id, message_id)"], False),
+    Migration(9, "notify recipients of new messages",
+              [CREATE_FUNCTION_MESSAGES_NOTIFY, CREATE_TRIGGER_MESSAGES_NOTIFY], True),
+    # rebuilds messages as a partitioned table in one transaction: every row
+    # is copied while the table is locked, plan downtime for a large table.
+    # The old table is dropped with its indexes and triggers, which are then
+    # created again on the partitioned one (CONCURRENTLY is not available
+    # for partitioned tables).
+    Migration(10, "partition messages by month",
+              ["ALTER TABLE messages RENAME TO messages_legacy",
+               "ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey",
+               CREATE_TABLE_MESSAGES_PARTITIONED,
+               "CREATE TABLE messages_default PARTITION OF messages DEFAULT",
+               CREATE_FUNCTION_CREATE_MESSAGE_PARTITIONS,
+               f"""SELECT create_message_partitions(
+                       coalesce((SELECT min(creation_date) FROM messages_legacy), current_date)::date,
+                       {config.PARTITION_MONTHS_AHEAD})""",
+               """INSERT INTO messages(message_id, from_id, to_id, creation_date, text)
+                  SELECT message_id, from_id, to_id, coalesce(creation_date, current_timestamp), text
+                  FROM messages_legacy""",
+               "ALTER SEQUENCE messages_message_id_seq OWNED BY messages.message_id",
+               "DROP TABLE messages_legacy",
+               "CREATE INDEX messages_to_id_creation_date_idx ON messages(to_id, creation_date, message_id)",
+               "CREATE INDEX messages_from_id_idx ON messages(from_id)",
+               "CREATE INDEX messages_text_search_idx ON messages USING gin(text_search)",
+               """CREATE INDEX messages_thread_idx
+                  ON messages(least(from_id, to_id), greatest(from_id, to_id), creation_date, message_id)""",
+               "CREATE INDEX messages_to_id_message_id_idx ON messages(to_id, message_id)",
+               CREATE_TRIGGER_CONVERSATIONS_UPDATE,
+               CREATE_TRIGGER_MESSAGES_NOTIFY], True),
+    # a nullable column without a default is added without rewriting users
+    Migration(11, "soft-deleted users",
+              ["ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at timestamp",
+               "DROP INDEX CONCURRENTLY IF EXISTS users_deleted_at_idx",
+               "CREATE INDEX CONCURRENTLY users_deleted_at_idx ON users(deleted_at) WHERE deleted_at IS NOT NULL"],
+              False),
+    Migration(12, "long message bodies and attachments",
+              [CREATE_TABLE_MESSAGE_BODIES,
+               # bodies worth compressing are compressed by the application
+               # already, TOAST should not try again
+               "ALTER TABLE message_bodies ALTER COLUMN body SET STORAGE EXTERNAL",
+               CREATE_TABLE_ATTACHMENTS,
+               "CREATE INDEX attachments_message_id_idx ON attachments(message_id)",
+               CREATE_TABLE_ATTACHMENT_CHUNKS,
+               CREATE_FUNCTION_MESSAGES_DELETE_CONTENT,
+               """CREATE TRIGGER messages_delete_content
+                  AFTER DELETE ON messages REFERENCING OLD TABLE AS deleted
+                  FOR EACH STATEMENT EXECUTE FUNCTION messages_delete_content()"""], True),
+    # the foreign key check of the new, all NULL group_id column reads
+    # messages once; the partial indexes stay as small as the group messages
+    Migration(13, "group messages",
+              [CREATE_TABLE_GROUPS,
+               CREATE_TABLE_GROUP_MEMBERS,
+               "CREATE INDEX group_members_user_id_idx ON group_members(user_id, group_id)",
+               "ALTER TABLE messages ADD COLUMN group_id int REFERENCES groups(group_id) ON DELETE CASCADE",
+               """CREATE INDEX messages_group_id_creation_date_idx ON messages(group_id, creation_date, message_id)
+                  WHERE group_id IS NOT NULL""",
+               """CREATE INDEX messages_group_id_message_id_idx ON messages(group_id, message_id)
+                  WHERE group_id IS NOT NULL""",
+               CREATE_FUNCTION_CONVERSATIONS_UPDATE,
+               CREATE_FUNCTION_MESSAGES_NOTIFY], True),
+    # ids unique across shards leave gaps (see shards.py) and outgrow int.
+    # Every changed column rewrites its table and rebuilds its indexes in
+    # this one transaction, with the tables locked: plan downtime, like for
+    # migration 10.
+    Migration(14, "64-bit ids",
+              ["ALTER TABLE users ALTER COLUMN user_id TYPE bigint",
+               "ALTER SEQUENCE users_user_id_seq AS bigint",
+               """ALTER TABLE messages ALTER COLUMN message_id TYPE bigint, ALTER COLUMN from_id TYPE bigint,
+                                       ALTER COLUMN to_id TYPE bigint, ALTER COLUMN group_id TYPE bigint""",
+               "ALTER SEQUENCE messages_message_id_seq AS bigint",
+               """ALTER TABLE conversations ALTER COLUMN user_id TYPE bigint, ALTER COLUMN counterpart_id TYPE bigint,
+                                            ALTER COLUMN last_message_id TYPE bigint""",
+               "ALTER TABLE read_marks ALTER COLUMN user_id TYPE bigint, ALTER COLUMN last_read_id TYPE bigint",
+               "ALTER TABLE message_bodies ALTER COLUMN message_id TYPE bigint",
+               "ALTER TABLE attachments ALTER COLUMN attachment_id TYPE bigint, ALTER COLUMN message_id TYPE bigint",
+               "ALTER SEQUENCE attachments_attachment_id_seq AS bigint",
+               "ALTER TABLE attachment_chunks ALTER COLUMN attachment_id TYPE bigint",
+               "ALTER TABLE groups ALTER COLUMN group_id TYPE bigint, ALTER COLUMN owner_id TYPE bigint",
+               "ALTER SEQUENCE groups_group_id_seq AS bigint",
+               "ALTER TABLE group_members ALTER COLUMN group_id TYPE bigint, ALTER COLUMN user_id TYPE bigint"],
+              True),
+    # a shard keeps a remote copy of the users row of every sender living on
+    # another shard, for the foreign keys and the sender names of its
+    # messages; a NOT NULL column with a constant default is added without
+    # rewriting users
+    Migration(15, "remote copies of users",
+              ["ALTER TABLE users ADD COLUMN IF NOT EXISTS remote boolean NOT NULL DEFAULT false"], True),
+    # message ids are handed out before the insert commits, so they do not
+    # say in which order messages became visible; the id of the inserting
+    # transaction, compared with the oldest one still running, does (until
+    # migration 19). PostgreSQL 13+. The existing rows and marks
+    # get 0 without a rewrite, which keeps their order, and only new rows
+    # call pg_current_xact_id(). The new indexes replace the (to_id,
+    # message_id) and (group_id, message_id) ones of the read marks; they are
+    # built partition by partition while messages are still being sent.
+    # Dropping the old ones locks messages briefly.
+    Migration(16, "commit order of messages",
+              ["ALTER TABLE messages ADD COLUMN IF NOT EXISTS xact_id xid8 NOT NULL DEFAULT '0'",
+               "ALTER TABLE messages ALTER COLUMN xact_id SET DEFAULT pg_current_xact_id()",
+               "ALTER TABLE read_marks ADD COLUMN IF NOT EXISTS last_read_xact_id xid8 NOT NULL DEFAULT '0'",
+               partitioned_index("messages_to_id_xact_id_idx", "(to_id, xact_id, message_id)"),
+               partitioned_index("messages_group_id_xact_id_idx", "(group_id, xact_id, message_id) "
+                                                                  "WHERE group_id IS NOT NULL"),
+               "DROP INDEX IF EXISTS messages_to_id_message_id_idx",
+               "DROP INDEX IF EXISTS messages_group_id_message_id_idx"], False),
+    # create_message_partitions used to fail, for every later month too, once
+    # messages_default held rows of a month it was asked to create
+    Migration(17, "move default partition rows into new partitions",
+              [CREATE_FUNCTION_CREATE_MESSAGE_PARTITIONS], True),
+    # migration 16 held every reader back while any transaction anywhere
+    # ran; message_gate only waits for the inserts into the reader's
+    # buckets, in message id order again, so the marks go back to ids.
+    Migration(18, "index messages by recipient and id",
+              [partitioned_index("messages_to_id_message_id_idx", "(to_id, message_id)"),
+               partitioned_index("messages_group_id_message_id_idx",
+                                 "(group_id, message_id) WHERE group_id IS NOT NULL")],
+              False),
+    # waits for the running inserts and holds new ones back until it
+    # commits. A mark becomes the id before the first message above it, or
+    # the last id handed out if there is none; messages read out of id order
+    # may show up as unread once more. Dropping xact_id drops its indexes.
+    Migration(19, "gate reads on running inserts",
+              ["LOCK TABLE messages IN SHARE MODE",
+               """UPDATE read_marks r SET last_read_id = coalesce(
+                      least((SELECT min(m.message_id) FROM messages m
+                             WHERE m.to_id = r.user_id
+                               AND (m.xact_id, m.message_id) > (r.last_read_xact_id, r.last_read_id)),
+                            (SELECT min(m.message_id) FROM group_members gm
+                             JOIN messages m ON m.group_id = gm.group_id AND m.creation_date >= gm.joined_date
+                                                AND m.from_id <> gm.user_id
+                             WHERE gm.user_id = r.user_id
+                               AND (m.xact_id, m.message_id) > (r.last_read_xact_id, r.last_read_id))) - 1,
+                      (SELECT last_value FROM messages_message_id_seq))""",
+               CREATE_FUNCTION_MESSAGES_ASSIGN_ID,
+               CREATE_TRIGGER_MESSAGES_ASSIGN_ID,
+               "ALTER TABLE messages ALTER COLUMN message_id DROP DEFAULT",
+               CREATE_FUNCTION_MESSAGE_GATE,
+               "ALTER TABLE messages DROP COLUMN xact_id",
+               "ALTER TABLE read_marks DROP COLUMN last_read_xact_id"], True),
+    # --since-last takes what it returns off the unread counts from now on
+    # (see Conversation.count_read); a conversation had at most its messages
+    # above the reader's mark unread. Holds back the inserts like 19.
+    Migration(20, "unread counts follow the read marks",
+              ["LOCK TABLE messages IN SHARE MODE",
+               """UPDATE conversations c SET unread_count = least(c.unread_count,
+                      (SELECT count(*) FROM messages m
+                       WHERE m.to_id = c.user_id AND m.from_id = c.counterpart_id AND m.message_id > r.last_read_id))
+                  FROM read_marks r
+                  WHERE r.user_id = c.user_id AND c.unread_count > 0"""], True),
+]
+
+
+def create_database():
+    """Create the messanger_db database if it does not exist yet.
+
+        Returns:
+            None
+        """
     try:
-        cursor.execute(CREATE_DATABASE)
-        print("NOTE: DATABASE CREATED")
-    except DuplicateDatabase as dd:
-        print("WARNING: DATABASE EXISTS", dd)
-    connection.close()
+        connection = connect(user=username, password=passwd, host=server)
+        connection.autocommit = True
+        cursor = connection.cursor()
+        try:
+            cursor.execute(CREATE_DATABASE)
+            print("NOTE: DATABASE CREATED")
+        except DuplicateDatabase as dd:
+            print("WARNING: DATABASE EXISTS", dd)
+        connection.close()
+
+    except OperationalError as oe:
+        print("WARNING: ERROR!", oe)
+
+
+def current_version(cursor):
+    """Get the version of the schema.
+
+        Creates the schema_version table on first use.
+
+        Args:
+            cursor: The cursor object used to execute the SQL statements.
 
-except OperationalError as oe:
-    print("WARNING: ERROR!", oe)
+        Returns:
+            int: The number of the last applied migration, 0 for an empty database.
+        """
+    cursor.execute(CREATE_TABLE_SCHEMA_VERSION)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
 
-try:
-    connection = connect(user=username, password=passwd, host=server, database='messanger_db')
+
+def apply_migration(connection, migration):
+    """Apply one migration and record it in schema_version.
+
+        Args:
+            connection: An autocommit connection to messanger_db.
+            migration (Migration): The migration to apply.
+
+        Returns:
+            None
+
+        Raises:
+            psycopg2.Error: If any statement of the migration fails.
+        """
+    record = "INSERT INTO schema_version(version, description) VALUES (%s, %s)"
+
+    if migration.transactional:
+        connection.autocommit = False
+        try:
+            with connection.cursor() as cursor:
+                for statement in _statements(cursor, migration):
+                    cursor.execute(statement)
+                cursor.execute(record, (migration.version, migration.description))
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        finally:
+            connection.autocommit = True
+    else:
+        with connection.cursor() as cursor:
+            for statement in _statements(cursor, migration):
+                cursor.execute(statement)
+            cursor.execute(record, (migration.version, migration.description))
+
+
+def _statements(cursor, migration):
+    """Yield the SQL statements of `migration`, expanding the functions among them (see Migration)."""
+    for statement in migration.statements:
+        if callable(statement):
+            yield from statement(cursor)
+        else:
+            yield statement
+
+
+def upgrade(connection, target=None):
+    """Apply all pending migrations up to `target`.
+
+        Args:
+            connection: A connection to messanger_db.
+            target (int, optional): The version to stop at. Defaults to the latest migration.
+
+        Returns:
+            int: The version of the schema after the upgrade.
+
+        Raises:
+            psycopg2.Error: If a migration fails. Migrations applied before it stay applied.
+        """
     connection.autocommit = True
     cursor = connection.cursor()
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK,))
     try:
-        cursor.execute(CREATE_TABLE_USERS)
-        print("NOTE: TABLE users CREATED")
-    except DuplicateTable as dt:
-        print("WARNING: TABLE EXISTS", dt)
+        version = current_version(cursor)
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            if target is not None and migration.version > target:
+                break
+            print(f"NOTE: APPLYING MIGRATION {migration.version}: {migration.description}")
+            apply_migration(connection, migration)
+            version = migration.version
+        return version
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+
+
+def create_partitions(cursor, first_month=None, months_ahead=config.PARTITION_MONTHS_AHEAD):
+    """Create the missing monthly partitions of messages.
+
+        Args:
+            cursor: The cursor object used to execute the SQL statements.
+            first_month (datetime.date, optional): The first month to create. Defaults to the current one.
+            months_ahead (int, optional): How many months after the current one to create.
+                Defaults to config.PARTITION_MONTHS_AHEAD.
+
+        Returns:
+            int: The number of partitions created.
+        """
+    cursor.execute("SELECT create_message_partitions(%s, %s)",
+                   (first_month or datetime.date.today(), months_ahead))
+    return cursor.fetchone()[0]
+
+
+def monthly_partitions(cursor):
+    """List the monthly partitions attached to messages.
+
+        Args:
+            cursor: The cursor object used to execute the SQL statement.
+
+        Returns:
+            list: (partition name, first day of its month) tuples, oldest first.
+        """
+    cursor.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                      WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname""")
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = re.fullmatch(r"messages_(\d{4})_(\d{2})", name)
+        if match:
+            partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return partitions
+
+
+def archive_partitions(connection, before, directory=config.ARCHIVE_DIR):
+    """Archive and drop the monthly partitions of messages that end before a date.
+
+        Each partition is first written to DIRECTORY/messages_YYYY_MM.csv.gz,
+        with the long bodies and the attachments of its messages in
+        messages_YYYY_MM.bodies.csv.gz and messages_YYYY_MM.attachments.csv.gz
+        (CSVs with a header line, which COPY ... FROM can load again). Then
+        the bodies and attachments are deleted and the partition is detached
+        and dropped, in one transaction. Dropping a partition frees
+        its month at once, without the DELETE, the dead rows and the vacuum
+        of removing the same rows from one big table.
+
+        Args:
+            connection: An autocommit connection to messanger_db.
+            before (datetime.date): Partitions whose month ends on or before this date are archived.
+            directory (str, optional): Where to write the archives. Defaults to config.ARCHIVE_DIR.
+
+        Returns:
+            list: The names of the archived partitions.
+
+        Raises:
+            psycopg2.Error: If a partition cannot be copied, detached or dropped. Partitions
+                archived before it stay archived.
+        """
+    os.makedirs(directory, exist_ok=True)
+    cursor = connection.cursor()
+    archived = []
+
+    for name, month in monthly_partitions(cursor):
+        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+        if next_month > before:
+            continue
+
+        exports = [
+            (f"{name}.csv.gz", f"SELECT message_id, from_id, to_id, creation_date, text, group_id FROM {name}"),
+            (f"{name}.bodies.csv.gz", f"""SELECT b.message_id, b.size, b.compressed, b.body
+                                         FROM message_bodies b JOIN {name} m USING (message_id)"""),
+            (f"{name}.attachments.csv.gz", f"""SELECT a.attachment_id, a.message_id, a.filename, a.size,
+                                                     c.chunk_no, c.data
+                                              FROM attachments a JOIN {name} m USING (message_id)
+                                              JOIN attachment_chunks c USING (attachment_id)
+                                              ORDER BY a.attachment_id, c.chunk_no"""),
+        ]
+        for filename, query in exports:
+            path = os.path.join(directory, filename)
+            with gzip.open(path + ".part", "wb") as archive:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+            os.replace(path + ".part", path)
+
+        connection.autocommit = False
+        try:
+            # dropping a partition fires no delete trigger
+            cursor.execute(f"DELETE FROM message_bodies WHERE message_id IN (SELECT message_id FROM {name})")
+            cursor.execute(f"DELETE FROM attachments WHERE message_id IN (SELECT message_id FROM {name})")
+            cursor.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        finally:
+            connection.autocommit = True
+        print(f"NOTE: ARCHIVED {name} TO {directory}")
+        archived.append(name)
+
+    return archived
+
+
+parser = argparse.ArgumentParser(description="Create and migrate the messanger_db database.")
+parser.add_argument('command', nargs='?', default='init',
+                    choices=['init', 'upgrade', 'version', 'maintain', 'archive'],
+                    help="init: create the database and apply all migrations (default), "
+                         "upgrade: apply pending migrations, "
+                         "version: print the current schema version, "
+                         "maintain: create the upcoming monthly partitions of messages (run it from cron), "
+                         "archive: write the partitions older than --before to compressed files and drop them")
+parser.add_argument('--to', help='upgrade only up to this migration number', type=int)
+parser.add_argument('--before', help='archive: the months ending on or before this date (YYYY-MM-DD)',
+                    type=datetime.date.fromisoformat)
+parser.add_argument('--dir', help=f'archive: where to write the archives (default {config.ARCHIVE_DIR})',
+                    default=config.ARCHIVE_DIR)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if config.BACKEND == 'sqlite':
+        if args.command in ('maintain', 'archive'):
+            print("WARNING: PARTITIONS NEED THE POSTGRESQL BACKEND")
+            sys.exit(1)
+        # the embedded database creates its schema whenever it is opened
+        storage.connect().close()
+        print(f"NOTE: SQLITE DATABASE READY AT {config.SQLITE_PATH}")
+        sys.exit()
+
+    if args.command == 'init':
+        create_database()
 
     try:
-        cursor.execute(CREATE_TABLE_MESSAGES)
-        print("NOTE: TABLE messages CREATED")
-    except DuplicateTable as dt:
-        print("WARNING: TABLE EXISTS", dt)
-    connection.close()
-except OperationalError as oe:
-    print("WARNING: ERROR", oe)
+        connection = connect(user=username, password=passwd, host=server, database=database)
+        connection.autocommit = True
+        cursor = connection.cursor()
+
+        if args.command == 'version':
+            print(f"NOTE: SCHEMA VERSION {current_version(cursor)} OF {MIGRATIONS[-1].version}")
+        elif args.command in ('maintain', 'archive'):
+            if current_version(cursor) < 10:
+                print("WARNING: MESSAGES ARE NOT PARTITIONED YET, RUN upgrade FIRST")
+            elif args.command == 'maintain':
+                print(f"NOTE: CREATED {create_partitions(cursor)} PARTITIONS")
+            elif args.before is None:
+                print("WARNING: archive NEEDS --before")
+            else:
+                try:
+                    archived = archive_partitions(connection, args.before, args.dir)
+                    print(f"NOTE: ARCHIVED {len(archived)} PARTITIONS")
+                except (Error, OSError) as err:
+                    print("WARNING: ARCHIVING FAILED", err)
+        else:
+            try:
+                version = upgrade(connection, args.to)
+                print(f"NOTE: SCHEMA AT VERSION {version}")
+                if version >= 10:
+                    print(f"NOTE: CREATED {create_partitions(cursor)} PARTITIONS")
+            except Error as err:
+                print("WARNING: MIGRATION FAILED", err)
+        connection.close()
+    except OperationalError as oe:
+        print("WARNING: ERROR", oe)
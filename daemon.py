@@ -0,0 +1,358 @@
+"""
+Long-lived local daemon that runs mess_app and user_app commands on pooled
+database connections.
+
+Start it with:
+    python daemon.py [--socket PATH] [--min N] [--max N]
+
+While it is running, both CLIs forward their command line to it over a
+Unix-domain socket instead of opening a new connection per invocation; the
+daemon runs the same command code on a connection from its
+ThreadedConnectionPool and streams the printed output back. When no daemon
+is listening, the CLIs fall back to a direct connection.
+
+Protocol: the client sends one JSON line {"app": ..., "argv": [...]} and
+reads UTF-8 text until the daemon closes the connection.
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+
+import config
+
+
+APPS = ("mess_app", "user_app")
+"""
+APPS are the modules whose `parser` and `run(cursor, args)` the daemon serves.
+"""
+
+
+def forward(app, argv, path=None):
+    """Run a CLI command through the daemon, if one is listening.
+
+        Args:
+            app (str): The name of the CLI module, one of APPS.
+            argv (list): The command line arguments of the command.
+            path (str, optional): The socket path. Defaults to config.DAEMON_SOCKET.
+
+        Returns:
+            bool: True if the daemon ran the command, False if no daemon is
+            running and the caller should connect to the database itself.
+        """
+    path = path or config.DAEMON_SOCKET
+    # the daemon pools PostgreSQL connections; an embedded SQLite database
+    # is opened directly by every process, and so are the shards, as the
+    # command connects to the shard of its user
+    if not config.USE_DAEMON or config.BACKEND != "postgres" or config.SHARD_DSNS:
+        return False
+
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            print(f"Ignoring {path}: the socket is not yours, connecting directly")
+            return False
+    except OSError:
+        return False
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return False
+
+    with client:
+        # the socket may have been replaced since the stat: the command line
+        # carries the password, only send it to a daemon of this user
+        if peer_uid(client) not in (None, os.getuid()):
+            print(f"Ignoring {path}: the daemon is not yours, connecting directly")
+            return False
+        request = json.dumps({"app": app, "argv": list(argv)}) + "\n"
+        client.sendall(request.encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+
+        with client.makefile("r", encoding="utf-8") as response:
+            for line in response:
+                sys.stdout.write(line)
+        sys.stdout.flush()
+    return True
+
+
+def peer_uid(client):
+    """Get the user ID of the process at the other end of a connected Unix socket.
+
+        Args:
+            client (socket.socket): The connected socket.
+
+        Returns:
+            int or None: The user ID, None where SO_PEERCRED is not available.
+        """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
+
+
+def private_directory(path):
+    """Create the directory of the socket, accessible to this user only, or check an existing one.
+
+        An existing directory must be owned by this user (or root) and not be
+        writable by others, unless it is sticky like /tmp: nobody else may
+        replace the socket in it.
+
+        Args:
+            path (str): The socket path.
+
+        Returns:
+            bool: False if the directory is not safe to listen in.
+        """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid not in (os.getuid(), 0):
+        return False
+    return not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH) or bool(info.st_mode & stat.S_ISVTX)
+
+
+class ThreadLocalStdout:
+    """A sys.stdout replacement that writes to a per-thread stream.
+
+        The CLI commands report everything with print(). Installing this as
+        sys.stdout lets every handler thread send its command's output to its
+        own client, while threads that did not redirect keep writing to the
+        original stream.
+        """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def redirect(self, stream):
+        self._local.stream = stream
+
+    def reset(self):
+        self._local.stream = None
+
+    def _current(self):
+        return getattr(self._local, "stream", None) or self._default
+
+    def write(self, text):
+        return self._current().write(text)
+
+    def flush(self):
+        return self._current().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Runs one forwarded command on a pooled connection."""
+
+    def handle(self):
+        out = io.TextIOWrapper(self.wfile, encoding="utf-8", line_buffering=True)
+        sys.stdout.redirect(out)
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("app") not in APPS:
+                print(f"Unknown application: {request.get('app')}")
+                return
+
+            app = importlib.import_module(request["app"])
+            try:
+                args = app.parser.parse_args(request.get("argv", []))
+            except SystemExit:
+                # clients validate argv before forwarding it, so this only
+                # happens with hand-written requests
+                print("Invalid arguments")
+                return
+            self.server.run(app, args)
+        except Exception as err:
+            print("Error: ", err)
+        finally:
+            out.flush()
+            out.detach()
+            sys.stdout.reset()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server holding a pool of database connections."""
+
+    daemon_threads = True
+
+    def __init__(self, path, minconn, maxconn):
+        from psycopg2.pool import ThreadedConnectionPool
+        import db_operations
+
+        db_operations.PREPARE = config.PREPARED_STATEMENTS
+        if config.WRITE_BUFFER:
+            import write_buffer
+
+            db_operations.WRITER = write_buffer.BufferedMessageWriter()
+        self.path = path
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **config.connection_kwargs())
+        # more handlers than connections would make getconn() fail, so make
+        # the extra ones wait for a free connection instead
+        self.slots = threading.BoundedSemaphore(maxconn)
+        # created 0600 by bind: never reachable by other users, not even briefly
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, CommandHandler)
+        finally:
+            os.umask(umask)
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+        self.maintenance = None
+        self.maintain()
+
+    def run(self, app, args):
+        """Run a command of `app` on a connection borrowed from the pool.
+
+            Args:
+                app (module): mess_app or user_app.
+                args (argparse.Namespace): The parsed command line arguments.
+
+            Returns:
+                None
+            """
+        from psycopg2 import Error, InterfaceError, OperationalError
+        import replicas
+
+        with self.slots:
+            connection = self.pool.getconn()
+            broken = False
+            cursor = None
+            try:
+                connection.autocommit = True
+                # read-your-writes holds per user across their commands
+                cursor = replicas.route(connection.cursor(), args.username)
+                app.run(cursor, args)
+            except (InterfaceError, OperationalError) as err:
+                broken = True
+                print("Connection Error: ", err)
+            except Error as err:
+                connection.rollback()
+                print("Error: ", err)
+            finally:
+                # also gives back the replica connection a failed command borrowed
+                if cursor is not None:
+                    cursor.close()
+                self.pool.putconn(connection, close=broken or bool(connection.closed))
+
+    def maintain(self):
+        """Create the upcoming monthly partitions of messages, and schedule the next run.
+
+            Returns:
+                None
+            """
+        import create_db
+        from psycopg2 import Error
+
+        with self.slots:
+            connection = self.pool.getconn()
+            try:
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    if create_db.current_version(cursor) >= 10:
+                        create_db.create_partitions(cursor)
+            except Error as err:
+                print("Partition maintenance failed: ", err, file=sys.stderr)
+            finally:
+                self.pool.putconn(connection, close=bool(connection.closed))
+
+        self.maintenance = threading.Timer(config.PARTITION_MAINTENANCE_INTERVAL, self.maintain)
+        self.maintenance.daemon = True
+        self.maintenance.start()
+
+    def server_close(self):
+        import db_operations
+
+        if self.maintenance is not None:
+            self.maintenance.cancel()
+        super().server_close()
+        # no command arrives any more, write what is still queued
+        if db_operations.WRITER is not None:
+            db_operations.WRITER.close()
+            db_operations.WRITER = None
+        self.pool.closeall()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def remove_stale_socket(path):
+    """Remove a socket file left behind by a daemon that is no longer running.
+
+        Args:
+            path (str): The socket path.
+
+        Returns:
+            bool: False if another daemon is still listening on `path`, or the file belongs to another user.
+        """
+    if not os.path.lexists(path):
+        return True
+    if os.lstat(path).st_uid != os.getuid():
+        return False
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return False
+    except OSError:
+        os.unlink(path)
+        return True
+    finally:
+        probe.close()
+
+
+parser = argparse.ArgumentParser(description="Serve mess_app and user_app commands on pooled connections.")
+parser.add_argument('--socket', help=f'socket path (default {config.DAEMON_SOCKET})', default=config.DAEMON_SOCKET)
+parser.add_argument('--min', help='connections opened at start', type=int, default=config.POOL_MIN_CONNECTIONS)
+parser.add_argument('--max', help='maximum number of connections', type=int, default=config.POOL_MAX_CONNECTIONS)
+
+
+if __name__ == '__main__':
+    from psycopg2 import OperationalError
+
+    args = parser.parse_args()
+
+    if config.BACKEND != "postgres":
+        print(f"The daemon pools PostgreSQL connections, it is not needed with the {config.BACKEND} backend")
+        sys.exit(1)
+
+    if config.SHARD_DSNS:
+        print("The daemon pools the connections of one database, the CLIs connect to the shards themselves")
+        sys.exit(1)
+
+    if not private_directory(args.socket):
+        print(f"The directory of {args.socket} is not private to you, choose another --socket")
+        sys.exit(1)
+
+    if not remove_stale_socket(args.socket):
+        print(f"A daemon is already listening on {args.socket}, or the file belongs to another user")
+        sys.exit(1)
+
+    try:
+        server = Daemon(args.socket, args.min, args.max)
+    except OperationalError as opr_err:
+        print("Connection Error: ", opr_err)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,10 +1,212 @@
+import csv
+import re
+import select
+import time
+import uuid
+import weakref
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+import config
 import crypto
+import storage
 from psycopg2 import connect
 import psycopg2.errors
+import psycopg2.extras
+
+
+ITERSIZE = 2000
+"""
+ITERSIZE is the default number of rows a server-side cursor fetches from the
+database per network round trip when the iter_* loaders are consumed.
+"""
+
+PREPARE = False
+"""
+PREPARE makes the hot queries (user lookups, message insert and inbox page)
+run as server-side prepared statements: each is PREPAREd once per connection
+and EXECUTEd afterwards, so Postgres parses and plans it only once. Preparing
+costs an extra round trip, so only long-lived processes (the daemon, the
+interactive shell) switch it on. The sqlite backend ignores it: the sqlite3
+module already keeps its statements prepared.
+"""
+
+WRITER = None
+"""
+WRITER is the write_buffer.BufferedMessageWriter plain new messages are sent
+through instead of being inserted one transaction each, or None. Only
+long-lived processes set it (the daemon, with config.WRITE_BUFFER).
+"""
+
+SHARDS = None
+"""
+SHARDS is the shards.ShardSet of a sharded deployment, or None for a single
+database. shards.connect() sets it when config.SHARD_DSNS lists shards; the
+commands then run on the shard of their user and go through SHARDS for
+everything that involves other users' shards.
+"""
+
+FOLLOW_POLL_INTERVAL = 0.2
+"""
+FOLLOW_POLL_INTERVAL is the number of seconds between two checks for new
+messages of Message.follow on the sqlite backend, which has no LISTEN/NOTIFY.
+"""
+
+FOLLOW_BACKOFF_AFTER = 5
+FOLLOW_MAX_POLL_INTERVAL = 5.0
+"""
+While a committed message waits for a running insert, Message.follow on
+PostgreSQL checks again every FOLLOW_POLL_INTERVAL seconds, and after
+FOLLOW_BACKOFF_AFTER checks in vain doubles the interval up to
+FOLLOW_MAX_POLL_INTERVAL seconds. A notification still wakes it up at once.
+"""
+
+_prepared = weakref.WeakKeyDictionary()
+
+# sets the gate of the user given as parameter for the statements after it
+# (see _above_read_mark), which then compare with it through _BELOW_GATE
+_GATE = "SELECT set_config('messenger.message_gate', message_gate(%s)::text, false)"
+_BELOW_GATE = "m.message_id < current_setting('messenger.message_gate')::bigint"
+
+# the user given as parameter received the message m through a group
+_GROUP_MEMBER = """EXISTS (SELECT 1 FROM group_members gm
+                           WHERE gm.group_id = m.group_id AND gm.user_id=%s AND gm.joined_date <= m.creation_date)"""
+
+
+def execute(cursor, name, sql, values, setup=None):
+    """Execute one of the hot statements, prepared if PREPARE is on.
+
+        Args:
+            cursor: The cursor object used to execute the SQL statement.
+            name (str): A name identifying `sql`, used as the prepared statement name.
+            sql (str): The statement, with %s placeholders.
+            values (sequence): The parameters of the statement.
+            setup (tuple, optional): A PostgreSQL statement and its parameters, run
+                before `sql` in the same round trip, e.g. _GATE.
+
+        Returns:
+            None
+
+        Raises:
+            psycopg2.Error: If there is an error executing the SQL statement.
+        """
+    setup_sql, setup_values = (f"{setup[0]}; ", list(setup[1])) if setup else ("", [])
+    if not PREPARE or storage.dialect(cursor) != "postgres" or not getattr(cursor, "prepare", True):
+        cursor.execute(setup_sql + sql, [*setup_values, *values])
+        return
+
+    prepared = _prepared.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {_numbered_placeholders(sql)}")
+        prepared.add(name)
+    cursor.execute(f"{setup_sql}EXECUTE {name} ({', '.join(['%s'] * len(values))})", [*setup_values, *values])
+
+
+def _numbered_placeholders(sql):
+    """Turn the %s placeholders of `sql` into PREPARE's $1, $2, ..."""
+    numbers = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda match: f"${next(numbers)}", sql)
+
+
+def _fts5_query(terms):
+    """Quote every word of `terms`, so FTS5 ANDs them instead of parsing its query syntax."""
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in terms.split())
+
+
+def _in_list(cursor, column, values):
+    """Build a `column` IN `values` condition, as = ANY on PostgreSQL and as an IN list on SQLite.
+
+        Returns:
+            tuple: The SQL condition and its parameters.
+        """
+    values = list(values)
+    if storage.dialect(cursor) == "sqlite":
+        return f"{column} IN ({', '.join(['%s'] * len(values))})", values
+    return f"{column} = ANY(%s)", [values]
+
+
+@contextmanager
+def transaction(cursor):
+    """Run the statements executed on `cursor` inside one transaction.
+
+        If the connection is in autocommit mode, autocommit is switched off,
+        the transaction is committed when the block succeeds or rolled back if
+        it raises, and autocommit is restored. If the connection is already
+        managing transactions itself, the block just runs in the current one.
+
+        Args:
+            cursor: The cursor object whose connection is used.
+
+        Yields:
+            None
+        """
+    connection = cursor.connection
+    if not connection.autocommit:
+        yield
+        return
+
+    connection.autocommit = False
+    try:
+        yield
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.autocommit = True
+
+
+@contextmanager
+def server_side_cursor(cursor, itersize=ITERSIZE):
+    """Open a named (server-side) cursor on the connection of `cursor`.
+
+        Rows of a query executed on the returned cursor stay on the server and
+        are fetched in chunks of `itersize` while it is iterated, so the client
+        never holds more than one chunk in memory.
+
+        Named cursors only live inside a transaction, so if the connection is
+        in autocommit mode it is switched off for the lifetime of the cursor
+        and restored afterwards. SQLite cursors step through their result
+        lazily already, so on the sqlite backend this is a plain cursor. For a
+        replicas.RoutingCursor the stream is opened on the connection its
+        reads go to, usually a replica.
+
+        Args:
+            cursor: The cursor object whose connection is used.
+            itersize (int, optional): The number of rows fetched per round trip. Defaults to ITERSIZE.
+
+        Yields:
+            psycopg2 named cursor.
+        """
+    connection = cursor.read_connection() if hasattr(cursor, "read_connection") else cursor.connection
+    if storage.dialect(cursor) == "sqlite":
+        stream = connection.cursor()
+        try:
+            yield stream
+        finally:
+            stream.close()
+        return
+
+    autocommit = connection.autocommit
+    if autocommit:
+        connection.autocommit = False
+
+    stream = connection.cursor(name=f"stream_{uuid.uuid4().hex}")
+    stream.itersize = itersize
+    try:
+        yield stream
+    finally:
+        stream.close()
+        if autocommit:
+            connection.rollback()
+            connection.autocommit = True
 
 
 
 class User:
+    __slots__ = ("_id", "username", "_hashed_password")
+
     def __init__(self, username, password="", salt=None):
         """Initialize a User object.
 
@@ -23,6 +225,23 @@ class User:
         self.username = username
         self._hashed_password = crypto.hash_password(password, salt)
 
+    @classmethod
+    def from_row(cls, row):
+        """Build a User from a (user_id, username, hashed_password) row.
+
+            Unlike the constructor, this does not hash anything: the stored
+            hash is taken as it is, so loading users costs no salt generation
+            and no SHA-256 per row.
+
+            Args:
+                row (tuple): The user_id, username and hashed_password columns.
+
+            Returns:
+                User: The loaded user.
+            """
+        user = cls.__new__(cls)
+        user._id, user.username, user._hashed_password = row
+        return user
 
     @property
     def id(self):
@@ -68,7 +287,7 @@ class User:
             sql = """INSERT INTO users(username, hashed_password) 
                      VALUES (%s, %s) RETURNING user_id"""
             values = (self.username, self.hashed_password)
-            cursor.execute(sql, values)
+            execute(cursor, "user_insert", sql, values)
             self._id = cursor.fetchone()[0]
             return True
         else:
@@ -94,38 +313,60 @@ class User:
             """
         sql = """SELECT user_id, username, hashed_password
                  FROM users
-                 WHERE username=%s
+                 WHERE username=%s AND deleted_at IS NULL AND NOT remote
                     """
 
-        cursor.execute(sql, (username,))
+        execute(cursor, "user_by_username", sql, (username,))
         data = cursor.fetchone()
         if data:
-            id_, username, hashed_password = data
-            loaded_user = User(username)
-            loaded_user._id = id_
-            loaded_user._hashed_password = hashed_password
-            return loaded_user
+            return User.from_row(data)
         else:
             print("There is no user with this username !")
             return data
 
+    @staticmethod
+    def load_users_by_usernames(cursor, usernames):
+        """Load several users from the database in one query.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                usernames (iterable): The usernames of the users to load.
+
+            Returns:
+                dict: The loaded User objects by username. Usernames with no
+                user are missing from the dict.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        usernames = list(usernames)
+        if storage.dialect(cursor) == "sqlite":
+            # SQLite has no arrays, bind one placeholder per username instead
+            placeholders = ", ".join(["%s"] * len(usernames))
+            sql = f"""SELECT user_id, username, hashed_password
+                      FROM users
+                      WHERE username IN ({placeholders}) AND deleted_at IS NULL AND NOT remote"""
+            cursor.execute(sql, usernames)
+        else:
+            sql = """SELECT user_id, username, hashed_password
+                     FROM users
+                     WHERE username = ANY(%s) AND deleted_at IS NULL AND NOT remote"""
+            cursor.execute(sql, (usernames,))
+        return {data[1]: User.from_row(data) for data in cursor.fetchall()}
+
     @staticmethod
     def load_user_by_id(cursor, user_id):
 
         sql = """SELECT user_id, username, hashed_password
                  FROM users
-                 WHERE user_id=%s
+                 WHERE user_id=%s AND deleted_at IS NULL AND NOT remote
                """
 
-        cursor.execute(sql, (user_id,))
+        execute(cursor, "user_by_id", sql, (user_id,))
         data = cursor.fetchone()
 
         if data:
-            id_, username, hashed_password = data
-            loaded_user = User(username)
-            loaded_user._id = id_
-            loaded_user._hashed_password = hashed_password
-            return loaded_user
+            return User.from_row(data)
         else:
             print("There is no user with this id number ")
 
@@ -143,22 +384,109 @@ class User:
                 psycopg2.Error: If there is an error executing the SQL query.
             """
 
-        sql = """SELECT * FROM users"""
-        users = []
+        sql = """SELECT user_id, username, hashed_password FROM users WHERE deleted_at IS NULL AND NOT remote"""
         cursor.execute(sql)
+        return [User.from_row(user_data) for user_data in cursor.fetchall()]
 
-        for user_data in cursor.fetchall():
-            id_, username, hashed_password = user_data
-            loaded_user = User(username)
-            loaded_user._id = id_
-            loaded_user.username = username
-            loaded_user._hashed_password = hashed_password
-            users.append(loaded_user)
-        return users
+    @staticmethod
+    def iter_all_users(cursor, itersize=ITERSIZE):
+        """Lazily fetch all users from the database.
+
+            Works like load_all_users, but rows are streamed from a server-side
+            cursor, so the first user is available as soon as the first chunk
+            arrives and memory use does not grow with the table.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                itersize (int, optional): The number of rows fetched per round trip. Defaults to ITERSIZE.
+
+            Yields:
+                User: The users in the database, ordered by ID.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        sql = """SELECT user_id, username, hashed_password FROM users
+                 WHERE deleted_at IS NULL AND NOT remote ORDER BY user_id"""
+
+        with server_side_cursor(cursor, itersize) as stream:
+            stream.execute(sql)
+
+            for user_data in stream:
+                yield User.from_row(user_data)
+
+    @staticmethod
+    def copy_from_csv(cursor, csv_file):
+        """Bulk-insert users from CSV with COPY FROM STDIN.
+
+            Rows are copied into a temporary staging table and moved into users
+            with one INSERT, which skips usernames that are already taken
+            (including repeats within `csv_file`). Call it inside transaction().
+            The sqlite backend has no COPY and inserts the rows with executemany.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statements.
+                csv_file: A file-like object with username,hashed_password CSV rows.
+
+            Returns:
+                int: The number of users inserted.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statements.
+            """
+        if storage.dialect(cursor) == "sqlite":
+            cursor.executemany("""INSERT INTO users(username, hashed_password) VALUES (%s, %s)
+                                  ON CONFLICT (username) DO NOTHING""", csv.reader(csv_file))
+            return cursor.rowcount
+
+        cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS users_import
+                          (username varchar(255), hashed_password varchar(80))
+                          ON COMMIT DROP""")
+        cursor.copy_expert("COPY users_import(username, hashed_password) FROM STDIN WITH (FORMAT csv)", csv_file)
+        cursor.execute("""INSERT INTO users(username, hashed_password)
+                          SELECT username, hashed_password FROM users_import
+                          ON CONFLICT (username) DO NOTHING""")
+        inserted = cursor.rowcount
+        cursor.execute("TRUNCATE users_import")
+        return inserted
+
+    @staticmethod
+    def copy_to_csv(cursor, out):
+        """Stream all users as CSV with COPY TO STDOUT.
+
+            The rows go straight from the server to `out` without being turned
+            into User objects. Password hashes are not exported.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statement.
+                out: A writable file-like object.
+
+            Returns:
+                None
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statement.
+            """
+        if storage.dialect(cursor) == "sqlite":
+            writer = csv.writer(out)
+            writer.writerow(("user_id", "username"))
+            cursor.execute("""SELECT user_id, username FROM users
+                              WHERE deleted_at IS NULL AND NOT remote ORDER BY user_id""")
+            writer.writerows(cursor)
+            return
+
+        cursor.copy_expert("""COPY (SELECT user_id, username FROM users
+                                    WHERE deleted_at IS NULL AND NOT remote ORDER BY user_id)
+                              TO STDOUT WITH (FORMAT csv, HEADER)""", out)
 
     def delete_user(self, cursor, id):
         """Delete the user from the database.
 
+           The user is only marked as deleted: from then on they cannot log in,
+           receive messages or be listed, and the statement is a single row
+           update however many messages they have. Their messages and the user
+           row itself are removed later, in small batches, by purge().
+
            Args:
                cursor: The cursor object used to execute the SQL query.
 
@@ -168,25 +496,121 @@ class User:
            Raises:
                psycopg2.Error: If there is an error executing the SQL query.
            """
-        sql = """DELETE FROM users WHERE user_id=%s;"""
+        sql = """UPDATE users SET deleted_at=current_timestamp WHERE user_id=%s AND deleted_at IS NULL;"""
 
         try:
             cursor.execute(sql, (id,))
             self._id = -1
             return True
-        except psycopg2.Error as e:
+        except storage.DATABASE_ERRORS as e:
             print("Error deleting user:", e)
             return False
 
+    @staticmethod
+    def load_deleted_users(cursor):
+        """Load the users marked as deleted whose data has not been purged yet.
+
+            On a shard these include the remote copies of deleted users
+            living on other shards (see shards.ShardSet.propagate_deletions),
+            so purging them removes what they sent to the users of this shard.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+
+            Returns:
+                list: User objects, the longest deleted first.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        sql = """SELECT user_id, username, hashed_password FROM users
+                 WHERE deleted_at IS NOT NULL ORDER BY deleted_at"""
+        cursor.execute(sql)
+        return [User.from_row(data) for data in cursor.fetchall()]
+
+    def purge(self, cursor, batch_size=config.PURGE_BATCH_SIZE):
+        """Remove the messages of a user marked as deleted, then the user row.
+
+            Messages sent or received by the user are deleted `batch_size` at a
+            time, each batch in its own short transaction, so no lock is held
+            for long and the write-ahead log grows in small steps. The caller
+            can pause between batches, the generator resumes where it stopped.
+            The user row goes last; by then the ON DELETE CASCADE foreign keys
+            of messages have nothing left to do. The groups the user owned
+            pass to their oldest remaining member in the same transaction.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statements,
+                    on a connection in autocommit mode.
+                batch_size (int, optional): The number of messages deleted per statement.
+                    Defaults to config.PURGE_BATCH_SIZE.
+
+            Yields:
+                int: The number of messages deleted by each batch.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statements.
+            """
+        sql = """DELETE FROM messages
+                 WHERE (message_id, creation_date) IN (SELECT message_id, creation_date FROM messages
+                                                       WHERE from_id=%s OR to_id=%s
+                                                       LIMIT %s)"""
+        while True:
+            cursor.execute(sql, (self.id, self.id, batch_size))
+            if cursor.rowcount <= 0:
+                break
+            yield cursor.rowcount
+
+        sql = """UPDATE groups SET owner_id = (SELECT gm.user_id FROM group_members gm
+                                         JOIN users u ON u.user_id = gm.user_id
+                                         WHERE gm.group_id = groups.group_id AND u.deleted_at IS NULL
+                                         ORDER BY gm.joined_date, gm.user_id
+                                         LIMIT 1)
+                 WHERE owner_id=%s"""
+        with transaction(cursor):
+            cursor.execute(sql, (self.id,))
+            cursor.execute("DELETE FROM users WHERE user_id=%s AND deleted_at IS NOT NULL", (self.id,))
+
 
 class Message:
+    __slots__ = ("_id", "from_id", "to_id", "text", "_creation_date", "from_username", "to_username", "group_id")
 
-    def __init__(self, from_id, to_id, text):
+    def __init__(self, from_id, to_id, text, group_id=None):
         self._id = -1
         self.from_id = from_id
         self.to_id = to_id
         self.text = text
         self._creation_date = None
+        self.from_username = None
+        self.to_username = None
+        self.group_id = group_id
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a Message from a database row.
+
+            Args:
+                row (tuple): The message_id, from_id, to_id, text and
+                    creation_date columns, optionally followed by the sender
+                    and recipient usernames (@name for a group) and by the
+                    group_id.
+
+            Returns:
+                Message: The loaded message.
+            """
+        message = cls.__new__(cls)
+        message.group_id = None
+        if len(row) == 8:
+            (message._id, message.from_id, message.to_id, message.text, message._creation_date,
+             message.from_username, message.to_username, message.group_id) = row
+        elif len(row) == 7:
+            (message._id, message.from_id, message.to_id, message.text, message._creation_date,
+             message.from_username, message.to_username) = row
+        else:
+            message._id, message.from_id, message.to_id, message.text, message._creation_date = row
+            message.from_username = None
+            message.to_username = None
+        return message
 
     @property
     def id(self):
@@ -200,6 +624,8 @@ class Message:
     def save_to_db(self, cursor):
         """Save the message object to the database.
 
+            A message with a group_id is sent to the group and has no to_id.
+
             Args:
                 cursor: The cursor object used to execute the SQL statements.
 
@@ -210,12 +636,12 @@ class Message:
                 psycopg2.Error: If there is an error executing the SQL statements.
             """
         if self._id == -1:
-            sql = """INSERT INTO messages(from_id, to_id, text)
-                     VALUES (%s,%s,%s) 
+            sql = """INSERT INTO messages(from_id, to_id, text, group_id)
+                     VALUES (%s,%s,%s,%s) 
                      RETURNING message_id, creation_date;"""
 
-            values = (self.from_id, self.to_id, self.text)
-            cursor.execute(sql, values)
+            values = (self.from_id, self.to_id, self.text, self.group_id)
+            execute(cursor, "message_insert", sql, values)
             self._id, self._creation_date = cursor.fetchone()
             return True
         else:
@@ -225,13 +651,168 @@ class Message:
             cursor.execute(sql, values)
             return True
 
+    def save_body(self, cursor, body):
+        """Store the full text of a saved message that is too long for messages.text.
+
+            Bodies longer than config.BODY_COMPRESS_THRESHOLD bytes are stored
+            zlib-compressed when that makes them smaller.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statement.
+                body (str): The full text of the message.
+
+            Returns:
+                None
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statement.
+            """
+        data = body.encode("utf-8")
+        stored = data
+        if len(data) > config.BODY_COMPRESS_THRESHOLD:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                stored = compressed
+
+        sql = "INSERT INTO message_bodies(message_id, size, compressed, body) VALUES (%s, %s, %s, %s)"
+        cursor.execute(sql, (self.id, len(data), stored is not data, stored))
+
+    @staticmethod
+    def load_body(cursor, message_id):
+        """Load the full text of a message stored with save_body.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                message_id (int): The ID of the message.
+
+            Returns:
+                str or None: The full text, None if the whole message fits in messages.text.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        cursor.execute("SELECT compressed, body FROM message_bodies WHERE message_id=%s", (message_id,))
+        data = cursor.fetchone()
+        if not data:
+            return None
+        compressed, body = data
+        body = bytes(body)
+        return (zlib.decompress(body) if compressed else body).decode("utf-8")
+
     @staticmethod
-    def load_all_messages(cursor, user_id=None):
+    def load_message(cursor, message_id, user_id):
+        """Load one message sent or received by a user, directly or through a group.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                message_id (int): The ID of the message.
+                user_id (int): The ID of the sender or recipient.
+
+            Returns:
+                Message or None: The message with from_username and to_username
+                filled in, None if there is no such message of this user.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                         s.username, coalesce(r.username, '@' || g.name), m.group_id
+                  FROM messages m
+                  JOIN users s ON s.user_id = m.from_id
+                  LEFT JOIN users r ON r.user_id = m.to_id
+                  LEFT JOIN groups g ON g.group_id = m.group_id
+                  WHERE m.message_id=%s AND (m.from_id=%s OR m.to_id=%s OR {_GROUP_MEMBER})"""
+        cursor.execute(sql, (message_id, user_id, user_id, user_id))
+        data = cursor.fetchone()
+        return Message.from_row(data) if data else None
+
+    @staticmethod
+    def load_content_info(cursor, message_ids):
+        """Find which messages have a long body or attachments, without reading them.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                message_ids (iterable): The IDs of the messages.
+
+            Returns:
+                dict: For each message with content outside messages, a
+                (body size in bytes or None, list of Attachment objects) tuple.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        bodies, body_values = _in_list(cursor, "message_id", message_ids)
+        attachments, attachment_values = _in_list(cursor, "message_id", message_ids)
+        sql = f"""SELECT message_id, NULL, NULL, size FROM message_bodies WHERE {bodies}
+                  UNION ALL
+                  SELECT message_id, attachment_id, filename, size FROM attachments WHERE {attachments}
+                  ORDER BY 1, 2"""
+        cursor.execute(sql, body_values + attachment_values)
+
+        info = {}
+        for message_id, attachment_id, filename, size in cursor.fetchall():
+            body_size, files = info.setdefault(message_id, (None, []))
+            if attachment_id is None:
+                info[message_id] = (size, files)
+            else:
+                files.append(Attachment.from_row((attachment_id, message_id, filename, size)))
+        return info
+
+    @staticmethod
+    def save_many(cursor, messages, page_size=1000):
+        """Insert new messages into the database with multi-row INSERTs.
+
+            Sends `page_size` messages per statement instead of one round trip
+            per message, and sets the ID and creation date of every message.
+            Run it inside transaction() to insert all of them atomically. The
+            embedded sqlite backend has no round trips to save and inserts them
+            one by one.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statements.
+                messages (list): Unsaved Message objects.
+                page_size (int, optional): The number of messages per INSERT. Defaults to 1000.
+
+            Returns:
+                int: The number of messages inserted.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statements.
+            """
+        sql = """INSERT INTO messages(from_id, to_id, text, group_id)
+                 VALUES %s
+                 RETURNING message_id, creation_date"""
+
+        values = [(message.from_id, message.to_id, message.text, message.group_id) for message in messages]
+        if storage.dialect(cursor) == "sqlite":
+            saved = []
+            for value in values:
+                cursor.execute("""INSERT INTO messages(from_id, to_id, text, group_id) VALUES (%s, %s, %s, %s)
+                                  RETURNING message_id, creation_date""", value)
+                saved.append(cursor.fetchone())
+        else:
+            saved = psycopg2.extras.execute_values(cursor, sql, values, page_size=page_size, fetch=True)
+
+        for message, (id_, creation_date) in zip(messages, saved):
+            message._id = id_
+            message._creation_date = creation_date
+        return len(saved)
+
+    @staticmethod
+    def load_all_messages(cursor, user_id=None, since=None, until=None):
         """Load all messages from the database.
 
+           With a date range, PostgreSQL only reads the monthly partitions of
+           messages that overlap it.
+
            Args:
                cursor: The cursor object used to execute the SQL query.
                user_id (int, optional): The ID of the user to filter messages by recipient. Defaults to None.
+               since (datetime.datetime, optional): Load only messages created at or after this time.
+               until (datetime.datetime, optional): Load only messages created before this time.
 
            Returns:
                list: A list of Message objects representing all the messages in the database.
@@ -239,23 +820,922 @@ class Message:
            Raises:
                psycopg2.Error: If there is an error executing the SQL query.
            """
+        sql, values = Message._all_messages_query(user_id, since, until)
+        cursor.execute(sql, values)
+
+        return [Message.from_row(message) for message in cursor.fetchall()]
+
+    @staticmethod
+    def iter_all_messages(cursor, user_id=None, itersize=ITERSIZE, since=None, until=None):
+        """Lazily load all messages from the database.
+
+           Works like load_all_messages, but rows are streamed from a
+           server-side cursor instead of being fetched all at once.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int, optional): The ID of the user to filter messages by recipient. Defaults to None.
+               itersize (int, optional): The number of rows fetched per round trip. Defaults to ITERSIZE.
+               since (datetime.datetime, optional): Load only messages created at or after this time.
+               until (datetime.datetime, optional): Load only messages created before this time.
+
+           Yields:
+               Message: The messages in the database.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        sql, values = Message._all_messages_query(user_id, since, until)
+        with server_side_cursor(cursor, itersize) as stream:
+            stream.execute(sql, values)
+
+            for message in stream:
+                yield Message.from_row(message)
+
+    @staticmethod
+    def _all_messages_query(user_id, since, until):
+        """Build the query of load_all_messages and iter_all_messages, and its parameters."""
+        conditions = []
+        values = []
         if user_id:
-            sql = "SELECT message_id, from_id, to_id, text, creation_date FROM messages WHERE to_id=%s"
-            cursor.execute(sql, (user_id,))
+            conditions.append("to_id=%s")
+            values.append(user_id)
+        # plain comparisons of the partition key, so the planner can prune
+        if since is not None:
+            conditions.append("creation_date >= %s")
+            values.append(since)
+        if until is not None:
+            conditions.append("creation_date < %s")
+            values.append(until)
+
+        sql = "SELECT message_id, from_id, to_id, text, creation_date FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, values
+
+    @staticmethod
+    def iter_inbox(cursor, user_id, before=None, after=None, itersize=ITERSIZE):
+        """Lazily load every message received by a user, directly or through a group.
+
+           Returns the same rows as paging through load_inbox from the newest
+           message to the oldest, streamed from a server-side cursor.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of the recipient.
+               before (int, optional): Return only messages older than the message with this ID.
+               after (int, optional): Return only messages newer than the message with this ID.
+               itersize (int, optional): The number of rows fetched per round trip. Defaults to ITERSIZE.
+
+           Yields:
+               Message: The messages, newest first, with from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        keyset_values = []
+        keyset = ""
+        if before is not None:
+            keyset = """AND (m.creation_date, m.message_id) <
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            keyset_values.append(before)
+        elif after is not None:
+            keyset = """AND (m.creation_date, m.message_id) >
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            keyset_values.append(after)
+
+        received, values = Message._received_query(cursor, user_id, keyset, keyset_values,
+                                                   "m.creation_date DESC, m.message_id DESC", None)
+        sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                         s.username, coalesce(r.username, '@' || g.name), m.group_id
+                  FROM ({received}) m
+                  JOIN users s ON s.user_id = m.from_id
+                  LEFT JOIN users r ON r.user_id = m.to_id
+                  LEFT JOIN groups g ON g.group_id = m.group_id
+                  ORDER BY m.creation_date DESC, m.message_id DESC"""
+
+        with server_side_cursor(cursor, itersize) as stream:
+            stream.execute(sql, values)
+
+            for message in stream:
+                yield Message.from_row(message)
+
+    @staticmethod
+    def load_inbox(cursor, user_id, limit=20, before=None, after=None):
+        """Load one page of the messages received by a user, directly or through a group.
+
+           Sender and recipient usernames are resolved in the same query, and
+           pages are addressed by the (creation_date, message_id) of a known
+           message, so every page costs one index range scan for the direct
+           messages and one per group of the user, no matter how deep into
+           the inbox it is.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of the recipient.
+               limit (int, optional): The maximum number of messages to return. Defaults to 20.
+               before (int, optional): Return only messages older than the message with this ID.
+               after (int, optional): Return only messages newer than the message with this ID.
+
+           Returns:
+               list: Message objects ordered from the newest to the oldest, with
+               from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        keyset_values = []
+        keyset = ""
+        order = "DESC"
+        name = "inbox_first"
+
+        if before is not None:
+            name = "inbox_before"
+            keyset = """AND (m.creation_date, m.message_id) <
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            keyset_values.append(before)
+        elif after is not None:
+            keyset = """AND (m.creation_date, m.message_id) >
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            keyset_values.append(after)
+            order = "ASC"
+            name = "inbox_after"
+
+        received, values = Message._received_query(cursor, user_id, keyset, keyset_values,
+                                                   f"m.creation_date {order}, m.message_id {order}", limit)
+        sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                         s.username, coalesce(r.username, '@' || g.name), m.group_id
+                  FROM ({received}) m
+                  JOIN users s ON s.user_id = m.from_id
+                  LEFT JOIN users r ON r.user_id = m.to_id
+                  LEFT JOIN groups g ON g.group_id = m.group_id
+                  ORDER BY m.creation_date {order}, m.message_id {order}
+                  LIMIT %s"""
+        values.append(limit)
+        execute(cursor, name, sql, values)
+
+        messages = [Message.from_row(message) for message in cursor.fetchall()]
+
+        # pages fetched with `after` are read oldest first to hit the right
+        # end of the index, but are always shown newest first
+        if order == "ASC":
+            messages.reverse()
+        return messages
+
+    @staticmethod
+    def search(cursor, user_id, terms, limit=20, offset=0):
+        """Full-text search the messages a user sent or received, directly or through a group.
+
+           Matches the text_search column through its GIN index (an FTS5
+           index on the sqlite backend), so only matching messages are read.
+           All words of `terms` must occur; on PostgreSQL "quoted phrases",
+           OR and -word work as in a web search engine.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of the sender or recipient.
+               terms (str): The words to search for.
+               limit (int, optional): The maximum number of messages to return, None for all. Defaults to 20.
+               offset (int, optional): The number of best matches to skip. Defaults to 0.
+
+           Returns:
+               list: Message objects ordered from the best match to the worst,
+               with from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        if storage.dialect(cursor) == "sqlite":
+            sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                             s.username, coalesce(r.username, '@' || g.name), m.group_id
+                      FROM messages_fts
+                      JOIN messages m ON m.message_id = messages_fts.rowid
+                      JOIN users s ON s.user_id = m.from_id
+                      LEFT JOIN users r ON r.user_id = m.to_id
+                      LEFT JOIN groups g ON g.group_id = m.group_id
+                      WHERE messages_fts MATCH %s AND (m.from_id=%s OR m.to_id=%s OR {_GROUP_MEMBER})
+                      ORDER BY bm25(messages_fts), m.message_id DESC
+                      LIMIT %s OFFSET %s"""
+            values = (_fts5_query(terms), user_id, user_id, user_id, -1 if limit is None else limit, offset)
         else:
-            sql = "SELECT message_id, from_id, to_id, text, creation_date FROM messages"
-            cursor.execute(sql)
+            sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                             s.username, coalesce(r.username, '@' || g.name), m.group_id
+                      FROM websearch_to_tsquery('simple', %s) query
+                      JOIN messages m ON m.text_search @@ query
+                      JOIN users s ON s.user_id = m.from_id
+                      LEFT JOIN users r ON r.user_id = m.to_id
+                      LEFT JOIN groups g ON g.group_id = m.group_id
+                      WHERE m.from_id=%s OR m.to_id=%s OR {_GROUP_MEMBER}
+                      ORDER BY ts_rank(m.text_search, query) DESC, m.message_id DESC
+                      LIMIT %s OFFSET %s"""
+            values = (terms, user_id, user_id, user_id, limit, offset)
+        execute(cursor, "message_search", sql, values)
+
+        return [Message.from_row(message) for message in cursor.fetchall()]
+
+    @staticmethod
+    def load_thread(cursor, user_id, counterpart_id, limit=20, before=None, after=None):
+        """Load one page of the conversation between two users.
+
+           Messages in both directions are read from one range of the
+           messages_thread_idx index on (smaller id, larger id, creation_date,
+           message_id) and paged like load_inbox.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of one of the users.
+               counterpart_id (int): The ID of the other user.
+               limit (int, optional): The maximum number of messages to return. Defaults to 20.
+               before (int, optional): Return only messages older than the message with this ID.
+               after (int, optional): Return only messages newer than the message with this ID.
+
+           Returns:
+               list: Message objects ordered from the newest to the oldest, with
+               from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        least, greatest = ("min", "max") if storage.dialect(cursor) == "sqlite" else ("least", "greatest")
+        values = [min(user_id, counterpart_id), max(user_id, counterpart_id)]
+        keyset = ""
+        order = "DESC"
+        name = "thread_first"
+
+        if before is not None:
+            name = "thread_before"
+            keyset = """AND (m.creation_date, m.message_id) <
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            values.append(before)
+        elif after is not None:
+            keyset = """AND (m.creation_date, m.message_id) >
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            values.append(after)
+            order = "ASC"
+            name = "thread_after"
 
-        messages = []
+        sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                         s.username, r.username
+                  FROM messages m
+                  JOIN users s ON s.user_id = m.from_id
+                  JOIN users r ON r.user_id = m.to_id
+                  WHERE {least}(m.from_id, m.to_id)=%s AND {greatest}(m.from_id, m.to_id)=%s {keyset}
+                  ORDER BY m.creation_date {order}, m.message_id {order}
+                  LIMIT %s"""
+        values.append(limit)
+        execute(cursor, name, sql, values)
 
-        for message in cursor.fetchall():
-            id_, from_id, to_id, text, creation_date = message
-            loaded_message = Message(from_id, to_id, text)
-            loaded_message._id = id_
-            loaded_message._creation_date = creation_date
-            messages.append(loaded_message)
+        messages = [Message.from_row(message) for message in cursor.fetchall()]
+        if order == "ASC":
+            messages.reverse()
         return messages
 
+    @staticmethod
+    def load_unread(cursor, user_id, limit=None):
+        """Load the messages received by a user above their read mark, without moving it.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of the recipient.
+               limit (int, optional): The maximum number of messages to return, None for all.
+
+           Returns:
+               list: Message objects ordered from the oldest to the newest, with
+               from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        return Message._above_read_mark(cursor, user_id, limit)[0]
+
+    @staticmethod
+    def fetch_since_last(cursor, user_id, limit=None):
+        """Load the messages received by a user since the last call, and move the read mark past them.
+
+           The mark is moved with a compare-and-set on the value the messages
+           were read above, so two pollers running at once never both get the
+           same message: the one that loses the race reads again above the
+           winner's mark. The unread counts of the conversations the direct
+           messages belong to drop in the same transaction (see
+           Conversation.count_read). Message ids are handed out before the insert
+           commits, so only the messages below the gate of the running
+           inserts are returned (see _above_read_mark): one committing late
+           is returned by a later call, never skipped.
+
+           Args:
+               cursor: The cursor object used to execute the SQL statements.
+               user_id (int): The ID of the recipient.
+               limit (int, optional): The maximum number of messages to return, None for all.
+                   The mark only moves past the messages returned.
+
+           Returns:
+               list: Message objects ordered from the oldest to the newest, with
+               from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL statements.
+           """
+        sql = """INSERT INTO read_marks(user_id, last_read_id) VALUES (%s, %s)
+                 ON CONFLICT (user_id) DO UPDATE SET last_read_id = excluded.last_read_id
+                 WHERE read_marks.last_read_id = %s"""
+
+        while True:
+            messages, mark = Message._above_read_mark(cursor, user_id, limit)
+            if not messages:
+                return messages
+            with transaction(cursor):
+                execute(cursor, "read_mark_advance", sql, (user_id, messages[-1].id, mark))
+                if cursor.rowcount != 1:
+                    continue
+                Conversation.count_read(cursor, user_id, messages)
+            return messages
+
+    @staticmethod
+    def follow(cursor, user_id):
+        """Wait for the messages received by a user from now on, and yield them as they arrive.
+
+           LISTENs on the channel messages_<user_id> and on groups_<group_id>
+           for every group of the user when following starts, which the
+           messages_notify trigger notifies on every insert, and sleeps in
+           select() on the connection in between, so following costs no
+           queries while no message arrives. A notification only wakes the
+           loop up: the new messages are read with one range of the (to_id,
+           message_id) index and one of the (group_id, message_id) index per
+           group above the last one yielded, so notifications merged by
+           PostgreSQL lose nothing. Like the read marks (see
+           _above_read_mark), only the messages below the gate of the inserts
+           still running are yielded; while a committed message waits for
+           one, the loop also wakes up after a timeout, which grows while the
+           insert runs (see FOLLOW_BACKOFF_AFTER). SQLite has no notifications;
+           there the cheap data_version pragma is checked every
+           FOLLOW_POLL_INTERVAL seconds instead.
+
+           The connection has to be in autocommit mode, notifications are
+           delivered between transactions only.
+
+           Args:
+               cursor: The cursor object used to execute the SQL statements.
+               user_id (int): The ID of the recipient.
+
+           Yields:
+               Message: The new messages, oldest first, with from_username and to_username filled in.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL statements or the connection is lost.
+           """
+        connection = cursor.connection
+        sqlite = storage.dialect(cursor) == "sqlite"
+
+        # listen before looking up where to start, so nothing sent in between is missed
+        if not sqlite:
+            cursor.execute(f"LISTEN messages_{int(user_id)}")
+            cursor.execute("SELECT group_id FROM group_members WHERE user_id=%s", (user_id,))
+            for (group_id,) in cursor.fetchall():
+                cursor.execute(f"LISTEN groups_{int(group_id)}")
+            # every message below the gate has committed already
+            cursor.execute("SELECT message_gate(%s) - 1", (user_id,))
+        else:
+            received, values = Message._received_query(cursor, user_id, "", [], "m.message_id DESC", 1)
+            cursor.execute(f"SELECT coalesce(max(message_id), 0) FROM ({received}) m", values)
+        last_id = cursor.fetchone()[0]
+        version = None
+        polls = 0
+        poll_interval = FOLLOW_POLL_INTERVAL
+
+        while True:
+            if sqlite:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+                cursor.execute("PRAGMA data_version")
+                current = cursor.fetchone()[0]
+                if current == version:
+                    continue
+                version = current
+            else:
+                # the insert a message waits for may have been to another
+                # user of the bucket, whose commit notifies nobody here
+                select.select([connection], [], [], poll_interval if polls else None)
+                connection.poll()
+                if not connection.notifies and not polls:
+                    continue
+                connection.notifies.clear()
+
+            received, values = Message._received_query(cursor, user_id, "AND m.message_id > %s", [last_id],
+                                                       "m.message_id", None)
+            sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                             s.username, coalesce(r.username, '@' || g.name), m.group_id,
+                             {"1" if sqlite else _BELOW_GATE}
+                      FROM ({received}) m
+                      JOIN users s ON s.user_id = m.from_id
+                      LEFT JOIN users r ON r.user_id = m.to_id
+                      LEFT JOIN groups g ON g.group_id = m.group_id
+                      ORDER BY m.message_id"""
+            execute(cursor, "messages_after", sql, values, None if sqlite else (_GATE, [user_id]))
+
+            rows = cursor.fetchall()
+            # the messages below the gate sort first
+            held = next((number for number, row in enumerate(rows) if not row[8]), None)
+            for row in rows[:held]:
+                last_id = row[0]
+                yield Message.from_row(row[:8])
+
+            if held != 0:
+                polls, poll_interval = 0, FOLLOW_POLL_INTERVAL
+            if held is not None:
+                polls += 1
+                if polls > FOLLOW_BACKOFF_AFTER:
+                    poll_interval = min(poll_interval * 2, FOLLOW_MAX_POLL_INTERVAL)
+
+    @staticmethod
+    def _above_read_mark(cursor, user_id, limit):
+        """Load the messages above the read mark of a user, with the mark itself.
+
+           Message ids are handed out before the insert commits, so a slow
+           insert can still commit a message below the highest id already
+           visible. Only the messages below the user's gate are loaded: _GATE
+           runs message_gate (see create_db.py) first, in the same round
+           trip, and only an insert still running into one of the user's lock
+           buckets holds back the messages from the lowest id it can get. The
+           embedded sqlite backend has one writer at a time and needs no gate.
+
+           The mark and the messages come from one statement: a primary key
+           lookup in read_marks, a range of the (to_id, message_id) index and
+           one of the (group_id, message_id) index per group of the user, so a
+           poll without new messages reads a few index pages and returns no
+           rows. Message ids are global, so one mark covers the direct and the
+           group messages.
+
+           Returns:
+               tuple: The list of messages, oldest first, and the read mark
+               (None if there are no messages).
+           """
+        mark = "(SELECT coalesce(max(last_read_id), 0) FROM read_marks WHERE user_id=%s)"
+        condition = f"AND m.message_id > {mark}"
+        setup = None
+        if storage.dialect(cursor) != "sqlite":
+            condition += f" AND {_BELOW_GATE}"
+            setup = (_GATE, [user_id])
+        received, values = Message._received_query(cursor, user_id, condition, [user_id], "m.message_id", limit)
+        sql = f"""SELECT m.message_id, m.from_id, m.to_id, m.text, m.creation_date,
+                         s.username, coalesce(r.username, '@' || g.name), m.group_id, {mark}
+                  FROM ({received}) m
+                  JOIN users s ON s.user_id = m.from_id
+                  LEFT JOIN users r ON r.user_id = m.to_id
+                  LEFT JOIN groups g ON g.group_id = m.group_id
+                  ORDER BY m.message_id
+                  LIMIT %s"""
+        if limit is None and storage.dialect(cursor) == "sqlite":
+            limit = -1
+        execute(cursor, "above_read_mark", sql, [user_id, *values, limit], setup)
+
+        rows = cursor.fetchall()
+        mark = rows[0][8] if rows else None
+        return [Message.from_row(row[:8]) for row in rows], mark
+
+    @staticmethod
+    def _received_query(cursor, user_id, condition, values, order_by, limit):
+        """Build the query of the messages received by a user, directly or through a group, and its parameters.
+
+           The direct messages are one range of a to_id index. The group
+           messages are one range of a group_id index per group of the user,
+           starting at the date they joined, without the ones they sent. Each
+           range stops after `limit` rows in `order_by` order before they are
+           merged, so a page does not read every message a busy group holds;
+           PostgreSQL reads the group ranges with a LATERAL join, SQLite,
+           which has none, limits them together.
+
+           Args:
+               cursor: The cursor object the query is built for.
+               user_id (int): The ID of the recipient.
+               condition (str): More conditions on the messages m, starting with AND, or "".
+               values (list): The parameters of `condition`.
+               order_by (str): The ORDER BY list, on the columns of m.
+               limit (int): The maximum number of rows per range, None for all.
+
+           Returns:
+               tuple: The SQL of an unordered query of the message_id, from_id,
+               to_id, text, creation_date and group_id columns, and its parameters.
+           """
+        columns = "m.message_id, m.from_id, m.to_id, m.text, m.creation_date, m.group_id"
+        if limit is None and storage.dialect(cursor) == "sqlite":
+            limit = -1
+
+        direct = f"""SELECT {columns}
+                     FROM messages m
+                     WHERE m.to_id=%s {condition}
+                     ORDER BY {order_by}
+                     LIMIT %s"""
+        direct_values = [user_id, *values, limit]
+
+        if storage.dialect(cursor) == "sqlite":
+            grouped = f"""SELECT {columns}
+                          FROM group_members gm
+                          JOIN messages m ON m.group_id = gm.group_id
+                          WHERE gm.user_id=%s AND m.creation_date >= gm.joined_date AND m.from_id <> gm.user_id
+                                {condition}
+                          ORDER BY {order_by}
+                          LIMIT %s"""
+            grouped_values = [user_id, *values, limit]
+        else:
+            grouped = f"""SELECT m.*
+                          FROM group_members gm
+                          CROSS JOIN LATERAL (SELECT {columns}
+                                              FROM messages m
+                                              WHERE m.group_id = gm.group_id AND m.creation_date >= gm.joined_date
+                                                    AND m.from_id <> gm.user_id {condition}
+                                              ORDER BY {order_by}
+                                              LIMIT %s) m
+                          WHERE gm.user_id=%s"""
+            grouped_values = [*values, limit, user_id]
+
+        sql = f"""SELECT * FROM ({direct}) direct
+                  UNION ALL
+                  SELECT * FROM ({grouped}) grouped"""
+        return sql, direct_values + grouped_values
+
+
+class Attachment:
+    __slots__ = ("_id", "message_id", "filename", "size")
+
+    @classmethod
+    def from_row(cls, row):
+        """Build an Attachment from a database row.
+
+            Args:
+                row (tuple): The attachment_id, message_id, filename and size columns.
+
+            Returns:
+                Attachment: The loaded attachment.
+            """
+        attachment = cls.__new__(cls)
+        attachment._id, attachment.message_id, attachment.filename, attachment.size = row
+        return attachment
+
+    @property
+    def id(self):
+        """Get the ID of the attachment.
+
+            Returns:
+            int: The ID of the attachment.
+        """
+        return self._id
+
+    @staticmethod
+    def save(cursor, message_id, filename, file, chunk_size=config.ATTACHMENT_CHUNK_SIZE):
+        """Store the content of a binary file as an attachment of a saved message.
+
+            The file is read into one reused buffer of `chunk_size` bytes and
+            every chunk is inserted as its own attachment_chunks row, so memory
+            use does not depend on the size of the file. Run it inside
+            transaction(), together with saving the message.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statements.
+                message_id (int): The ID of the message.
+                filename (str): The name the attachment is saved under.
+                file: A binary file object supporting readinto().
+                chunk_size (int, optional): The number of bytes per chunk. Defaults to config.ATTACHMENT_CHUNK_SIZE.
+
+            Returns:
+                Attachment: The saved attachment.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statements.
+            """
+        cursor.execute("""INSERT INTO attachments(message_id, filename) VALUES (%s, %s)
+                          RETURNING attachment_id""", (message_id, filename))
+        attachment_id = cursor.fetchone()[0]
+
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        size = 0
+        chunk_no = 0
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            cursor.execute("INSERT INTO attachment_chunks(attachment_id, chunk_no, data) VALUES (%s, %s, %s)",
+                           (attachment_id, chunk_no, view[:length]))
+            size += length
+            chunk_no += 1
+
+        cursor.execute("UPDATE attachments SET size=%s WHERE attachment_id=%s", (size, attachment_id))
+        return Attachment.from_row((attachment_id, message_id, filename, size))
+
+    @staticmethod
+    def load(cursor, attachment_id, user_id):
+        """Load the metadata of an attachment of a message sent or received by a user, directly or through a group.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                attachment_id (int): The ID of the attachment.
+                user_id (int): The ID of the sender or recipient.
+
+            Returns:
+                Attachment or None: The attachment, None if there is no such attachment of this user.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        sql = f"""SELECT a.attachment_id, a.message_id, a.filename, a.size
+                  FROM attachments a
+                  WHERE a.attachment_id=%s
+                    AND EXISTS (SELECT 1 FROM messages m
+                                WHERE m.message_id = a.message_id
+                                  AND (m.from_id=%s OR m.to_id=%s OR {_GROUP_MEMBER}))"""
+        cursor.execute(sql, (attachment_id, user_id, user_id, user_id))
+        data = cursor.fetchone()
+        return Attachment.from_row(data) if data else None
+
+    def write_to(self, cursor, out, itersize=4):
+        """Stream the content of the attachment into a binary file.
+
+            Chunks come from a server-side cursor `itersize` at a time, so at
+            most that many chunks are in memory.
+
+            Args:
+                cursor: The cursor object whose connection is used.
+                out: A binary file object.
+                itersize (int, optional): The number of chunks fetched per round trip. Defaults to 4.
+
+            Returns:
+                int: The number of bytes written.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        written = 0
+        with server_side_cursor(cursor, itersize) as stream:
+            stream.execute("SELECT data FROM attachment_chunks WHERE attachment_id=%s ORDER BY chunk_no", (self.id,))
+            for (data,) in stream:
+                written += out.write(data)
+        return written
+
+
+class Group:
+    __slots__ = ("_id", "name", "owner_id")
+
+    def __init__(self, name, owner_id):
+        self._id = -1
+        self.name = name
+        self.owner_id = owner_id
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a Group from a database row.
+
+            Args:
+                row (tuple): The group_id, name and owner_id columns.
+
+            Returns:
+                Group: The loaded group.
+            """
+        group = cls.__new__(cls)
+        group._id, group.name, group.owner_id = row
+        return group
+
+    @property
+    def id(self):
+        """Get the ID of the group.
+
+            Returns:
+            int: The ID of the group.
+        """
+        return self._id
+
+    def save_to_db(self, cursor):
+        """Create the group in the database, with its owner as the first member.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statements.
+
+            Returns:
+                bool: True if the operation is successful.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statements, e.g. the name is taken.
+            """
+        with transaction(cursor):
+            cursor.execute("INSERT INTO groups(name, owner_id) VALUES (%s, %s) RETURNING group_id",
+                           (self.name, self.owner_id))
+            self._id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO group_members(group_id, user_id) VALUES (%s, %s)", (self._id, self.owner_id))
+        return True
+
+    @staticmethod
+    def load_group_by_name(cursor, name):
+        """Load a group from the database by its name.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                name (str): The name of the group, without the leading @.
+
+            Returns:
+                Group or None: The loaded group, None if there is no such group.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        cursor.execute("SELECT group_id, name, owner_id FROM groups WHERE name=%s", (name,))
+        data = cursor.fetchone()
+        return Group.from_row(data) if data else None
+
+    def is_member(self, cursor, user_id):
+        """Check whether a user is a member of the group.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+                user_id (int): The ID of the user.
+
+            Returns:
+                bool: True if the user is a member.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        cursor.execute("SELECT 1 FROM group_members WHERE group_id=%s AND user_id=%s", (self.id, user_id))
+        return cursor.fetchone() is not None
+
+    def load_members(self, cursor):
+        """Load the active members of the group.
+
+            Args:
+                cursor: The cursor object used to execute the SQL query.
+
+            Returns:
+                list: (user_id, username, joined_date) tuples ordered by username.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL query.
+            """
+        sql = """SELECT u.user_id, u.username, gm.joined_date
+                 FROM group_members gm
+                 JOIN users u ON u.user_id = gm.user_id
+                 WHERE gm.group_id=%s AND u.deleted_at IS NULL
+                 ORDER BY u.username"""
+        cursor.execute(sql, (self.id,))
+        return cursor.fetchall()
+
+    def add_members(self, cursor, usernames):
+        """Add users to the group, with one statement whatever their number.
+
+            A new member receives the messages sent to the group from now on.
+            Users who are members already keep their join date.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statement.
+                usernames (iterable): The usernames of the users to add.
+
+            Returns:
+                int: The number of users added; unknown users and members are not counted.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statement.
+            """
+        condition, values = _in_list(cursor, "username", usernames)
+        sql = f"""INSERT INTO group_members(group_id, user_id)
+                  SELECT %s, user_id FROM users WHERE {condition} AND deleted_at IS NULL
+                  ON CONFLICT (group_id, user_id) DO NOTHING"""
+        cursor.execute(sql, [self.id, *values])
+        return cursor.rowcount
+
+    def remove_members(self, cursor, usernames):
+        """Remove users from the group.
+
+            Args:
+                cursor: The cursor object used to execute the SQL statement.
+                usernames (iterable): The usernames of the users to remove.
+
+            Returns:
+                int: The number of members removed.
+
+            Raises:
+                psycopg2.Error: If there is an error executing the SQL statement.
+            """
+        condition, values = _in_list(cursor, "username", usernames)
+        sql = f"""DELETE FROM group_members
+                  WHERE group_id=%s AND user_id IN (SELECT user_id FROM users WHERE {condition})"""
+        cursor.execute(sql, [self.id, *values])
+        return cursor.rowcount
+
+
+class Conversation:
+    __slots__ = ("user_id", "counterpart_id", "counterpart", "last_message_id", "last_date", "last_text",
+                 "message_count", "unread_count")
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a Conversation from a database row.
+
+            Args:
+                row (tuple): The user_id, counterpart_id, counterpart username,
+                    last_message_id, last_date, last message text,
+                    message_count and unread_count columns.
+
+            Returns:
+                Conversation: The loaded conversation summary.
+            """
+        conversation = cls.__new__(cls)
+        (conversation.user_id, conversation.counterpart_id, conversation.counterpart, conversation.last_message_id,
+         conversation.last_date, conversation.last_text, conversation.message_count,
+         conversation.unread_count) = row
+        return conversation
+
+    @staticmethod
+    def load_conversations(cursor, user_id, limit=20, before=None):
+        """Load one page of the conversations of a user, the most recent first.
+
+           Reads the conversations summary table, which triggers on messages
+           keep up to date, so the cost depends on the page size and not on
+           the number of messages.
+
+           Args:
+               cursor: The cursor object used to execute the SQL query.
+               user_id (int): The ID of the user.
+               limit (int, optional): The maximum number of conversations to return. Defaults to 20.
+               before (int, optional): Return only conversations whose last message is older than
+                   the message with this ID.
+
+           Returns:
+               list: Conversation objects.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL query.
+           """
+        values = [user_id]
+        keyset = ""
+        name = "conversations_first"
+
+        if before is not None:
+            name = "conversations_before"
+            keyset = """AND (c.last_date, c.last_message_id) <
+                            (SELECT creation_date, message_id FROM messages WHERE message_id=%s)"""
+            values.append(before)
+
+        sql = f"""SELECT c.user_id, c.counterpart_id, u.username, c.last_message_id, c.last_date, m.text,
+                         c.message_count, c.unread_count
+                  FROM conversations c
+                  JOIN users u ON u.user_id = c.counterpart_id
+                  LEFT JOIN messages m ON m.message_id = c.last_message_id
+                  WHERE c.user_id=%s {keyset}
+                  ORDER BY c.last_date DESC, c.last_message_id DESC
+                  LIMIT %s"""
+        values.append(limit)
+        execute(cursor, name, sql, values)
+
+        return [Conversation.from_row(conversation) for conversation in cursor.fetchall()]
+
+    @staticmethod
+    def mark_read(cursor, user_id, counterpart_id, last_seen_id):
+        """Reset the unread count of a conversation the user has just read.
+
+           Nothing changes if a newer message arrived after `last_seen_id`,
+           so a message cannot be counted as read before it was shown.
+
+           Args:
+               cursor: The cursor object used to execute the SQL statement.
+               user_id (int): The ID of the reader.
+               counterpart_id (int): The ID of the other user.
+               last_seen_id (int): The ID of the newest message shown to the reader.
+
+           Returns:
+               bool: True if the unread count was reset, False otherwise.
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL statement.
+           """
+        sql = """UPDATE conversations SET unread_count=0
+                 WHERE user_id=%s AND counterpart_id=%s AND last_message_id=%s AND unread_count > 0"""
+        cursor.execute(sql, (user_id, counterpart_id, last_seen_id))
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def count_read(cursor, user_id, messages):
+        """Take the direct messages a user has just read off the unread counts of their conversations.
+
+           The counts drop by the number of messages read from each
+           counterpart, not below 0: a message already counted as read by
+           mark_read is not counted twice. The rows are updated in key order,
+           like CONVERSATIONS_UPSERT locks them (see create_db.py), so this
+           cannot deadlock with a running insert.
+
+           Args:
+               cursor: The cursor object used to execute the SQL statements.
+               user_id (int): The ID of the reader.
+               messages (list): The Message objects read, direct and group ones.
+
+           Returns:
+               None
+
+           Raises:
+               psycopg2.Error: If there is an error executing the SQL statements.
+           """
+        read = Counter(message.from_id for message in messages if message.to_id == user_id)
+        sql = """UPDATE conversations SET unread_count = CASE WHEN unread_count > %s THEN unread_count - %s ELSE 0 END
+                 WHERE user_id=%s AND counterpart_id=%s AND unread_count > 0"""
+        for counterpart_id in sorted(read):
+            execute(cursor, "conversation_read", sql, (read[counterpart_id], read[counterpart_id], user_id,
+                                                       counterpart_id))
+
 
 """user = User("Weronika", 'Admin1')
 connection = connect(user='postgres', password='coderslab', host='localhost', database='messanger_db')
@@ -1,27 +1,85 @@
 import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import config
+import daemon
 import db_operations
-from psycopg2 import connect, OperationalError
-from crypto import check_password
+import profiling
+import replicas
+import session
+import shards
+import storage
+
+
+def non_negative(text):
+    """Parse a command line count that may be 0 but not negative."""
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return value
+
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('-u', '--username', help='username')
-parser.add_argument('-p', '--password', help='password')
-parser.add_argument('-t', '--to', help='the name of the user to whom the message is to be sent')
+parser.add_argument('-p', '--password', help='password, may be omitted after --login')
+parser.add_argument('-t', '--to', help='the name of the user to whom the message is to be sent, '
+                                     'or @name of a group you are a member of')
 parser.add_argument('-m', '--message', help='message')
 parser.add_argument('-l', '--list', help='request to list all user messages (flag)', action='store_true')
+parser.add_argument('--limit', help='number of messages to list per page, 0 streams the whole inbox (default 20)', type=non_negative, default=20)
+parser.add_argument('--before', help='list messages older than the message with this id', type=int)
+parser.add_argument('--after', help='list messages newer than the message with this id', type=int)
+parser.add_argument('--unread', help='list the received messages above your read mark, without moving it (flag)',
+                    action='store_true')
+parser.add_argument('--since-last', help='list the messages received since the last --since-last and mark them '
+                                         'as read (flag)', action='store_true')
+parser.add_argument('--follow', help='wait for new messages and print them as they arrive, until Ctrl-C (flag)',
+                    action='store_true')
+parser.add_argument('--search', help='list the sent and received messages containing these words, best match first')
+parser.add_argument('--page', help='page of --search results to list, of --limit messages each (default 1)',
+                    type=int, default=1)
+parser.add_argument('--conversations', help='list the users you have been talking to, most recent first (flag)',
+                    action='store_true')
+parser.add_argument('--with', help='list the conversation with this user, pages like -l', dest='with_user')
+parser.add_argument('--batch', help='send the messages from a JSON lines file ("-" for stdin), '
+                                    'one {"to": ..., "message": ...} object per line')
+parser.add_argument('--attach', help='attach this file to the message sent, may be repeated', action='append',
+                    metavar='FILE')
+parser.add_argument('--read', help='print the full text and the attachments of the message with this id', type=int,
+                    metavar='ID')
+parser.add_argument('--save-attachment', help='save the attachment with this id to a file', type=int, metavar='ID')
+parser.add_argument('--output', help='file --save-attachment writes to, "-" for stdout '
+                                     '(default the name of the attachment)')
+parser.add_argument('--login', help='check the password once and cache a session token for later commands',
+                    action='store_true')
+parser.add_argument('--logout', help='revoke the cached session token', action='store_true')
+parser.add_argument('--profile', help='print where the time went: per-statement database timings and '
+                                      'phase timings, as a table (default) or as json, to stderr',
+                    nargs='?', const='table', choices=['table', 'json'])
 
-args = parser.parse_args()
+BATCH_CHUNK = 10000
+"""
+BATCH_CHUNK is the number of batch lines whose recipients are resolved with one
+query and whose messages are inserted together.
+"""
 
 
-def list_user_messages(cursor, username, password):
+def list_user_messages(cursor, username, password, limit=20, before=None, after=None):
     """
-    This function retrieves and prints all messages for a given user from the database, provided the username and password are correct.
+    This function retrieves and prints one page of messages received by a given user, provided the username and password are correct.
 
     Args:
     cursor: A database cursor object.
     username (str): The username of the user whose messages are to be retrieved.
-    password (str): The password of the user.
+    password (str): The password of the user, None to use the cached session token.
+    limit (int): The maximum number of messages to print, 0 streams the whole inbox.
+    before (int): Print only messages older than the message with this id.
+    after (int): Print only messages newer than the message with this id.
 
     Returns:
     None
@@ -31,36 +89,359 @@ def list_user_messages(cursor, username, password):
 
     Example:
     cursor = db_operations.create_cursor()
-    list_user_messages(cursor, 'example_user', 'password123')
+    list_user_messages(cursor, 'example_user', 'password123', limit=10, before=1234)
     """
-    user = db_operations.User.load_user_by_username(cursor, username)
+    user = session.authenticate(cursor, username, password)
 
     if user:
-        if check_password(password, user.hashed_password):
-            messages = db_operations.Message.load_all_messages(cursor)
-            counter = 1
-
-            for message in messages:
-                to_ = db_operations.User.load_user_by_id(cursor, message.to_id)
-                print(f"""Message no.{counter}: 
-                Message to : {to_.username},
-                Message: {message.text},
-                Message date: {message._creation_date}""")
-                counter += 1
-        else:
-            print("Incorrect password !")
+        print_inbox(cursor, user, limit, before, after)
+
+
+def print_inbox(cursor, user, limit=20, before=None, after=None):
+    """
+    This function prints one page of messages received by an already authenticated user.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The recipient.
+    limit (int): The maximum number of messages to print, 0 streams the whole inbox.
+    before (int): Print only messages older than the message with this id.
+    after (int): Print only messages newer than the message with this id.
+
+    Returns:
+    None
+    """
+    if limit:
+        messages = db_operations.Message.load_inbox(cursor, user.id, limit, before, after)
+        content = db_operations.Message.load_content_info(cursor, [message.id for message in messages])
+    else:
+        messages = db_operations.Message.iter_inbox(cursor, user.id, before, after)
+        content = {}
+    counter = 1
+    message = None
+
+    # a streamed inbox is fetched while it is printed, so with limit 0 the
+    # render phase includes the fetching
+    with profiling.phase("render"):
+        for message in messages:
+            print_message(counter, message, content.get(message.id))
+            counter += 1
+
+    if message is None:
+        print("No messages.")
+    elif counter - 1 == limit:
+        print(f"Older messages: --before {message.id}")
+
+
+def list_new_messages(cursor, username, password, limit=20, advance=False):
+    """
+    This function prints the messages received by a given user above their read mark, provided the username and password are correct.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the recipient.
+    password (str): The password of the recipient, None to use the cached session token.
+    limit (int): The maximum number of messages to print, 0 prints all of them.
+    advance (bool): Move the read mark past the printed messages (--since-last) instead of only peeking (--unread).
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    list_new_messages(cursor, 'example_user', 'password123', advance=True)
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if user:
+        print_new_messages(cursor, user, limit, advance)
+
+
+def print_new_messages(cursor, user, limit=20, advance=False):
+    """
+    This function prints the messages received by an already authenticated user above their read mark, oldest first.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The recipient.
+    limit (int): The maximum number of messages to print, 0 prints all of them.
+    advance (bool): Move the read mark past the printed messages instead of only peeking.
+
+    Returns:
+    None
+    """
+    if advance:
+        messages = db_operations.Message.fetch_since_last(cursor, user.id, limit or None)
+    else:
+        messages = db_operations.Message.load_unread(cursor, user.id, limit or None)
+    content = db_operations.Message.load_content_info(cursor, [message.id for message in messages])
+
+    with profiling.phase("render"):
+        for counter, message in enumerate(messages, 1):
+            print_message(counter, message, content.get(message.id))
+
+    if not messages:
+        print("No new messages.")
+    elif len(messages) == limit:
+        print("More new messages: --since-last" if advance else "More unread messages, --since-last marks them as read")
+
+
+def follow_messages(cursor, username, password):
+    """
+    This function prints the messages received by a given user as they arrive, until interrupted, provided the username and password are correct.
+
+    The user is authenticated once; while no message arrives, nothing is sent to the database.
+
+    Args:
+    cursor: A database cursor object of a connection in autocommit mode.
+    username (str): The username of the recipient.
+    password (str): The password of the recipient, None to use the cached session token.
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    follow_messages(cursor, 'example_user', 'password123')
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if not user:
+        return
+
+    print(f"Following messages to {username}, press Ctrl-C to stop.", flush=True)
+    try:
+        for counter, message in enumerate(db_operations.Message.follow(cursor, user.id), 1):
+            content = db_operations.Message.load_content_info(cursor, [message.id])
+            print_message(counter, message, content.get(message.id))
+            # whoever reads the output (a dashboard, a pipe) gets every message right away
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print()
+
+
+def print_message(number, message, content=None):
+    """
+    This function prints one message.
+
+    Args:
+    number (int): The position of the message in the printed list.
+    message (db_operations.Message): The message, with from_username and to_username filled in.
+    content (tuple): The long body size and attachments of the message, from Message.load_content_info.
+
+    Returns:
+    None
+    """
+    print(f"""Message no.{number} (id {message.id}): 
+            Message from : {message.from_username},
+            Message to : {message.to_username},
+            Message: {message.text},
+            Message date: {message._creation_date}""")
+    if content:
+        body_size, attachments = content
+        if body_size is not None:
+            print(f"            Full message: {body_size} bytes, --read {message.id}")
+        for attachment in attachments:
+            print(f"            Attachment: {attachment.filename} ({attachment.size} bytes), "
+                  f"--save-attachment {attachment.id}")
+
+
+def search_messages(cursor, username, password, terms, limit=20, page=1):
+    """
+    This function searches the messages a given user sent or received, provided the username and password are correct.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user whose messages are searched.
+    password (str): The password of the user, None to use the cached session token.
+    terms (str): The words to search for.
+    limit (int): The number of messages per page, 0 prints all matches.
+    page (int): The page of results to print, starting at 1.
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    search_messages(cursor, 'example_user', 'password123', 'meeting tomorrow', limit=10, page=2)
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if user:
+        print_search(cursor, user, terms, limit, page)
+
+
+def print_search(cursor, user, terms, limit=20, page=1):
+    """
+    This function prints one page of the messages an already authenticated user sent or received that match a search.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The sender or recipient.
+    terms (str): The words to search for.
+    limit (int): The number of messages per page, 0 prints all matches.
+    page (int): The page of results to print, starting at 1.
+
+    Returns:
+    None
+    """
+    if not terms.strip() or page < 1 or limit < 0:
+        print("Please give some words to search for, a positive --page and a non-negative --limit.")
+        return
+
+    messages = db_operations.Message.search(cursor, user.id, terms, limit or None, (page - 1) * limit)
+    content = db_operations.Message.load_content_info(cursor, [message.id for message in messages])
+
+    with profiling.phase("render"):
+        for counter, message in enumerate(messages, (page - 1) * limit + 1):
+            print_message(counter, message, content.get(message.id))
+
+    if not messages:
+        print("No matching messages.")
+    elif len(messages) == limit:
+        print(f"More results: --page {page + 1}")
+
+
+def list_conversations(cursor, username, password, limit=20, before=None):
+    """
+    This function prints one page of the conversations of a given user, provided the username and password are correct.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user.
+    password (str): The password of the user, None to use the cached session token.
+    limit (int): The maximum number of conversations to print.
+    before (int): Print only conversations whose last message is older than the message with this id.
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    list_conversations(cursor, 'example_user', 'password123', limit=10)
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if user:
+        print_conversations(cursor, user, limit, before)
+
+
+def print_conversations(cursor, user, limit=20, before=None):
+    """
+    This function prints one page of the conversations of an already authenticated user.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The user.
+    limit (int): The maximum number of conversations to print.
+    before (int): Print only conversations whose last message is older than the message with this id.
+
+    Returns:
+    None
+    """
+    conversations = db_operations.Conversation.load_conversations(cursor, user.id, limit or 20, before)
+
+    with profiling.phase("render"):
+        for conversation in conversations:
+            unread = f", {conversation.unread_count} unread" if conversation.unread_count else ""
+            print(f"""{conversation.counterpart} ({conversation.message_count} messages{unread}):
+            Last message: {conversation.last_text},
+            Last date: {conversation.last_date}""")
+
+    if not conversations:
+        print("No conversations.")
+    elif len(conversations) == (limit or 20):
+        print(f"Older conversations: --before {conversations[-1].last_message_id}")
+
+
+def list_thread(cursor, username, password, counterpart, limit=20, before=None, after=None):
+    """
+    This function prints one page of the conversation of a given user with another user, provided the username and password are correct.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user.
+    password (str): The password of the user, None to use the cached session token.
+    counterpart (str): The username of the other user.
+    limit (int): The maximum number of messages to print.
+    before (int): Print only messages older than the message with this id.
+    after (int): Print only messages newer than the message with this id.
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    list_thread(cursor, 'example_user', 'password123', 'other_user', limit=10, before=1234)
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if user:
+        print_thread(cursor, user, counterpart, limit, before, after)
+
+
+def print_thread(cursor, user, counterpart, limit=20, before=None, after=None):
+    """
+    This function prints one page of the conversation of an already authenticated user with another user.
+
+    Showing the newest message of the conversation resets its unread count.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The user.
+    counterpart (str): The username of the other user.
+    limit (int): The maximum number of messages to print.
+    before (int): Print only messages older than the message with this id.
+    after (int): Print only messages newer than the message with this id.
+
+    Returns:
+    None
+    """
+    if db_operations.SHARDS is not None:
+        other = db_operations.SHARDS.locate(counterpart)[1]
+    else:
+        other = db_operations.User.load_user_by_username(cursor, counterpart)
+    if not other:
+        return
+
+    limit = limit or 20
+    messages = db_operations.Message.load_thread(cursor, user.id, other.id, limit, before, after)
+    content = db_operations.Message.load_content_info(cursor, [message.id for message in messages])
 
+    with profiling.phase("render"):
+        for counter, message in enumerate(messages, 1):
+            print_message(counter, message, content.get(message.id))
 
-def send_message(cursor, username, password, to, message):
+    if not messages:
+        print("No messages.")
+        return
+    if before is None:
+        db_operations.Conversation.mark_read(cursor, user.id, other.id, messages[0].id)
+    if len(messages) == limit:
+        print(f"Older messages: --before {messages[-1].id}")
+
+
+def send_message(cursor, username, password, to, message, attachments=()):
     """
     This function sends a message from one user to another user in the database, provided the sender's username and password are correct.
 
     Args:
     cursor: A database cursor object.
     username (str): The username of the sender.
-    password (str): The password of the sender.
-    to (str): The username of the recipient.
+    password (str): The password of the sender, None to use the cached session token.
+    to (str): The username of the recipient, or @name of a group.
     message (str): The message content to be sent.
+    attachments (list): Paths of the files to attach to the message.
 
     Returns:
     None
@@ -73,42 +454,383 @@ def send_message(cursor, username, password, to, message):
     send_message(cursor, 'sender_user', 'password123', 'recipient_user', 'Hello, how are you?')
     """
 
-    user = db_operations.User.load_user_by_username(cursor, username)
-    user_hashed_passwd = user.hashed_password
+    user = session.authenticate(cursor, username, password)
 
     if user:
+        deliver_message(cursor, user, to, message, attachments)
+
+
+def deliver_message(cursor, user, to, message, attachments=()):
+    """
+    This function sends a message from an already authenticated user.
+
+    A message longer than 255 characters keeps its first 254 characters in messages.text, as the preview listings
+    show, and its full text in message_bodies. The message, its body and its attachments are saved in one
+    transaction, attachments are streamed from their files in chunks. A message to a group is stored once, whatever
+    the number of its members.
+
+    Args:
+    cursor: A database cursor object.
+    user (db_operations.User): The sender.
+    to (str): The username of the recipient, or @name of a group.
+    message (str): The message content to be sent.
+    attachments (list): Paths of the files to attach to the message.
 
-        if check_password(password, user_hashed_passwd):
+    Returns:
+    None
+    """
+    group = None
+    shard = None
+    if to.startswith('@') and db_operations.SHARDS is not None:
+        print("Groups are not available on a sharded database.")
+        return
+    if to.startswith('@'):
+        group = db_operations.Group.load_group_by_name(cursor, to[1:])
+        if not group:
+            print(f"There is no group named {to[1:]}")
+            return
+        if not group.is_member(cursor, user.id):
+            print(f"You are not a member of {to}")
+            return
+        reciver_id = None
+    else:
+        if db_operations.SHARDS is not None:
+            shard, reciver = db_operations.SHARDS.locate(to)
+        else:
             reciver = db_operations.User.load_user_by_username(cursor, to)
-            if reciver:
-                shipper_id = user.id
-                reciver_id = reciver.id
-                if len(message) <= 255:
-                    final_message = db_operations.Message(shipper_id, reciver_id, message)
-                    final_message.save_to_db(cursor)
-                    print("Message sent !")
+        if not reciver:
+            print(f"There is no user named {to}")
+            return
+        reciver_id = reciver.id
+    if len(message) > config.MAX_BODY_LENGTH:
+        print(f"The message is too long, please try to hold in {config.MAX_BODY_LENGTH} characters.")
+        return
+    for path in attachments:
+        if not os.path.isfile(path):
+            print(f"There is no file named {path}")
+            return
+
+    shipper_id = user.id
+    preview = message if len(message) <= 255 else message[:254] + "…"
+    final_message = db_operations.Message(shipper_id, reciver_id, preview, group.id if group else None)
+    if db_operations.SHARDS is not None:
+        # stored on the recipient's shard, which may not be the sender's
+        stored = db_operations.SHARDS.deliver(user, shard, reciver_id,
+                                              lambda target: store_message(target, final_message, message, attachments))
+        print("Message sent !" if stored is not None else f"There is no user named {to}")
+        return
+    if db_operations.WRITER is not None and preview is message and not attachments:
+        # committed together with the messages other clients send meanwhile
+        db_operations.WRITER.save(final_message)
+        # written on the writer's own connection, which the routing cursor did not see
+        replicas.wrote(user.username)
+        print("Message sent !")
+        return
+
+    with db_operations.transaction(cursor):
+        store_message(cursor, final_message, message, attachments)
+    print("Message sent !")
+
+
+def store_message(cursor, final_message, body, attachments=()):
+    """
+    This function saves a new message with its full body, if it was cut to a preview, and its attachments.
+
+    Args:
+    cursor: A database cursor object, inside a transaction.
+    final_message (db_operations.Message): The unsaved message, its text the preview of the body.
+    body (str): The full text of the message.
+    attachments (list): Paths of the files to attach to the message.
+
+    Returns:
+    None
+    """
+    final_message.save_to_db(cursor)
+    if final_message.text is not body:
+        final_message.save_body(cursor, body)
+    for path in attachments:
+        with open(path, 'rb') as file:
+            db_operations.Attachment.save(cursor, final_message.id, os.path.basename(path), file)
+
+
+def read_message(cursor, username, password, message_id):
+    """
+    This function prints the full text and the attachments of one message sent or received by the user.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user.
+    password (str): The password of the user, None to use the cached session token.
+    message_id (int): The ID of the message.
+
+    Returns:
+    None
+    """
+    user = session.authenticate(cursor, username, password)
+    if not user:
+        return
+
+    message = db_operations.Message.load_message(cursor, message_id, user.id)
+    if not message:
+        print(f"There is no message with id {message_id}")
+        return
+    body = db_operations.Message.load_body(cursor, message_id)
+    if body is not None:
+        message.text = body
+    content = db_operations.Message.load_content_info(cursor, [message_id]).get(message_id)
+    print_message(1, message, (None, content[1]) if content else None)
+
+
+def save_attachment(cursor, username, password, attachment_id, output=None):
+    """
+    This function writes an attachment of a message sent or received by the user to a file.
+
+    The content is streamed chunk by chunk, an existing file is never overwritten.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user.
+    password (str): The password of the user, None to use the cached session token.
+    attachment_id (int): The ID of the attachment.
+    output (str): The path to write to, "-" for stdout, defaults to the name of the attachment.
+
+    Returns:
+    None
+    """
+    user = session.authenticate(cursor, username, password)
+    if not user:
+        return
+
+    attachment = db_operations.Attachment.load(cursor, attachment_id, user.id)
+    if not attachment:
+        print(f"There is no attachment with id {attachment_id}")
+        return
+    if output == '-':
+        attachment.write_to(cursor, sys.stdout.buffer)
+        return
+
+    path = output or attachment.filename
+    try:
+        with open(path, 'xb') as out:
+            written = attachment.write_to(cursor, out)
+    except FileExistsError:
+        print(f"{path} already exists, choose another file with --output")
+        return
+    print(f"Saved {attachment.filename} to {path} ({written} bytes)")
+
+
+def send_batch(cursor, username, password, lines):
+    """
+    This function sends many messages from one user at once, provided the sender's username and password are correct.
+
+    The sender is authenticated once, recipients are resolved with one query per chunk of BATCH_CHUNK lines and
+    all messages are inserted with multi-row INSERTs in a single transaction. Lines that cannot be sent are reported
+    and skipped. On a sharded database every shard inserts its recipients' messages in a transaction of its own.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the sender.
+    password (str): The password of the sender, None to use the cached session token.
+    lines (iterable): JSON lines, each an object with "to" and "message" keys.
+
+    Returns:
+    None
+
+    Raises:
+    None
+
+    Example:
+    with open('notifications.jsonl') as batch:
+        send_batch(cursor, 'sender_user', 'password123', batch)
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if not user:
+        return
+
+    started = time.perf_counter()
+    sent = 0
+    rejected = 0
+    numbered = enumerate(lines, 1)
+
+    with db_operations.transaction(cursor):
+        while True:
+            chunk = list(itertools.islice(numbered, BATCH_CHUNK))
+            if not chunk:
+                break
+
+            rows = []
+            for line_no, line in chunk:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item["to"], str) or not isinstance(item["message"], str):
+                        raise TypeError
+                    rows.append((line_no, item["to"], item["message"]))
+                except (ValueError, TypeError, KeyError):
+                    print(f"Rejected line {line_no}: expected an object with \"to\" and \"message\"")
+                    rejected += 1
+
+            if not rows:
+                continue
+            if db_operations.SHARDS is not None:
+                # {username: (shard, user)}, asked of every shard at once
+                located = db_operations.SHARDS.locate_many({to for _, to, _ in rows})
+                recipients = {to: recipient for to, (_, recipient) in located.items()}
+            else:
+                recipients = db_operations.User.load_users_by_usernames(cursor, {to for _, to, _ in rows})
+            messages = []
+            numbers = []
+            for line_no, to, message in rows:
+                if to not in recipients:
+                    print(f"Rejected line {line_no}: there is no user named {to}")
+                    rejected += 1
+                elif len(message) > 255:
+                    print(f"Rejected line {line_no}: the message is longer than 255 characters")
+                    rejected += 1
                 else:
-                    print("The message is too long, please try to hold in 255 characters.")
+                    messages.append(db_operations.Message(user.id, recipients[to].id, message))
+                    if db_operations.SHARDS is not None:
+                        numbers.append(located[to][0])
+
+            if db_operations.SHARDS is not None:
+                saved = db_operations.SHARDS.save_many(user, messages, numbers)
+                if saved < len(messages):
+                    print(f"Rejected {len(messages) - saved} messages: their recipients moved or left meanwhile")
+                    rejected += len(messages) - saved
+                sent += saved
             else:
-                print(f"There is no user named {to}")
+                sent += db_operations.Message.save_many(cursor, messages)
+
+    elapsed = time.perf_counter() - started
+    print(f"Sent {sent} messages in {elapsed:.2f} s ({sent / elapsed:.0f} messages/s), rejected {rejected}.")
+
+
+def login(cursor, username, password):
+    """
+    This function checks the password once and caches a session token, so later commands can omit the password.
+
+    Args:
+    cursor: A database cursor object.
+    username (str): The username of the user.
+    password (str): The password of the user.
+
+    Returns:
+    None
+
+    Raises:
+    None
+    """
+    user = session.authenticate(cursor, username, password)
+
+    if user:
+        expires = session.login(user)
+        print(f"Logged in as {username} until {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires))}")
+
+
+def logout(username):
+    """
+    This function revokes the cached session tokens of a user.
+
+    Args:
+    username (str): The username of the user.
+
+    Returns:
+    None
+    """
+    session.revoke(username)
+    print(f"Logged out {username}")
+
+
+def run(cursor, args):
+    """
+    This function dispatches the parsed command line arguments to the matching command.
+
+    Args:
+    cursor: A database cursor object.
+    args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+    None
+    """
+    if args.username and args.password and args.login:
+        login(cursor, args.username, args.password)
+    elif args.username and args.logout:
+        logout(args.username)
+    elif args.username and args.follow:
+        follow_messages(cursor, args.username, args.password)
+    elif args.username and (args.unread or args.since_last):
+        list_new_messages(cursor, args.username, args.password, args.limit, args.since_last)
+    elif args.username and args.search is not None:
+        search_messages(cursor, args.username, args.password, args.search, args.limit, args.page)
+    elif args.username and args.conversations:
+        list_conversations(cursor, args.username, args.password, args.limit, args.before)
+    elif args.username and args.with_user:
+        list_thread(cursor, args.username, args.password, args.with_user, args.limit, args.before, args.after)
+    elif args.username and args.list:
+        list_user_messages(cursor, args.username, args.password, args.limit, args.before, args.after)
+    elif args.username and args.read is not None:
+        read_message(cursor, args.username, args.password, args.read)
+    elif args.username and args.save_attachment is not None:
+        save_attachment(cursor, args.username, args.password, args.save_attachment, args.output)
+    elif args.username and args.to and args.message:
+        send_message(cursor, args.username, args.password, args.to, args.message, args.attach or ())
+    elif args.username and args.batch:
+        if args.batch == '-':
+            send_batch(cursor, args.username, args.password, sys.stdin)
         else:
-            print("Incorrect password !")
+            try:
+                batch = open(args.batch, encoding='utf-8')
+            except OSError:
+                print(f"There is no file named {args.batch}")
+                return
+            with batch:
+                send_batch(cursor, args.username, args.password, batch)
+    else:
+        parser.print_help()
 
 
-if __name__ == '__main__':
+def main(argv=None):
+    """
+    This function runs the command given on the command line, through the daemon if one is running.
+
+    Args:
+    argv (list): The command line arguments, defaults to sys.argv[1:].
+
+    Returns:
+    None
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+
+    # a batch is one long command that reads local files or stdin, like
+    # attaching and saving attachments read and write local files, --follow
+    # would hold one of the daemon's connections forever, and a profile has to
+    # measure this process, so these always run here
+    local = args.batch or args.attach or args.save_attachment is not None
+    if not (local or args.follow or args.profile) and daemon.forward('mess_app', argv):
+        return
+
+    if args.profile:
+        profiling.enable()
 
     try:
-        connection = connect(user='postgres', password='coderslab', host='localhost', database='messanger_db')
+        with profiling.phase("connect"):
+            connection = shards.connect(args.username)
         connection.autocommit = True
-        cursor = connection.cursor()
-
-        if args.username and args.password and args.list:
-            list_user_messages(cursor, args.username, args.password)
-        elif args.username and args.password and args.to and args.message:
-            send_message(cursor, args.username, args.password, args.to, args.message)
-        else:
-            parser.print_help()
+        cursor = replicas.route(connection.cursor(), args.username)
+        run(cursor, args)
+        cursor.close()
         connection.close()
 
-    except OperationalError as opr_err:
-        print("Connection Error: ", opr_err)
\ No newline at end of file
+    except storage.CONNECTION_ERRORS as opr_err:
+        print("Connection Error: ", opr_err)
+    finally:
+        shards.close()
+
+    profiling.report(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+"""
+Unified entry point of the messaging console application.
+
+    python messenger.py send -u alice -t bob -m "Hi" [--attach FILE]...
+    python messenger.py read -u alice ID
+    python messenger.py attachment -u alice ID [--output PATH]
+    python messenger.py inbox -u alice [--limit N] [--before ID] [--after ID]
+    python messenger.py follow -u alice
+    python messenger.py new -u alice [--peek] [--limit N]
+    python messenger.py search -u alice "words to find" [--limit N] [--page N]
+    python messenger.py conversations -u alice [--with bob] [--limit N] [--before ID]
+    python messenger.py group -u alice NAME [--create] [--add bob]... [--remove bob]...
+    python messenger.py users
+    python messenger.py passwd -u alice -p OLD -n NEW
+    python messenger.py login -u alice -p PASSWORD
+    python messenger.py logout -u alice
+    python messenger.py shell -u alice
+
+Subcommands import the application modules (and with them psycopg2) only
+when they actually need them, so `--help` and commands served by the daemon
+start without paying for the database driver. `shell` opens an interactive
+session that authenticates once and keeps one connection for all commands.
+"""
+import argparse
+import cmd
+import importlib
+import shlex
+
+
+def _with_password(argv, args):
+    return argv + ['-p', args.password] if args.password else argv
+
+
+def _run(app, argv, local=False):
+    """Run a mess_app or user_app command line, through the daemon if one is running and the command is not local."""
+    import daemon
+
+    if not local and daemon.forward(app, argv):
+        return
+
+    importlib.import_module(app).main(argv)
+
+
+def cmd_send(args):
+    argv = ['-u', args.username, '-t', args.to, '-m', args.message]
+    for path in args.attach or ():
+        argv += ['--attach', path]
+    # the daemon cannot read the files to attach
+    _run('mess_app', _with_password(argv, args), local=bool(args.attach))
+
+
+def cmd_read(args):
+    _run('mess_app', _with_password(['-u', args.username, '--read', str(args.id)], args))
+
+
+def cmd_attachment(args):
+    argv = ['-u', args.username, '--save-attachment', str(args.id)]
+    if args.output:
+        argv += ['--output', args.output]
+    _run('mess_app', _with_password(argv, args), local=True)
+
+
+def cmd_inbox(args):
+    argv = ['-u', args.username, '-l', '--limit', str(args.limit)]
+    if args.before is not None:
+        argv += ['--before', str(args.before)]
+    if args.after is not None:
+        argv += ['--after', str(args.after)]
+    _run('mess_app', _with_password(argv, args))
+
+
+def cmd_follow(args):
+    _run('mess_app', _with_password(['-u', args.username, '--follow'], args))
+
+
+def cmd_new(args):
+    argv = ['-u', args.username, '--unread' if args.peek else '--since-last', '--limit', str(args.limit)]
+    _run('mess_app', _with_password(argv, args))
+
+
+def cmd_search(args):
+    argv = ['-u', args.username, '--search', args.terms, '--limit', str(args.limit), '--page', str(args.page)]
+    _run('mess_app', _with_password(argv, args))
+
+
+def cmd_conversations(args):
+    argv = ['-u', args.username, '--limit', str(args.limit)]
+    argv += ['--with', args.with_user] if args.with_user else ['--conversations']
+    if args.before is not None:
+        argv += ['--before', str(args.before)]
+    _run('mess_app', _with_password(argv, args))
+
+
+def cmd_group(args):
+    argv = ['-u', args.username, '--create-group' if args.create else '--group', args.name]
+    for username in args.add or ():
+        argv += ['--add-member', username]
+    for username in args.remove or ():
+        argv += ['--remove-member', username]
+    _run('user_app', _with_password(argv, args))
+
+
+def cmd_users(args):
+    _run('user_app', ['-s'])
+
+
+def cmd_passwd(args):
+    _run('user_app', ['-u', args.username, '-p', args.password, '-e', '-n', args.new_pass])
+
+
+def cmd_login(args):
+    _run('mess_app', ['-u', args.username, '-p', args.password, '--login'])
+
+
+def cmd_logout(args):
+    _run('mess_app', ['-u', args.username, '--logout'])
+
+
+def cmd_shell(args):
+    import getpass
+
+    import config
+    import db_operations
+    import replicas
+    import session
+    import shards
+    import storage
+
+    db_operations.PREPARE = config.PREPARED_STATEMENTS
+
+    try:
+        connection = shards.connect(args.username)
+    except storage.CONNECTION_ERRORS as opr_err:
+        print("Connection Error: ", opr_err)
+        shards.close()
+        return
+    connection.autocommit = True
+    cursor = replicas.route(connection.cursor(), args.username)
+
+    password = args.password
+    if password is None and session.load(args.username) is None:
+        password = getpass.getpass(f"Password for {args.username}: ")
+    user = session.authenticate(cursor, args.username, password)
+
+    if user:
+        try:
+            MessengerShell(cursor, user).cmdloop()
+        except KeyboardInterrupt:
+            print()
+    cursor.close()
+    connection.close()
+    shards.close()
+
+
+class MessengerShell(cmd.Cmd):
+    """Interactive session of one authenticated user on one connection."""
+
+    def __init__(self, cursor, user):
+        super().__init__()
+        self.cursor = cursor
+        self.user = user
+        self.prompt = f"{user.username}> "
+        self.intro = f"Logged in as {user.username}. Type help or ? to list commands."
+
+    def onecmd(self, line):
+        import storage
+
+        try:
+            return super().onecmd(line)
+        except storage.DATABASE_ERRORS as err:
+            print("Error: ", err)
+        except (ValueError, SystemExit):
+            # bad quoting or arguments, argparse already printed the usage
+            pass
+
+    def emptyline(self):
+        pass
+
+    def do_send(self, line):
+        """send RECIPIENT MESSAGE...  Send a message, to a group with @NAME."""
+        import mess_app
+
+        words = shlex.split(line)
+        if len(words) < 2:
+            print("usage: send RECIPIENT MESSAGE")
+            return
+        mess_app.deliver_message(self.cursor, self.user, words[0], " ".join(words[1:]))
+
+    def do_inbox(self, line):
+        """inbox [--limit N] [--before ID] [--after ID]  List received messages."""
+        import mess_app
+
+        inbox = argparse.ArgumentParser(prog="inbox")
+        inbox.add_argument('--limit', type=int, default=20)
+        inbox.add_argument('--before', type=int)
+        inbox.add_argument('--after', type=int)
+        args = inbox.parse_args(shlex.split(line))
+        mess_app.print_inbox(self.cursor, self.user, args.limit, args.before, args.after)
+
+    def do_new(self, line):
+        """new [--peek] [--limit N]  List messages received since the last check and mark them as read."""
+        import mess_app
+
+        new = argparse.ArgumentParser(prog="new")
+        new.add_argument('--peek', action='store_true')
+        new.add_argument('--limit', type=int, default=20)
+        args = new.parse_args(shlex.split(line))
+        mess_app.print_new_messages(self.cursor, self.user, args.limit, not args.peek)
+
+    def do_search(self, line):
+        """search [--limit N] [--page N] WORDS...  Search your sent and received messages."""
+        import mess_app
+
+        search = argparse.ArgumentParser(prog="search")
+        search.add_argument('--limit', type=int, default=20)
+        search.add_argument('--page', type=int, default=1)
+        search.add_argument('words', nargs='+')
+        args = search.parse_args(shlex.split(line))
+        mess_app.print_search(self.cursor, self.user, " ".join(args.words), args.limit, args.page)
+
+    def do_conversations(self, line):
+        """conversations [--limit N] [--before ID] [USER]  List your conversations, or the one with USER."""
+        import mess_app
+
+        conversations = argparse.ArgumentParser(prog="conversations")
+        conversations.add_argument('--limit', type=int, default=20)
+        conversations.add_argument('--before', type=int)
+        conversations.add_argument('user', nargs='?')
+        args = conversations.parse_args(shlex.split(line))
+        if args.user:
+            mess_app.print_thread(self.cursor, self.user, args.user, args.limit, args.before)
+        else:
+            mess_app.print_conversations(self.cursor, self.user, args.limit, args.before)
+
+    def do_users(self, line):
+        """users  List all users."""
+        import user_app
+
+        user_app.show_users(self.cursor)
+
+    def do_passwd(self, line):
+        """passwd  Change your password."""
+        import getpass
+        import user_app
+
+        old = getpass.getpass("Current password: ")
+        new = getpass.getpass("New password: ")
+        user_app.edit_password(self.cursor, self.user.username, old, new)
+
+    def do_quit(self, line):
+        """quit  Leave the shell."""
+        return True
+
+    do_exit = do_quit
+
+    def do_EOF(self, line):
+        print()
+        return True
+
+
+parser = argparse.ArgumentParser(prog='messenger', description="Messaging console application.")
+subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+send = subparsers.add_parser('send', help='send a message')
+send.add_argument('-u', '--username', required=True, help='username')
+send.add_argument('-p', '--password', help='password, may be omitted after login')
+send.add_argument('-t', '--to', required=True, help='the name of the user to whom the message is to be sent')
+send.add_argument('-m', '--message', required=True, help='message')
+send.add_argument('--attach', action='append', metavar='FILE', help='attach this file, may be repeated')
+send.set_defaults(handler=cmd_send)
+
+read = subparsers.add_parser('read', help='print the full text and the attachments of a message')
+read.add_argument('id', type=int, help='the id of the message')
+read.add_argument('-u', '--username', required=True, help='username')
+read.add_argument('-p', '--password', help='password, may be omitted after login')
+read.set_defaults(handler=cmd_read)
+
+attachment = subparsers.add_parser('attachment', help='save an attachment to a file')
+attachment.add_argument('id', type=int, help='the id of the attachment')
+attachment.add_argument('-u', '--username', required=True, help='username')
+attachment.add_argument('-p', '--password', help='password, may be omitted after login')
+attachment.add_argument('--output', help='file to write, "-" for stdout (default the name of the attachment)')
+attachment.set_defaults(handler=cmd_attachment)
+
+inbox = subparsers.add_parser('inbox', help='list received messages')
+inbox.add_argument('-u', '--username', required=True, help='username')
+inbox.add_argument('-p', '--password', help='password, may be omitted after login')
+inbox.add_argument('--limit', type=int, default=20, help='messages per page, 0 for all (default 20)')
+inbox.add_argument('--before', type=int, help='list messages older than the message with this id')
+inbox.add_argument('--after', type=int, help='list messages newer than the message with this id')
+inbox.set_defaults(handler=cmd_inbox)
+
+follow = subparsers.add_parser('follow', help='print new messages as they arrive')
+follow.add_argument('-u', '--username', required=True, help='username')
+follow.add_argument('-p', '--password', help='password, may be omitted after login')
+follow.set_defaults(handler=cmd_follow)
+
+new = subparsers.add_parser('new', help='list messages received since the last check and mark them as read')
+new.add_argument('-u', '--username', required=True, help='username')
+new.add_argument('-p', '--password', help='password, may be omitted after login')
+new.add_argument('--peek', action='store_true', help='only list the unread messages, do not mark them as read')
+new.add_argument('--limit', type=int, default=20, help='messages to list, 0 for all (default 20)')
+new.set_defaults(handler=cmd_new)
+
+search = subparsers.add_parser('search', help='search sent and received messages')
+search.add_argument('terms', help='the words to search for')
+search.add_argument('-u', '--username', required=True, help='username')
+search.add_argument('-p', '--password', help='password, may be omitted after login')
+search.add_argument('--limit', type=int, default=20, help='messages per page, 0 for all (default 20)')
+search.add_argument('--page', type=int, default=1, help='page of results to list (default 1)')
+search.set_defaults(handler=cmd_search)
+
+conversations = subparsers.add_parser('conversations', help='list the users you have been talking to')
+conversations.add_argument('-u', '--username', required=True, help='username')
+conversations.add_argument('-p', '--password', help='password, may be omitted after login')
+conversations.add_argument('--with', dest='with_user', help='list the conversation with this user instead')
+conversations.add_argument('--limit', type=int, default=20, help='entries per page (default 20)')
+conversations.add_argument('--before', type=int, help='list entries older than the message with this id')
+conversations.set_defaults(handler=cmd_conversations)
+
+group = subparsers.add_parser('group', help='create a group, list or edit its members')
+group.add_argument('name', help='the name of the group, messages are sent to it with -t @NAME')
+group.add_argument('-u', '--username', required=True, help='username')
+group.add_argument('-p', '--password', help='password, may be omitted after login')
+group.add_argument('--create', action='store_true', help='create the group, owned by you')
+group.add_argument('--add', action='append', metavar='USERNAME', help='add this user, may be repeated')
+group.add_argument('--remove', action='append', metavar='USERNAME', help='remove this member, may be repeated')
+group.set_defaults(handler=cmd_group)
+
+users = subparsers.add_parser('users', help='list all users')
+users.set_defaults(handler=cmd_users)
+
+passwd = subparsers.add_parser('passwd', help='change a password')
+passwd.add_argument('-u', '--username', required=True, help='username')
+passwd.add_argument('-p', '--password', required=True, help='current password')
+passwd.add_argument('-n', '--new_pass', required=True, help='new password')
+passwd.set_defaults(handler=cmd_passwd)
+
+login = subparsers.add_parser('login', help='check the password once and cache a session token')
+login.add_argument('-u', '--username', required=True, help='username')
+login.add_argument('-p', '--password', required=True, help='password')
+login.set_defaults(handler=cmd_login)
+
+logout = subparsers.add_parser('logout', help='revoke the cached session token')
+logout.add_argument('-u', '--username', required=True, help='username')
+logout.set_defaults(handler=cmd_logout)
+
+shell = subparsers.add_parser('shell', help='interactive session on one authenticated connection')
+shell.add_argument('-u', '--username', required=True, help='username')
+shell.add_argument('-p', '--password', help='password, prompted for if there is no session token')
+shell.set_defaults(handler=cmd_shell)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Query instrumentation behind the --profile flag of mess_app and user_app.
+
+When profiling is enabled, connections are opened with ProfilingCursor as
+their cursor factory, so every statement sent through db_operations is
+timed and counted, grouped by its normalized SQL. Rows streamed from a
+server-side cursor arrive in later round trips; each of them is timed as a
+"FETCH <statement>" entry of its own. Application phases
+(connecting, password hashing, rendering, ...) are timed with phase().
+At the end report() prints a summary table, or a JSON document, to stderr.
+
+When profiling is disabled all of this costs nothing but a None check.
+"""
+import json
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+from psycopg2.extensions import cursor as _cursor
+
+
+class Profiler:
+    """Accumulates statement and phase timings."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = {}
+        self.phases = {}
+
+    def record_statement(self, sql, seconds, rows):
+        stats = self.statements.setdefault(normalize(sql), {"calls": 0, "seconds": 0.0, "max": 0.0, "rows": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        if rows > 0:
+            stats["rows"] += rows
+
+    def record_phase(self, name, seconds):
+        stats = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+
+    def summary(self):
+        """Get everything recorded so far.
+
+            Returns:
+                dict: total seconds, round trips, and the statements and
+                phases sorted by the time spent in them.
+            """
+        by_time = lambda item: -item[1]["seconds"]
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "round_trips": sum(stats["calls"] for stats in self.statements.values()),
+            "statements": [dict(sql=sql, **stats) for sql, stats in sorted(self.statements.items(), key=by_time)],
+            "phases": [dict(name=name, **stats) for name, stats in sorted(self.phases.items(), key=by_time)],
+        }
+
+
+PROFILER = None
+"""
+PROFILER is the active Profiler, or None while profiling is disabled.
+"""
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_VALUE_LISTS = re.compile(r"\(\?(?:\s*,\s*\?)*\)(?:\s*,\s*\(\?(?:\s*,\s*\?)*\))+")
+
+
+def normalize(sql):
+    """Reduce a statement to its shape, so its executions are grouped together.
+
+        Whitespace is collapsed and literals become ?, which also merges the
+        fully rendered multi-row INSERTs of execute_values into one entry.
+
+        Args:
+            sql (str or bytes): The statement as passed to execute().
+
+        Returns:
+            str: The normalized statement.
+        """
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    sql = " ".join(str(sql).split())
+    sql = _LITERALS.sub("?", sql)
+    return _VALUE_LISTS.sub("(?), ...", sql)
+
+
+def fetch_label(sql):
+    """Get the name the fetches of the rows of `sql` are recorded under."""
+    return "FETCH " + normalize(sql)
+
+
+def iter_chunks(fetchmany, size):
+    """Iterate over the rows of a result by calling `fetchmany(size)` until it returns no rows."""
+    while True:
+        rows = fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+class ProfilingCursor(_cursor):
+    """A psycopg2 cursor that reports each statement to the active Profiler."""
+
+    _sql = None
+
+    def execute(self, query, vars=None):
+        self._sql = query
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if PROFILER is not None:
+                PROFILER.record_statement(query, time.perf_counter() - started, self.rowcount)
+
+    # a named cursor only declares its query in execute(); the rows come
+    # with every fetch, so those are timed too. Fetches from a client-side
+    # cursor never leave the process and are not.
+
+    def _fetch(self, fetch, *args):
+        if self.name is None or PROFILER is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        result = None
+        try:
+            result = fetch(*args)
+            return result
+        finally:
+            rows = len(result) if isinstance(result, list) else int(result is not None)
+            PROFILER.record_statement(fetch_label(self._sql), time.perf_counter() - started, rows)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.itersize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __iter__(self):
+        if self.name is None:
+            return super().__iter__()
+        # itersize rows per round trip, like psycopg2's own iteration
+        return iter_chunks(self.fetchmany, self.itersize)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            if PROFILER is not None:
+                PROFILER.record_statement(query, time.perf_counter() - started, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            if PROFILER is not None:
+                PROFILER.record_statement(sql, time.perf_counter() - started, self.rowcount)
+
+
+def enable():
+    """Start profiling this process."""
+    global PROFILER
+    PROFILER = Profiler()
+
+
+def cursor_factory():
+    """Get the cursor_factory to open connections with.
+
+        Returns:
+            type or None: ProfilingCursor while profiling, None (the psycopg2
+            default) otherwise.
+        """
+    return ProfilingCursor if PROFILER is not None else None
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as the application phase `name`."""
+    if PROFILER is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.record_phase(name, time.perf_counter() - started)
+
+
+def report(output_format="table", out=None):
+    """Print what the profiler recorded.
+
+        Args:
+            output_format (str, optional): "table" or "json". Defaults to "table".
+            out (optional): The stream to print to. Defaults to sys.stderr.
+
+        Returns:
+            None
+        """
+    if PROFILER is None:
+        return
+    out = out or sys.stderr
+    summary = PROFILER.summary()
+
+    if output_format == "json":
+        json.dump(summary, out, indent=2)
+        print(file=out)
+        return
+
+    print(f"\nTotal {summary['total_seconds'] * 1000:.1f} ms, {summary['round_trips']} statements", file=out)
+    print(f"\n{'phase':<20}{'calls':>7}{'total ms':>11}", file=out)
+    for stats in summary["phases"]:
+        print(f"{stats['name']:<20}{stats['calls']:>7}{stats['seconds'] * 1000:>11.2f}", file=out)
+    print(f"\n{'calls':>7}{'total ms':>11}{'mean ms':>10}{'max ms':>10}{'rows':>9}  statement", file=out)
+    for stats in summary["statements"]:
+        sql = stats["sql"] if len(stats["sql"]) <= 90 else stats["sql"][:87] + "..."
+        print(f"{stats['calls']:>7}{stats['seconds'] * 1000:>11.2f}{stats['seconds'] * 1000 / stats['calls']:>10.2f}"
+              f"{stats['max'] * 1000:>10.2f}{stats['rows']:>9}  {sql}", file=out)
@@ -0,0 +1,374 @@
+"""
+Read-replica routing: read-only statements go to streaming replicas, the
+rest to the primary.
+
+Configure the replicas with MESSENGER_REPLICA_DSNS, a comma separated list
+of libpq connection strings, e.g.
+
+    MESSENGER_REPLICA_DSNS="host=localhost port=5433 dbname=messanger_db user=postgres password=..."
+
+The CLIs, the daemon and the shell then wrap their primary cursor with
+route(). The RoutingCursor it returns is a drop-in for the psycopg2 cursor
+db_operations takes:
+
+- A plain SELECT (or a COPY ... TO STDOUT) runs on a replica, picked round
+  robin among the healthy ones. Everything else runs on the primary.
+- A replica is healthy while it is in recovery, its WAL receiver is
+  streaming from the primary and it replays less than config.REPLICA_MAX_LAG
+  seconds behind the primary. This is checked when it
+  is picked, at most every config.REPLICA_CHECK_INTERVAL seconds. One that
+  fails the check or cannot be reached is skipped until the next check.
+  Without a healthy replica, reads run on the primary.
+- Read-your-writes: after a session writes, its reads stay on the primary
+  for config.REPLICA_STICKY_SECONDS. A session is a username: in the daemon
+  and the shell it spans the user's commands, a one-shot CLI command without
+  the daemon only remembers its own writes. Everything inside a transaction,
+  and everything after a LISTEN (notifications are not replicated), runs on
+  the primary too.
+
+To try it locally, clone the primary into a streaming replica on port 5433:
+
+    pg_basebackup -D /tmp/replica -R -h localhost -U postgres
+    postgres -D /tmp/replica -p 5433
+
+The health check reads pg_stat_wal_receiver, whose status only superusers and
+members of pg_read_all_stats can see, so the replica DSNs need such a role.
+
+and check what the router sees with `python replicas.py`.
+"""
+import itertools
+import re
+import threading
+import time
+
+from psycopg2 import Error, InterfaceError, OperationalError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+import config
+import profiling
+import storage
+
+
+READ = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+WRITE = re.compile(r"\b(INSERT|UPDATE|DELETE|FOR\s+(UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE)|nextval|setval|"
+                   r"pg_notify|pg_advisory\w*|set_config)\b", re.IGNORECASE)
+"""
+A statement is routed to a replica if it matches READ and not WRITE. The
+settings set_config changes only hold on the connection it ran on, e.g. the
+gate of the read marks, which has to be read from the primary's locks.
+"""
+
+PRIMARY_LSN_QUERY = "SELECT pg_current_wal_lsn()"
+LAG_QUERY = """SELECT pg_is_in_recovery(),
+                      EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'),
+                      CASE WHEN pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn()) <= 0 THEN 0
+                           ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"""
+"""
+LAG_QUERY tells whether a server is a replica, whether it is streaming from
+the primary and how many seconds its replay is behind, given the primary's
+PRIMARY_LSN_QUERY. A replica that replayed everything the primary wrote is
+not behind, however long ago the primary last wrote; one that only replayed
+everything it received is, since its WAL receiver may have lost the primary.
+"""
+
+
+def current_lsn(connection):
+    """Read the current WAL position of the primary with PRIMARY_LSN_QUERY."""
+    with connection.cursor() as cursor:
+        cursor.execute(PRIMARY_LSN_QUERY)
+        return cursor.fetchone()[0]
+
+
+class Replica:
+    """One replica: its connection pool and the result of its last health check."""
+
+    def __init__(self, dsn, maxconn):
+        self.dsn = dsn
+        self.pool = ThreadedConnectionPool(0, maxconn, dsn, cursor_factory=profiling.cursor_factory())
+        self.healthy = True
+        self.lag = None
+        self.checked_at = None
+        self.error = None
+
+    def due(self):
+        """Check whether the last health check is older than config.REPLICA_CHECK_INTERVAL."""
+        return self.checked_at is None or time.monotonic() - self.checked_at >= config.REPLICA_CHECK_INTERVAL
+
+    def check(self, connection, primary_lsn):
+        """Run the health check on a connection of the replica.
+
+            Args:
+                connection: A connection from the replica's pool.
+                primary_lsn (str): The primary's current WAL position, from PRIMARY_LSN_QUERY.
+
+            Returns:
+                bool: True if the replica is in recovery, streaming and at most config.REPLICA_MAX_LAG seconds behind.
+
+            Raises:
+                psycopg2.Error: If the check cannot run.
+            """
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_QUERY, (primary_lsn,))
+            in_recovery, streaming, lag = cursor.fetchone()
+        if not in_recovery:
+            self.lag, self.error = None, "not in recovery"
+        elif not streaming:
+            self.lag, self.error = None, "WAL receiver not streaming"
+        elif lag is None:
+            self.lag, self.error = None, "nothing replayed yet"
+        else:
+            self.lag, self.error = float(lag), None
+        self.healthy = self.lag is not None and self.lag <= config.REPLICA_MAX_LAG
+        self.checked_at = time.monotonic()
+        return self.healthy
+
+    def fail(self, err):
+        """Mark the replica unhealthy until the next check."""
+        self.healthy = False
+        self.error = str(err).strip()
+        self.checked_at = time.monotonic()
+
+
+class ReplicaRouter:
+    """Hands out replica connections round robin and remembers when each session last wrote."""
+
+    def __init__(self, dsns, maxconn=config.POOL_MAX_CONNECTIONS):
+        """Create the (initially empty) connection pools of the replicas.
+
+            Args:
+                dsns (list): The libpq connection strings of the replicas.
+                maxconn (int, optional): The most connections per replica. Defaults to config.POOL_MAX_CONNECTIONS.
+            """
+        self.replicas = [Replica(dsn, maxconn) for dsn in dsns]
+        self._cycle = itertools.cycle(self.replicas)
+        self._last_writes = {}
+        self._lock = threading.Lock()
+
+    def wrote(self, session):
+        """Record that `session` just wrote to the primary."""
+        with self._lock:
+            self._last_writes[session] = time.monotonic()
+
+    def sticky(self, session):
+        """Check whether `session` wrote less than config.REPLICA_STICKY_SECONDS ago."""
+        with self._lock:
+            last_write = self._last_writes.get(session)
+        return last_write is not None and time.monotonic() - last_write < config.REPLICA_STICKY_SECONDS
+
+    def borrow(self, primary):
+        """Borrow a connection of the next healthy replica.
+
+            Args:
+                primary: The primary connection, asked for its WAL position when a replica is due for a check.
+
+            Returns:
+                tuple or None: The Replica and an autocommit connection from its pool,
+                None if no replica is healthy.
+            """
+        primary_lsn = None
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = next(self._cycle)
+            if not replica.healthy and not replica.due():
+                continue
+            # read before the replica is checked, so it has to have replayed at least this much
+            if replica.due() and primary_lsn is None:
+                primary_lsn = current_lsn(primary)
+            try:
+                connection = replica.pool.getconn()
+            except (Error, PoolError) as err:
+                replica.fail(err)
+                continue
+            try:
+                connection.autocommit = True
+                if replica.due() and not replica.check(connection, primary_lsn):
+                    replica.pool.putconn(connection)
+                    continue
+            except Error as err:
+                replica.fail(err)
+                replica.pool.putconn(connection, close=True)
+                continue
+            return replica, connection
+        return None
+
+    def give_back(self, replica, connection, broken=False):
+        """Return a borrowed connection to its replica's pool."""
+        replica.pool.putconn(connection, close=broken or bool(connection.closed))
+
+    def cursor(self, primary, session=None):
+        """Wrap a cursor of the primary in a RoutingCursor.
+
+            Args:
+                primary: A cursor of the primary connection.
+                session (optional): The key read-your-writes is tracked under, e.g. the username.
+
+            Returns:
+                RoutingCursor: The routing cursor.
+            """
+        return RoutingCursor(self, primary, session)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+
+class RoutingCursor:
+    """A psycopg2-like cursor running reads on a replica and everything else on the primary."""
+
+    dialect = "postgres"
+    # statements run on whichever connection the routing picks, so
+    # db_operations.execute must not prepare them on one of them
+    prepare = False
+
+    def __init__(self, router, primary, session=None):
+        self._router = router
+        self._primary = primary
+        self._session = session
+        self._replica = None
+        self._replica_connection = None
+        self._replica_cursor = None
+        self._current = primary
+        self._pinned = False
+
+    @property
+    def connection(self):
+        """The primary connection: transactions always run there."""
+        return self._primary.connection
+
+    def execute(self, sql, params=None):
+        text = sql.decode() if isinstance(sql, bytes) else sql
+        if READ.match(text) and not WRITE.search(text):
+            cursor = self._read_cursor()
+            if cursor is not self._primary:
+                try:
+                    self._current = cursor
+                    return cursor.execute(sql, params)
+                except (OperationalError, InterfaceError) as err:
+                    # the replica went away; fall back to the primary
+                    self._release(err)
+            self._current = self._primary
+            return self._primary.execute(sql, params)
+
+        if re.match(r"\s*LISTEN\b", text, re.IGNORECASE):
+            self._pinned = True
+        self._current = self._primary
+        try:
+            return self._primary.execute(sql, params)
+        finally:
+            self._router.wrote(self._session)
+
+    def copy_expert(self, sql, file, size=8192):
+        if re.search(r"\bTO\s+STDOUT\b", sql, re.IGNORECASE):
+            self._current = self._read_cursor()
+            return self._current.copy_expert(sql, file, size)
+        self._current = self._primary
+        try:
+            return self._primary.copy_expert(sql, file, size)
+        finally:
+            self._router.wrote(self._session)
+
+    def read_connection(self):
+        """The connection the next read would run on, for server-side cursors."""
+        return self._read_cursor().connection
+
+    def _read_cursor(self):
+        if self._pinned or not self.connection.autocommit or self._router.sticky(self._session):
+            return self._primary
+        # a long-lived cursor (the shell's) keeps its replica: give it back
+        # when it failed or is due for a check, borrow() checks it again
+        if self._replica_cursor is not None and (not self._replica.healthy or self._replica.due()):
+            self._release()
+        if self._replica_cursor is None:
+            borrowed = self._router.borrow(self.connection)
+            if borrowed is None:
+                return self._primary
+            self._replica, self._replica_connection = borrowed
+            self._replica_cursor = self._replica_connection.cursor()
+        return self._replica_cursor
+
+    def _release(self, err=None):
+        if self._replica is None:
+            return
+        if not self._replica_cursor.closed:
+            self._replica_cursor.close()
+        if err is not None:
+            self._replica.fail(err)
+        self._router.give_back(self._replica, self._replica_connection, broken=err is not None)
+        self._replica = self._replica_connection = self._replica_cursor = None
+
+    def close(self):
+        """Close the cursors and return the replica connection to its pool."""
+        self._release()
+        self._primary.close()
+
+    def __iter__(self):
+        return iter(self._current)
+
+    def __getattr__(self, name):
+        # fetchone, fetchall, rowcount, description, mogrify, ... of the last statement's cursor
+        return getattr(self._current, name)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def masked(dsn):
+    """Hide the password of a connection string, for printing."""
+    return re.sub(r"(password=)\S+|(://[^:/@]*:)[^@]*(@)", lambda match: (match.group(1) or match.group(2)) + "***"
+                  + (match.group(3) or ""), dsn)
+
+
+def route(cursor, session=None):
+    """Wrap a cursor of the primary in a RoutingCursor if replicas are configured.
+
+        Args:
+            cursor: A cursor of the primary connection.
+            session (optional): The key read-your-writes is tracked under, e.g. the username.
+
+        Returns:
+            A RoutingCursor, or `cursor` itself without replicas, on a sharded database or on the sqlite backend.
+        """
+    global _router
+    # the replicas replicate one database, not the shards
+    if not config.REPLICA_DSNS or config.SHARD_DSNS or storage.dialect(cursor) != "postgres":
+        return cursor
+    with _router_lock:
+        if _router is None:
+            _router = ReplicaRouter(config.REPLICA_DSNS)
+    return _router.cursor(cursor, session)
+
+
+def wrote(session):
+    """Record that `session` wrote to the primary without a RoutingCursor, e.g. through db_operations.WRITER.
+
+        Args:
+            session: The key read-your-writes is tracked under, as passed to route().
+
+        Returns:
+            None
+        """
+    if _router is not None:
+        _router.wrote(session)
+
+
+if __name__ == '__main__':
+    if not config.REPLICA_DSNS:
+        raise SystemExit("No replicas configured, set MESSENGER_REPLICA_DSNS.")
+
+    router = ReplicaRouter(config.REPLICA_DSNS, maxconn=1)
+    primary = storage.connect()
+    primary.autocommit = True
+    primary_lsn = current_lsn(primary)
+    primary.close()
+    for replica in router.replicas:
+        try:
+            connection = replica.pool.getconn()
+            replica.check(connection, primary_lsn)
+            replica.pool.putconn(connection)
+        except Error as err:
+            replica.fail(err)
+        state = "healthy" if replica.healthy else f"unhealthy ({replica.error or f'lag {replica.lag:.1f} s'})"
+        lag = f", lag {replica.lag:.3f} s" if replica.healthy else ""
+        print(f"{masked(replica.dsn)}: {state}{lag}")
+    router.close()
@@ -0,0 +1,235 @@
+"""
+Signed, expiring session tokens that let the CLIs skip the password check.
+
+`mess_app --login` verifies the password once and stores a token in
+config.CACHE_DIR. Later commands given a username but no password validate
+that token locally with HMAC-SHA256 (no database round trip) and take the
+user_id from it. Changing the password or deleting the account revokes all
+tokens issued for the user before that moment.
+"""
+import base64
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import time
+
+import config
+import db_operations
+import profiling
+from crypto import check_password
+
+
+def _path(*parts):
+    return os.path.join(config.CACHE_DIR, *parts)
+
+
+def _private_temp(path, data):
+    """Write `data` (bytes) to a new temporary file next to `path` only the current user can read.
+
+        The name is unique, so concurrent writers, threads of the daemon
+        included, never write to the same temporary file.
+
+        Returns:
+            str: The path of the temporary file.
+        """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def _write_private(path, data):
+    """Atomically write `data` (bytes) to a file only the current user can read."""
+    tmp = _private_temp(path, data)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signing_key():
+    """Get the key tokens are signed with, generating it on first use.
+
+        Returns:
+            bytes: 32 random bytes kept in CACHE_DIR/secret.key.
+        """
+    path = _path("secret.key")
+    if not os.path.exists(path):
+        tmp = _private_temp(path, secrets.token_bytes(32))
+        try:
+            # link() fails if another process created the key first, so
+            # every process ends up signing with the same key
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _token_path(username):
+    # usernames may contain anything, so the file is named after their hash
+    return _path("sessions", hashlib.sha256(username.encode("utf-8")).hexdigest() + ".token")
+
+
+def _revocations():
+    try:
+        with open(_path("revocations.json"), encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def sign(payload):
+    """Serialize and sign a token payload.
+
+        Args:
+            payload (dict): The claims of the token.
+
+        Returns:
+            str: The token, "<base64 payload>.<base64 HMAC-SHA256>".
+        """
+    body = _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    signature = hmac.new(_signing_key(), body.encode("ascii"), hashlib.sha256).digest()
+    return f"{body}.{_b64encode(signature)}"
+
+
+def verify(token):
+    """Check the signature, expiry and revocation of a token.
+
+        Args:
+            token (str): A token created by sign().
+
+        Returns:
+            dict or None: The payload if the token is valid, None otherwise.
+        """
+    try:
+        body, signature = token.strip().split(".")
+        expected = hmac.new(_signing_key(), body.encode("ascii"), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None
+        payload = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError):
+        return None
+
+    if payload.get("exp", 0) < time.time():
+        return None
+    if payload.get("iat", 0) <= _revocations().get(payload.get("usr"), 0):
+        return None
+    return payload
+
+
+def login(user, ttl=None):
+    """Issue a session token for an authenticated user and cache it.
+
+        Args:
+            user (db_operations.User): The user whose password was verified.
+            ttl (int, optional): Lifetime in seconds. Defaults to config.SESSION_TTL.
+
+        Returns:
+            float: The expiry time as a Unix timestamp.
+        """
+    issued = time.time()
+    expires = issued + (config.SESSION_TTL if ttl is None else ttl)
+    token = sign({"uid": user.id, "usr": user.username, "iat": issued, "exp": expires})
+    _write_private(_token_path(user.username), token.encode("ascii"))
+    return expires
+
+
+def load(username):
+    """Get the user of a cached, valid session token.
+
+        Args:
+            username (str): The username given on the command line.
+
+        Returns:
+            db_operations.User or None: A User with the cached ID and no
+            password hash, or None if there is no valid token for `username`.
+        """
+    try:
+        with open(_token_path(username), encoding="ascii") as file:
+            payload = verify(file.read())
+    except (FileNotFoundError, UnicodeError):
+        return None
+
+    if payload is None or payload.get("usr") != username:
+        return None
+    return db_operations.User.from_row((payload["uid"], username, None))
+
+
+def revoke(username):
+    """Invalidate every token issued for `username` until now.
+
+        Args:
+            username (str): The username whose sessions end.
+
+        Returns:
+            None
+        """
+    # the lock serializes the read-modify-write across threads and
+    # processes, so no revocation written meanwhile is lost
+    os.makedirs(config.CACHE_DIR, mode=0o700, exist_ok=True)
+    lock = os.open(_path("revocations.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        revocations = _revocations()
+        revocations[username] = time.time()
+        _write_private(_path("revocations.json"), json.dumps(revocations).encode("utf-8"))
+    finally:
+        os.close(lock)
+    try:
+        os.unlink(_token_path(username))
+    except FileNotFoundError:
+        pass
+
+
+def authenticate(cursor, username, password=None):
+    """Resolve the user running a command.
+
+        With a password the user is loaded and the password checked; without
+        one the cached session token is used and the database is not queried.
+
+        Args:
+            cursor: A database cursor object.
+            username (str): The username given on the command line.
+            password (str, optional): The password given on the command line.
+
+        Returns:
+            db_operations.User or None: The authenticated user, or None after
+            printing why authentication failed.
+        """
+    if password is None:
+        with profiling.phase("auth token"):
+            user = load(username)
+        if user is None:
+            print("Not logged in, please provide a password or log in with --login")
+        return user
+
+    user = db_operations.User.load_user_by_username(cursor, username)
+    if user:
+        with profiling.phase("auth hashing"):
+            correct = check_password(password, user.hashed_password)
+        if not correct:
+            print("Incorrect password !")
+            return None
+    return user
@@ -0,0 +1,811 @@
+"""
+Hash sharding: users and messages spread over several PostgreSQL databases.
+
+The shard map is config.SHARD_DSNS: set MESSENGER_SHARD_DSNS to a comma
+separated list of libpq connection strings, shard 0 first, or, to try it
+on one local server, MESSENGER_SHARD_COUNT=N for the databases
+messanger_db_0 ... messanger_db_<N-1>. Create and migrate them with
+
+    MESSENGER_SHARD_COUNT=3 python shards.py init
+
+Layout:
+
+- A user lives on shard_for(user_id), a jump consistent hash of their id
+  over the shards: adding a shard at the end of the map moves about 1/N of
+  the users, and `python shards.py rebalance` moves them. `python shards.py
+  move --user NAME --to N` moves one user by hand, until the next rebalance.
+- A message lives on the shard of its recipient, with its long body and
+  attachments. The inbox, --unread, --since-last, --follow and --read of a
+  user touch their shard only.
+- Ids are unique across shards: the id sequences of shard k count k,
+  k + MAX_SHARDS, k + 2 * MAX_SHARDS, ... so no two shards hand out the same
+  message or attachment id, and every user id comes from shard 0. Moved rows
+  keep their ids.
+- A shard keeps a remote copy of the users row (id and username, no
+  password) of every sender living elsewhere, for the foreign keys and the
+  sender names of its messages. User lookups skip remote copies.
+- Looking a user up by name asks every shard at once, on a thread pool with
+  one thread per shard; so do listing the users and sending a batch to
+  recipients on several shards.
+
+With shards configured the CLIs connect to the shard of the user running the
+command, through connect(), and do not go through the daemon. Groups and
+the CSV import need a single database. --conversations, --with and --search
+see the messages stored on the user's shard: the ones they received, and
+the ones they sent to users of the same shard.
+"""
+import argparse
+import contextlib
+import heapq
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import sql
+from psycopg2.errors import DuplicateDatabase, UniqueViolation
+from psycopg2.extensions import make_dsn, parse_dsn
+from psycopg2.pool import ThreadedConnectionPool
+
+import config
+import create_db
+import db_operations
+import profiling
+import storage
+from replicas import masked
+
+
+MAX_SHARDS = 1024
+"""
+MAX_SHARDS is the step of the id sequences of every shard, and so the most
+shards the map can ever grow to. Changing it breaks the uniqueness of ids.
+"""
+
+SEQUENCES = ("users_user_id_seq", "messages_message_id_seq", "attachments_attachment_id_seq", "groups_group_id_seq")
+"""
+SEQUENCES are the id sequences numbered per shard by init.
+"""
+
+USER_LOCK = 7263002
+"""
+USER_LOCK is the first key of the advisory lock taken on shard 0 while a
+user is created, with a hash of the username as the second key, so two
+shards cannot both get a user of the same name.
+"""
+
+_MASK = (1 << 64) - 1
+_END = object()
+
+
+def shard_for(user_id, count):
+    """Get the shard a user belongs on.
+
+        Jump consistent hash (Lamping and Veach): going from N to N + 1
+        shards only moves the users that now belong on the new shard. The id
+        is mixed first (the splitmix64 finalizer), as ids count in steps of
+        MAX_SHARDS.
+
+        Args:
+            user_id (int): The ID of the user.
+            count (int): The number of shards.
+
+        Returns:
+            int: The number of the shard, from 0 to count - 1.
+        """
+    key = (user_id + 0x9E3779B97F4A7C15) & _MASK
+    key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & _MASK
+    key ^= key >> 31
+
+    shard, candidate = -1, 0
+    while candidate < count:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & _MASK
+        candidate = int((shard + 1) * (1 << 31) / ((key >> 33) + 1))
+    return shard
+
+
+class ShardSet:
+    """The connection pools of the shards, and the operations that span several of them."""
+
+    def __init__(self, dsns=None, maxconn=config.POOL_MAX_CONNECTIONS):
+        """Create the (initially empty) connection pools and the thread pool.
+
+            Args:
+                dsns (list, optional): The libpq connection strings of the shards, shard 0 first.
+                    Defaults to config.SHARD_DSNS.
+                maxconn (int, optional): The most connections per shard. Defaults to config.POOL_MAX_CONNECTIONS.
+            """
+        self.dsns = list(dsns or config.SHARD_DSNS)
+        self.pools = [ThreadedConnectionPool(0, maxconn, dsn, cursor_factory=profiling.cursor_factory())
+                      for dsn in self.dsns]
+        # one thread per shard: every shard of a cross-shard operation runs at once
+        self.executor = ThreadPoolExecutor(len(self.dsns), thread_name_prefix="shard")
+
+    def __len__(self):
+        return len(self.dsns)
+
+    def shard_for(self, user_id):
+        """Get the shard a user belongs on, see shard_for()."""
+        return shard_for(user_id, len(self.dsns))
+
+    def connect(self, number):
+        """Open a connection of its own to a shard, e.g. for a CLI command.
+
+            Args:
+                number (int): The number of the shard.
+
+            Returns:
+                A psycopg2 connection.
+
+            Raises:
+                psycopg2.OperationalError: If the shard cannot be reached.
+            """
+        return psycopg2.connect(self.dsns[number], cursor_factory=profiling.cursor_factory())
+
+    @contextlib.contextmanager
+    def cursor(self, number):
+        """Borrow an autocommit connection of a shard from its pool.
+
+            Args:
+                number (int): The number of the shard.
+
+            Yields:
+                A cursor of the connection.
+            """
+        pool = self.pools[number]
+        connection = pool.getconn()
+        broken = False
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                yield cursor
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            pool.putconn(connection, close=broken or bool(connection.closed))
+
+    def map(self, function, numbers=None):
+        """Run `function(number, cursor)` on several shards at once.
+
+            Args:
+                function (callable): Called on a thread of the pool with the number of a shard and a cursor of it.
+                numbers (iterable, optional): The shards to run on. Defaults to all of them.
+
+            Returns:
+                list: What `function` returned for each shard, in the order of `numbers`.
+
+            Raises:
+                The first error `function` raised, once every shard is done.
+            """
+        def run(number):
+            with self.cursor(number) as cursor:
+                return function(number, cursor)
+
+        numbers = range(len(self.dsns)) if numbers is None else list(numbers)
+        futures = [self.executor.submit(run, number) for number in numbers]
+        return [future.result() for future in futures]
+
+    def _find(self, condition, values):
+        def find(number, cursor):
+            cursor.execute(f"""SELECT user_id, username, hashed_password FROM users
+                               WHERE {condition} AND deleted_at IS NULL AND NOT remote""", values)
+            return cursor.fetchall()
+
+        found = {}
+        # the lowest shard wins while an interrupted move leaves a user on two
+        for number, rows in enumerate(self.map(find)):
+            for row in rows:
+                found.setdefault(row[1], (number, db_operations.User.from_row(row)))
+        return found
+
+    def locate(self, username):
+        """Find the shard a user lives on, asking every shard at once.
+
+            Args:
+                username (str): The username of the user.
+
+            Returns:
+                tuple: The number of the shard and the User, (None, None) if no shard has such a user.
+            """
+        return self._find("username=%s", (username,)).get(username, (None, None))
+
+    def locate_id(self, user_id):
+        """Find the shard a user lives on by their ID, asking every shard at once.
+
+            Args:
+                user_id (int): The ID of the user.
+
+            Returns:
+                tuple: The number of the shard and the User, (None, None) if no shard has such a user.
+            """
+        found = self._find("user_id=%s", (user_id,))
+        return next(iter(found.values()), (None, None))
+
+    def locate_many(self, usernames):
+        """Find the shards of several users, with one query per shard, all shards at once.
+
+            Args:
+                usernames (iterable): The usernames of the users.
+
+            Returns:
+                dict: (shard number, User) tuples by username. Usernames with no user are missing from the dict.
+            """
+        return self._find("username = ANY(%s)", (list(usernames),))
+
+    def create_user(self, user):
+        """Save a new user on the shard their ID hashes to.
+
+            The ID comes from shard 0, which also holds an advisory lock on the
+            username while every shard is checked for it.
+
+            Args:
+                user (db_operations.User): An unsaved user.
+
+            Returns:
+                tuple: The number of the shard and the saved User.
+
+            Raises:
+                psycopg2.IntegrityError: If a shard has a user of the same name,
+                    deleted users waiting for their purge included.
+            """
+        with self.cursor(0) as lock:
+            lock.execute("SELECT pg_advisory_lock(%s, hashtext(%s))", (USER_LOCK, user.username))
+            try:
+                def taken(number, cursor):
+                    cursor.execute("SELECT 1 FROM users WHERE username=%s AND NOT remote", (user.username,))
+                    return cursor.fetchone() is not None
+
+                owners = [number for number, found in enumerate(self.map(taken)) if found]
+                if owners:
+                    raise UniqueViolation(f"username {user.username} exists on shard {owners[0]}")
+
+                lock.execute("SELECT nextval('users_user_id_seq')")
+                user_id = lock.fetchone()[0]
+                number = self.shard_for(user_id)
+                with self.cursor(number) as cursor:
+                    cursor.execute("INSERT INTO users(user_id, username, hashed_password) VALUES (%s, %s, %s)",
+                                   (user_id, user.username, user.hashed_password))
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (USER_LOCK, user.username))
+        return number, db_operations.User.from_row((user_id, user.username, user.hashed_password))
+
+    @staticmethod
+    def _copy_users(cursor, users):
+        """Give a shard remote copies of the users it does not have yet."""
+        psycopg2.extras.execute_values(cursor, """INSERT INTO users(user_id, username, remote) VALUES %s
+                                                  ON CONFLICT DO NOTHING""",
+                                       [(user.id, user.username, True) for user in users])
+
+    def deliver(self, sender, number, recipient_id, save):
+        """Store a new message on the shard of its recipient.
+
+            Runs in one transaction on the shard: the sender gets a remote copy
+            there if they live elsewhere, the recipient's row is share-locked,
+            and `save` stores the message. If move_user moved the recipient
+            since they were looked up, they are looked up again and the message
+            goes to their new shard.
+
+            Args:
+                sender (db_operations.User): The sender.
+                number (int): The shard the recipient was found on.
+                recipient_id (int): The ID of the recipient.
+                save (callable): Stores the message with the shard cursor it is called with.
+
+            Returns:
+                int or None: The shard the message was stored on, None if the recipient no longer exists.
+            """
+        while number is not None:
+            with self.cursor(number) as cursor, db_operations.transaction(cursor):
+                cursor.execute("""SELECT 1 FROM users WHERE user_id=%s AND deleted_at IS NULL AND NOT remote
+                                  FOR SHARE""", (recipient_id,))
+                if cursor.fetchone():
+                    self._copy_users(cursor, [sender])
+                    save(cursor)
+                    return number
+            number = self.locate_id(recipient_id)[0]
+        return None
+
+    def save_many(self, sender, messages, numbers):
+        """Insert new messages on the shards of their recipients, all shards at once.
+
+            Every shard inserts its messages with Message.save_many in one
+            transaction of its own: a shard that fails does not undo the
+            others. Messages to recipients who moved or left since they were
+            looked up are not inserted.
+
+            Args:
+                sender (db_operations.User): The sender of all the messages.
+                messages (list): Unsaved Message objects.
+                numbers (list): The shard of the recipient of each message.
+
+            Returns:
+                int: The number of messages inserted.
+
+            Raises:
+                psycopg2.Error: If a shard fails to insert its messages.
+            """
+        by_shard = {}
+        for message, number in zip(messages, numbers):
+            by_shard.setdefault(number, []).append(message)
+
+        def save(number, cursor):
+            batch = by_shard[number]
+            with db_operations.transaction(cursor):
+                cursor.execute("""SELECT user_id FROM users
+                                  WHERE user_id = ANY(%s) AND deleted_at IS NULL AND NOT remote
+                                  FOR SHARE""", (sorted({message.to_id for message in batch}),))
+                present = {user_id for (user_id,) in cursor.fetchall()}
+                batch = [message for message in batch if message.to_id in present]
+                if not batch:
+                    return 0
+                self._copy_users(cursor, [sender])
+                return db_operations.Message.save_many(cursor, batch)
+
+        return sum(self.map(save, by_shard))
+
+    def iter_all_users(self, itersize=db_operations.ITERSIZE):
+        """Lazily fetch the users of all shards, ordered by ID.
+
+            Every shard streams its users from a server-side cursor, on a
+            thread of the pool, into a queue of at most `itersize` users, and
+            the streams are merged as they arrive: all shards are read at once
+            and memory use does not grow with the number of users.
+
+            Args:
+                itersize (int, optional): The number of rows fetched per round trip. Defaults to ITERSIZE.
+
+            Yields:
+                db_operations.User: The users of all shards, ordered by ID.
+
+            Raises:
+                psycopg2.Error: If a shard fails to list its users.
+            """
+        stop = threading.Event()
+
+        def produce(number, stream):
+            def put(item):
+                # give up once the consumer is gone, instead of blocking forever
+                while not stop.is_set():
+                    try:
+                        stream.put(item, timeout=0.1)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+
+            try:
+                with self.cursor(number) as cursor:
+                    for user in db_operations.User.iter_all_users(cursor, itersize):
+                        if not put(user):
+                            return
+            except BaseException as err:
+                put(err)
+                return
+            put(_END)
+
+        def consume(stream):
+            while True:
+                item = stream.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        streams = [queue.Queue(itersize) for _ in self.dsns]
+        for number, stream in enumerate(streams):
+            self.executor.submit(produce, number, stream)
+        try:
+            yield from heapq.merge(*(consume(stream) for stream in streams), key=lambda user: user.id)
+        finally:
+            stop.set()
+
+    def propagate_deletions(self):
+        """Mark the remote copies of deleted users as deleted too, on all shards at once.
+
+            Each shard's purge then also removes the messages the deleted
+            users sent to the users of that shard, and the copies themselves.
+
+            Returns:
+                int: The number of remote copies marked.
+            """
+        def deleted(number, cursor):
+            cursor.execute("SELECT user_id FROM users WHERE deleted_at IS NOT NULL AND NOT remote")
+            return [user_id for (user_id,) in cursor.fetchall()]
+
+        user_ids = [user_id for found in self.map(deleted) for user_id in found]
+        if not user_ids:
+            return 0
+
+        def mark(number, cursor):
+            cursor.execute("""UPDATE users SET deleted_at=current_timestamp
+                              WHERE user_id = ANY(%s) AND remote AND deleted_at IS NULL""", (user_ids,))
+            return cursor.rowcount
+
+        return sum(self.map(mark))
+
+    def misplaced(self):
+        """List the users who do not live on the shard shard_for puts them on.
+
+            Returns:
+                list: (user_id, username, current shard, shard_for shard) tuples.
+            """
+        def scan(number, cursor):
+            found = []
+            with db_operations.server_side_cursor(cursor) as stream:
+                stream.execute("SELECT user_id, username FROM users WHERE deleted_at IS NULL AND NOT remote")
+                for user_id, username in stream:
+                    target = self.shard_for(user_id)
+                    if target != number:
+                        found.append((user_id, username, number, target))
+            return found
+
+        return [user for found in self.map(scan) for user in found]
+
+    def move_user(self, user_id, source, target):
+        """Move a user and the messages they received from one shard to another.
+
+            The user's row on the source shard is locked for the whole move,
+            so no message to them is stored there meanwhile: senders waiting on
+            the lock then find them on the target shard (see deliver). Their
+            row, received messages with bodies and attachments, read mark and
+            conversation summaries are copied to the target in one transaction,
+            then deleted from the source in another. The copied messages keep
+            their ids, so the read mark still applies, and the target's id
+            sequences are raised above them. Their row stays behind as
+            a remote copy, for the messages they sent to users of the source
+            shard. Copying skips rows the target has already, so a move
+            interrupted between the two transactions is finished by running
+            it again.
+
+            Args:
+                user_id (int): The ID of the user.
+                source (int): The shard the user lives on.
+                target (int): The shard to move them to.
+
+            Returns:
+                int or None: The number of messages moved, None if the user does not live on `source`.
+
+            Raises:
+                psycopg2.Error: If copying or deleting fails. A failed copy leaves
+                    the user on the source, a failed delete on both shards.
+            """
+        with self.cursor(source) as cursor, db_operations.transaction(cursor):
+            cursor.execute("""SELECT user_id, username, hashed_password, deleted_at FROM users
+                              WHERE user_id=%s AND NOT remote FOR UPDATE""", (user_id,))
+            user = cursor.fetchone()
+            if not user:
+                return None
+
+            with self.cursor(target) as target_cursor, db_operations.transaction(target_cursor):
+                moved = self._copy_user(cursor, target_cursor, user, target)
+
+            # the delete trigger takes the bodies and attachments along
+            cursor.execute("DELETE FROM messages WHERE to_id=%s", (user_id,))
+            cursor.execute("DELETE FROM read_marks WHERE user_id=%s", (user_id,))
+            cursor.execute("DELETE FROM conversations WHERE user_id=%s", (user_id,))
+            cursor.execute("UPDATE users SET remote=true, hashed_password=NULL WHERE user_id=%s", (user_id,))
+        return moved
+
+    @staticmethod
+    def _copy_user(source, target, user, number):
+        """Copy a user's row and received data from the source shard to shard `number`, see move_user."""
+        user_id = user[0]
+        target.execute("""INSERT INTO users(user_id, username, hashed_password, deleted_at) VALUES (%s, %s, %s, %s)
+                          ON CONFLICT (user_id) DO UPDATE SET hashed_password=excluded.hashed_password,
+                                                              deleted_at=excluded.deleted_at, remote=false""", user)
+
+        # the senders of the messages and the counterparts of the conversations
+        source.execute("""SELECT user_id, username FROM users
+                          WHERE user_id IN (SELECT from_id FROM messages WHERE to_id=%s
+                                            UNION SELECT counterpart_id FROM conversations WHERE user_id=%s)""",
+                       (user_id, user_id))
+        ShardSet._copy_users(target, [db_operations.User.from_row((*row, None)) for row in source.fetchall()])
+
+        source.execute("SELECT min(creation_date) FROM messages WHERE to_id=%s", (user_id,))
+        oldest = source.fetchone()[0]
+        if oldest is None:
+            moved = 0
+        else:
+            create_db.create_partitions(target, oldest.date())
+            moved = _copy_rows(source, target,
+                               """SELECT message_id, from_id, to_id, creation_date, text, group_id
+                                  FROM messages WHERE to_id=%s""", (user_id,),
+                               """INSERT INTO messages(message_id, from_id, to_id, creation_date, text, group_id)
+                                  VALUES %s ON CONFLICT DO NOTHING""")
+            _copy_rows(source, target,
+                       """SELECT b.message_id, b.size, b.compressed, b.body
+                          FROM message_bodies b JOIN messages m USING (message_id) WHERE m.to_id=%s""", (user_id,),
+                       "INSERT INTO message_bodies(message_id, size, compressed, body) VALUES %s ON CONFLICT DO NOTHING")
+            _copy_rows(source, target,
+                       """SELECT a.attachment_id, a.message_id, a.filename, a.size
+                          FROM attachments a JOIN messages m USING (message_id) WHERE m.to_id=%s""", (user_id,),
+                       """INSERT INTO attachments(attachment_id, message_id, filename, size) VALUES %s
+                          ON CONFLICT DO NOTHING""")
+            _copy_rows(source, target,
+                       """SELECT c.attachment_id, c.chunk_no, c.data
+                          FROM attachment_chunks c JOIN attachments a USING (attachment_id)
+                          JOIN messages m USING (message_id) WHERE m.to_id=%s""", (user_id,),
+                       "INSERT INTO attachment_chunks(attachment_id, chunk_no, data) VALUES %s ON CONFLICT DO NOTHING",
+                       page_size=4)
+
+            # moved rows keep their ids, new ones must still come after them
+            target.execute("""SELECT max(m.message_id), max(a.attachment_id)
+                              FROM messages m LEFT JOIN attachments a USING (message_id) WHERE m.to_id=%s""",
+                           (user_id,))
+            largest = target.fetchone()
+            for sequence, above in zip(("messages_message_id_seq", "attachments_attachment_id_seq"), largest):
+                if above is not None:
+                    raise_sequence(target, sequence, number, above)
+
+        _copy_rows(source, target, "SELECT user_id, last_read_id FROM read_marks WHERE user_id=%s", (user_id,),
+                   """INSERT INTO read_marks(user_id, last_read_id) VALUES %s
+                      ON CONFLICT (user_id) DO UPDATE SET last_read_id=excluded.last_read_id""")
+        # the insert trigger counted the copied messages as unread, the
+        # summaries of the source are the right ones
+        _copy_rows(source, target,
+                   """SELECT user_id, counterpart_id, last_message_id, last_date, message_count, unread_count
+                      FROM conversations WHERE user_id=%s""", (user_id,),
+                   """INSERT INTO conversations(user_id, counterpart_id, last_message_id, last_date,
+                                                message_count, unread_count) VALUES %s
+                      ON CONFLICT (user_id, counterpart_id) DO UPDATE SET
+                          last_message_id=excluded.last_message_id, last_date=excluded.last_date,
+                          message_count=excluded.message_count, unread_count=excluded.unread_count""")
+        return moved
+
+    def close(self):
+        """Stop the threads and close the pooled connections."""
+        self.executor.shutdown()
+        for pool in self.pools:
+            pool.closeall()
+
+
+def _copy_rows(source, target, select, values, insert, page_size=1000):
+    """Stream the rows of a query on one shard into an INSERT ... VALUES %s on another.
+
+        Returns:
+            int: The number of rows read.
+        """
+    copied = 0
+    with db_operations.server_side_cursor(source, page_size) as stream:
+        stream.execute(select, values)
+        while True:
+            rows = stream.fetchmany(page_size)
+            if not rows:
+                return copied
+            psycopg2.extras.execute_values(target, insert, rows, page_size=page_size)
+            copied += len(rows)
+
+
+def enabled():
+    """Check whether shards are configured.
+
+        Returns:
+            bool: True if config.SHARD_DSNS lists shards and the backend is PostgreSQL.
+        """
+    return bool(config.SHARD_DSNS) and config.BACKEND == "postgres"
+
+
+def connect(username=None):
+    """Open the connection a command of a user runs on.
+
+        Without shards this is storage.connect(). With shards,
+        db_operations.SHARDS is set up on first use and the connection goes
+        to the shard the user lives on, or to shard 0 for an unknown user.
+
+        Args:
+            username (str, optional): The username given on the command line.
+
+        Returns:
+            A connection of the configured backend.
+
+        Raises:
+            One of storage.CONNECTION_ERRORS if a database cannot be reached.
+        """
+    if not enabled():
+        return storage.connect()
+    if db_operations.SHARDS is None:
+        db_operations.SHARDS = ShardSet(config.SHARD_DSNS)
+    number = db_operations.SHARDS.locate(username)[0] if username else None
+    return db_operations.SHARDS.connect(number or 0)
+
+
+def close():
+    """Close db_operations.SHARDS, if connect() set it up."""
+    if db_operations.SHARDS is not None:
+        db_operations.SHARDS.close()
+        db_operations.SHARDS = None
+
+
+def create_database(dsn):
+    """Create the database of a shard if it does not exist yet.
+
+        Args:
+            dsn (str): The libpq connection string of the shard.
+
+        Returns:
+            None
+        """
+    params = parse_dsn(dsn)
+    name = params.get("dbname", config.DB_NAME)
+    params["dbname"] = "postgres"
+    connection = psycopg2.connect(make_dsn(**params))
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+            print(f"NOTE: DATABASE {name} CREATED")
+        except DuplicateDatabase:
+            pass
+    connection.close()
+
+
+def shard_number(cursor):
+    """Get the shard number init gave a database.
+
+        Args:
+            cursor: A cursor of the database.
+
+        Returns:
+            int or None: The number, None if the database was not numbered yet.
+        """
+    cursor.execute("""SELECT increment_by, start_value FROM pg_sequences
+                      WHERE schemaname = current_schema() AND sequencename = %s""", (SEQUENCES[0],))
+    data = cursor.fetchone()
+    if not data or data[0] != MAX_SHARDS:
+        return None
+    return data[1] % MAX_SHARDS
+
+
+def number_sequences(cursor, number):
+    """Make the id sequences of a shard count number, number + MAX_SHARDS, ... above the ids used so far.
+
+        Args:
+            cursor: A cursor of the shard.
+            number (int): The number of the shard.
+
+        Returns:
+            None
+        """
+    for sequence in SEQUENCES:
+        cursor.execute(f"SELECT last_value FROM {sequence}")
+        start = (cursor.fetchone()[0] // MAX_SHARDS + 1) * MAX_SHARDS + number
+        cursor.execute(f"ALTER SEQUENCE {sequence} INCREMENT BY {MAX_SHARDS} START WITH {start} RESTART WITH {start}")
+
+
+def raise_sequence(cursor, sequence, number, above):
+    """Make an id sequence of a shard hand out ids above `above` next, still counting number + k * MAX_SHARDS.
+
+        Args:
+            cursor: A cursor of the shard.
+            sequence (str): The name of the sequence, one of SEQUENCES.
+            number (int): The number of the shard.
+            above (int): The largest id the sequence must not hand out.
+
+        Returns:
+            None
+        """
+    start = (above - number) // MAX_SHARDS * MAX_SHARDS + MAX_SHARDS + number
+    cursor.execute(f"""SELECT setval('{sequence}', %s, false) FROM {sequence}
+                       WHERE CASE WHEN is_called THEN last_value + {MAX_SHARDS} ELSE last_value END < %s""",
+                   (start, start))
+
+
+def init(dsns):
+    """Create, migrate and number the shard databases.
+
+        Running it again migrates the shards and numbers the ones added at
+        the end of the map.
+
+        Args:
+            dsns (list): The libpq connection strings of the shards, shard 0 first.
+
+        Returns:
+            bool: False if a database was numbered for another position in the map.
+        """
+    for number, dsn in enumerate(dsns):
+        print(f"NOTE: SHARD {number}: {masked(dsn)}")
+        create_database(dsn)
+        connection = psycopg2.connect(dsn)
+        try:
+            version = create_db.upgrade(connection)
+            with connection.cursor() as cursor:
+                create_db.create_partitions(cursor)
+                numbered = shard_number(cursor)
+                if numbered is None:
+                    number_sequences(cursor, number)
+                elif numbered != number:
+                    print(f"WARNING: THIS DATABASE IS SHARD {numbered}, THE SHARD MAP MUST KEEP ITS ORDER")
+                    return False
+            print(f"NOTE: SHARD {number} AT SCHEMA VERSION {version}")
+        finally:
+            connection.close()
+    return True
+
+
+def status(shards):
+    """Print the number of the users, remote copies and messages of every shard, counted on all shards at once."""
+    def count(number, cursor):
+        cursor.execute("""SELECT count(*) FILTER (WHERE NOT remote), count(*) FILTER (WHERE remote),
+                                 (SELECT count(*) FROM messages)
+                          FROM users""")
+        counts = cursor.fetchone()
+        return (shard_number(cursor), *counts)
+
+    for number, (numbered, users, copies, messages) in enumerate(shards.map(count)):
+        warning = "" if numbered == number else f", WARNING: NUMBERED {numbered}, RUN init"
+        print(f"shard {number} ({masked(shards.dsns[number])}): {users} users, {copies} remote copies, "
+              f"{messages} messages{warning}")
+
+
+def rebalance(shards, dry_run=False):
+    """Move every user who does not live on the shard shard_for puts them on.
+
+        Args:
+            shards (ShardSet): The shards.
+            dry_run (bool, optional): Only list the users that would move.
+
+        Returns:
+            None
+        """
+    misplaced = shards.misplaced()
+    if not misplaced:
+        print("Every user is on their shard.")
+        return
+
+    for user_id, username, source, target in misplaced:
+        if dry_run:
+            print(f"{username} (id {user_id}): shard {source} -> {target}")
+            continue
+        moved = shards.move_user(user_id, source, target)
+        print(f"Moved {username} (id {user_id}) from shard {source} to {target}, {moved or 0} messages")
+    if not dry_run:
+        print(f"Moved {len(misplaced)} users.")
+
+
+parser = argparse.ArgumentParser(description="Create, inspect and rebalance the shards of config.SHARD_DSNS.")
+parser.add_argument('command', choices=['init', 'status', 'rebalance', 'move'],
+                    help="init: create, migrate and number the shard databases, "
+                         "status: count the users and messages of every shard, "
+                         "rebalance: move the users who are not on the shard their id hashes to, "
+                         "move: move --user to the shard --to")
+parser.add_argument('--user', help='move: the username of the user to move')
+parser.add_argument('--to', help='move: the number of the shard to move the user to', type=int)
+parser.add_argument('--dry-run', help='rebalance: only list the users that would move (flag)', action='store_true')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not enabled():
+        raise SystemExit("No shards configured, set MESSENGER_SHARD_DSNS or MESSENGER_SHARD_COUNT.")
+
+    try:
+        if args.command == 'init':
+            if not init(config.SHARD_DSNS):
+                raise SystemExit(1)
+        else:
+            shards = ShardSet(config.SHARD_DSNS)
+            try:
+                if args.command == 'status':
+                    status(shards)
+                elif args.command == 'rebalance':
+                    rebalance(shards, args.dry_run)
+                elif not args.user or args.to is None or not 0 <= args.to < len(shards):
+                    print(f"move needs --user and --to, a shard from 0 to {len(shards) - 1}")
+                else:
+                    source, user = shards.locate(args.user)
+                    if user is None:
+                        print(f"There is no user named {args.user}")
+                    elif source == args.to:
+                        print(f"{args.user} is on shard {args.to} already")
+                    else:
+                        moved = shards.move_user(user.id, source, args.to)
+                        print(f"Moved {args.user} from shard {source} to {args.to}, {moved or 0} messages")
+            finally:
+                shards.close()
+    except psycopg2.OperationalError as opr_err:
+        print("Connection Error: ", opr_err)
@@ -0,0 +1,416 @@
+"""
+Storage backends: where db_operations runs its SQL.
+
+Two backends are available, selected with config.BACKEND (environment
+variable MESSENGER_BACKEND):
+
+    postgres  the PostgreSQL server from config.py (default)
+    sqlite    an embedded SQLite file (config.SQLITE_PATH) in WAL mode, for
+              edge deployments and CI with no network hop at all
+
+Both hand out DB-API connections whose cursors behave like psycopg2's, so
+db_operations, mess_app and user_app keep taking a plain `cursor` and run
+unchanged on either one. The SQLite connection translates %s placeholders,
+emulates psycopg2's `autocommit` switch and migrates its schema on connect;
+the few statements whose SQL really differs (= ANY, COPY, execute_values,
+server-side cursors) check dialect(cursor) in db_operations.
+"""
+import datetime
+import os
+import sqlite3
+import time
+
+import psycopg2
+
+import config
+import profiling
+
+
+CONNECTION_ERRORS = (psycopg2.OperationalError, sqlite3.OperationalError)
+"""
+CONNECTION_ERRORS are raised by connect() when the database cannot be reached or opened.
+"""
+
+DATABASE_ERRORS = (psycopg2.Error, sqlite3.Error)
+"""
+DATABASE_ERRORS is the base of every error a statement can raise on either backend.
+"""
+
+INTEGRITY_ERRORS = (psycopg2.IntegrityError, sqlite3.IntegrityError)
+"""
+INTEGRITY_ERRORS are raised by constraint violations, e.g. a taken username.
+"""
+
+
+SQLITE_MIGRATIONS = [
+    # 1: users and messages, as migrations 1-4 of create_db.py
+    ["""CREATE TABLE IF NOT EXISTS users
+        (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username varchar(255),
+            hashed_password varchar(80)
+        )""",
+     "CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users(username)",
+     """CREATE TABLE IF NOT EXISTS messages
+        (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+            to_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+            creation_date timestamp DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+            text varchar(255)
+        )""",
+     "CREATE INDEX IF NOT EXISTS messages_to_id_creation_date_idx ON messages(to_id, creation_date, message_id)",
+     "CREATE INDEX IF NOT EXISTS messages_from_id_idx ON messages(from_id)"],
+    # 2: full-text search, an external content FTS5 index kept in sync by triggers
+    ["CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='message_id')",
+     """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, text) VALUES (new.message_id, new.text);
+        END""",
+     """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.message_id, old.text);
+        END""",
+     """CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.message_id, old.text);
+            INSERT INTO messages_fts(rowid, text) VALUES (new.message_id, new.text);
+        END""",
+     "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"],
+    # 3: conversation summaries and the thread index, as migrations 6-7
+    ["""CREATE TABLE conversations
+        (
+            user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+            counterpart_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+            last_message_id INTEGER,
+            last_date timestamp,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id, counterpart_id)
+        )""",
+     "CREATE INDEX conversations_user_id_last_date_idx ON conversations(user_id, last_date, last_message_id)",
+     """CREATE TRIGGER messages_conversations_recipient AFTER INSERT ON messages BEGIN
+            INSERT INTO conversations(user_id, counterpart_id, last_message_id, last_date, message_count, unread_count)
+            VALUES (new.to_id, new.from_id, new.message_id, new.creation_date, 1, 1)
+            ON CONFLICT (user_id, counterpart_id) DO UPDATE SET
+                last_message_id = CASE WHEN (excluded.last_date, excluded.last_message_id) > (last_date, last_message_id)
+                                       THEN excluded.last_message_id ELSE last_message_id END,
+                last_date = max(last_date, excluded.last_date),
+                message_count = message_count + 1,
+                unread_count = unread_count + 1;
+        END""",
+     """CREATE TRIGGER messages_conversations_sender AFTER INSERT ON messages WHEN new.from_id <> new.to_id BEGIN
+            INSERT INTO conversations(user_id, counterpart_id, last_message_id, last_date, message_count, unread_count)
+            VALUES (new.from_id, new.to_id, new.message_id, new.creation_date, 1, 0)
+            ON CONFLICT (user_id, counterpart_id) DO UPDATE SET
+                last_message_id = CASE WHEN (excluded.last_date, excluded.last_message_id) > (last_date, last_message_id)
+                                       THEN excluded.last_message_id ELSE last_message_id END,
+                last_date = max(last_date, excluded.last_date),
+                message_count = message_count + 1;
+        END""",
+     """INSERT INTO conversations(user_id, counterpart_id, last_message_id, last_date, message_count, unread_count)
+        -- a bare column next to a single max() comes from the row holding the maximum
+        SELECT user_id, counterpart_id, message_id, max(creation_date), count(*), sum(unread)
+        FROM (SELECT to_id AS user_id, from_id AS counterpart_id, message_id, creation_date, 1 AS unread
+              FROM messages
+              UNION ALL
+              SELECT from_id, to_id, message_id, creation_date, 0 FROM messages WHERE from_id <> to_id)
+        GROUP BY user_id, counterpart_id""",
+     """CREATE INDEX messages_thread_idx
+        ON messages(min(from_id, to_id), max(from_id, to_id), creation_date, message_id)"""],
+    # 4: read marks, as migration 8
+    ["""CREATE TABLE read_marks
+        (
+            user_id INTEGER PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            last_read_id INTEGER NOT NULL DEFAULT 0
+        )""",
+     "CREATE INDEX messages_to_id_message_id_idx ON messages(to_id, message_id)"],
+    # 5: soft-deleted users, as migration 11
+    ["ALTER TABLE users ADD COLUMN deleted_at timestamp",
+     "CREATE INDEX users_deleted_at_idx ON users(deleted_at) WHERE deleted_at IS NOT NULL"],
+    # 6: long message bodies and attachments, as migration 12
+    ["""CREATE TABLE message_bodies
+        (
+            message_id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL,
+            compressed INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )""",
+     """CREATE TABLE attachments
+        (
+            attachment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            filename varchar(255) NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0
+        )""",
+     "CREATE INDEX attachments_message_id_idx ON attachments(message_id)",
+     """CREATE TABLE attachment_chunks
+        (
+            attachment_id INTEGER REFERENCES attachments(attachment_id) ON DELETE CASCADE,
+            chunk_no INTEGER,
+            data BLOB NOT NULL,
+            PRIMARY KEY(attachment_id, chunk_no)
+        )""",
+     """CREATE TRIGGER messages_delete_content AFTER DELETE ON messages BEGIN
+            DELETE FROM message_bodies WHERE message_id = old.message_id;
+            DELETE FROM attachments WHERE message_id = old.message_id;
+        END"""],
+    # 7: group messages, as migration 13; group messages have no recipient
+    # user and stay out of the conversation summaries
+    ["""CREATE TABLE groups
+        (
+            group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(255) NOT NULL UNIQUE,
+            owner_id INTEGER REFERENCES users(user_id) ON DELETE SET NULL,
+            creation_date timestamp DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+        )""",
+     """CREATE TABLE group_members
+        (
+            group_id INTEGER REFERENCES groups(group_id) ON DELETE CASCADE,
+            user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+            joined_date timestamp NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+            PRIMARY KEY(group_id, user_id)
+        )""",
+     "CREATE INDEX group_members_user_id_idx ON group_members(user_id, group_id)",
+     "ALTER TABLE messages ADD COLUMN group_id INTEGER REFERENCES groups(group_id) ON DELETE CASCADE",
+     """CREATE INDEX messages_group_id_creation_date_idx ON messages(group_id, creation_date, message_id)
+        WHERE group_id IS NOT NULL""",
+     "CREATE INDEX messages_group_id_message_id_idx ON messages(group_id, message_id) WHERE group_id IS NOT NULL",
+     "DROP TRIGGER messages_conversations_recipient",
+     """CREATE TRIGGER messages_conversations_recipient AFTER INSERT ON messages WHEN new.to_id IS NOT NULL BEGIN
+            INSERT INTO conversations(user_id, counterpart_id, last_message_id, last_date, message_count, unread_count)
+            VALUES (new.to_id, new.from_id, new.message_id, new.creation_date, 1, 1)
+            ON CONFLICT (user_id, counterpart_id) DO UPDATE SET
+                last_message_id = CASE WHEN (excluded.last_date, excluded.last_message_id) > (last_date, last_message_id)
+                                       THEN excluded.last_message_id ELSE last_message_id END,
+                last_date = max(last_date, excluded.last_date),
+                message_count = message_count + 1,
+                unread_count = unread_count + 1;
+        END"""],
+    # 8: remote copies of users, as migration 15; SQLite integers are 64-bit
+    # already, migration 14 has no equivalent. An SQLite database is never
+    # sharded, the column only keeps the queries the same on both backends.
+    ["ALTER TABLE users ADD COLUMN remote INTEGER NOT NULL DEFAULT 0"],
+    # 9: commit order of messages, as migration 16. SQLite has one writer at
+    # a time, so ids become visible in their order: xact_id stays 0 and
+    # only keeps the queries the same on both backends.
+    ["ALTER TABLE messages ADD COLUMN xact_id INTEGER NOT NULL DEFAULT 0",
+     "ALTER TABLE read_marks ADD COLUMN last_read_xact_id INTEGER NOT NULL DEFAULT 0",
+     "CREATE INDEX messages_to_id_xact_id_idx ON messages(to_id, xact_id, message_id)",
+     """CREATE INDEX messages_group_id_xact_id_idx ON messages(group_id, xact_id, message_id)
+        WHERE group_id IS NOT NULL""",
+     "DROP INDEX messages_to_id_message_id_idx",
+     "DROP INDEX messages_group_id_message_id_idx"],
+    # 10: read marks on message ids again, as migrations 18 and 19. xact_id
+    # was always 0, so the marks are right already; one writer at a time
+    # needs no gate.
+    ["DROP INDEX messages_to_id_xact_id_idx",
+     "DROP INDEX messages_group_id_xact_id_idx",
+     "ALTER TABLE messages DROP COLUMN xact_id",
+     "ALTER TABLE read_marks DROP COLUMN last_read_xact_id",
+     "CREATE INDEX messages_to_id_message_id_idx ON messages(to_id, message_id)",
+     "CREATE INDEX messages_group_id_message_id_idx ON messages(group_id, message_id) WHERE group_id IS NOT NULL"],
+    # 11: unread counts follow the read marks, as migration 20.
+    ["""UPDATE conversations SET unread_count = min(unread_count,
+            (SELECT count(*) FROM messages m
+             WHERE m.to_id = conversations.user_id AND m.from_id = conversations.counterpart_id
+               AND m.message_id > (SELECT last_read_id FROM read_marks r WHERE r.user_id = conversations.user_id)))
+        WHERE unread_count > 0 AND user_id IN (SELECT user_id FROM read_marks)"""],
+]
+"""
+SQLITE_MIGRATIONS is the SQLite equivalent of the migrations in create_db.py:
+one list of statements per schema version. Pending ones are applied on
+connect, and the version reached is stored in the user_version pragma.
+"""
+
+
+def dialect(cursor):
+    """Get the SQL dialect spoken by `cursor`.
+
+        Args:
+            cursor: A cursor of either backend.
+
+        Returns:
+            str: "postgres" or "sqlite".
+        """
+    return getattr(cursor, "dialect", "postgres")
+
+
+def connect(backend=None):
+    """Open a connection to the configured backend.
+
+        Args:
+            backend (str, optional): "postgres" or "sqlite". Defaults to config.BACKEND.
+
+        Returns:
+            A psycopg2 connection, or an SQLiteConnection.
+
+        Raises:
+            One of CONNECTION_ERRORS if the database cannot be reached.
+        """
+    backend = backend or config.BACKEND
+    if backend == "postgres":
+        return psycopg2.connect(cursor_factory=profiling.cursor_factory(), **config.connection_kwargs())
+    if backend == "sqlite":
+        return SQLiteConnection(config.SQLITE_PATH)
+    raise ValueError(f"Unknown backend {backend!r}, expected postgres or sqlite")
+
+
+def _convert_timestamp(value):
+    return datetime.datetime.fromisoformat(value.decode("ascii"))
+
+
+def _adapt_datetime(value):
+    return value.isoformat(sep=" ", timespec="milliseconds")
+
+
+sqlite3.register_converter("timestamp", _convert_timestamp)
+sqlite3.register_adapter(datetime.datetime, _adapt_datetime)
+
+
+class SQLiteConnection:
+    """An SQLite connection with the psycopg2 connection interface db_operations uses."""
+
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # isolation_level=None stops the sqlite3 module from opening
+        # transactions on its own; this class opens them like psycopg2 does
+        self._connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None,
+                                           check_same_thread=False)
+        self._autocommit = False
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT}")
+        self._migrate()
+
+    def _migrate(self):
+        """Apply the pending SQLITE_MIGRATIONS in one transaction."""
+        connection = self._connection
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= len(SQLITE_MIGRATIONS):
+            return
+
+        # IMMEDIATE takes the write lock up front, so a second process
+        # opening the database meanwhile waits and then sees the new version
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(SQLITE_MIGRATIONS[version:], version + 1):
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f"PRAGMA user_version={number}")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if self._connection.in_transaction:
+            raise sqlite3.ProgrammingError("set_session cannot be used inside a transaction")
+        self._autocommit = value
+
+    @property
+    def closed(self):
+        return self._connection is None
+
+    def cursor(self, name=None, **kwargs):
+        # SQLite steps through a result lazily anyway, so a named
+        # (server-side) cursor is just a plain one
+        return SQLiteCursor(self)
+
+    def commit(self):
+        if self._connection.in_transaction:
+            self._connection.execute("COMMIT")
+
+    def rollback(self):
+        if self._connection.in_transaction:
+            self._connection.execute("ROLLBACK")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class SQLiteCursor:
+    """An SQLite cursor accepting psycopg2's %s placeholders."""
+
+    dialect = "sqlite"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.itersize = 2000
+        self._cursor = connection._connection.cursor()
+        self._sql = None
+
+    @staticmethod
+    def _translate(sql):
+        return sql.replace("%s", "?").replace("%%", "%")
+
+    def _begin(self):
+        if not self.connection.autocommit and not self.connection._connection.in_transaction:
+            self._cursor.execute("BEGIN")
+
+    def execute(self, sql, params=()):
+        self._begin()
+        self._sql = sql
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(self._translate(sql), params or ())
+        finally:
+            if profiling.PROFILER is not None:
+                profiling.PROFILER.record_statement(sql, time.perf_counter() - started, self._cursor.rowcount)
+
+    def executemany(self, sql, params_list):
+        self._begin()
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(self._translate(sql), params_list)
+        finally:
+            if profiling.PROFILER is not None:
+                profiling.PROFILER.record_statement(sql, time.perf_counter() - started, self._cursor.rowcount)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if profiling.PROFILER is None:
+            return self._cursor.fetchmany(self.itersize if size is None else size)
+        # SQLite runs a query as its rows are stepped through: a stream
+        # spends its database time here, not in execute()
+        started = time.perf_counter()
+        rows = []
+        try:
+            rows = self._cursor.fetchmany(self.itersize if size is None else size)
+            return rows
+        finally:
+            profiling.PROFILER.record_statement(profiling.fetch_label(self._sql), time.perf_counter() - started,
+                                                len(rows))
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        if profiling.PROFILER is None:
+            return iter(self._cursor)
+        return profiling.iter_chunks(self.fetchmany, self.itersize)
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
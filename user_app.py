@@ -1,7 +1,19 @@
 import argparse
+import csv
+import io
+import itertools
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import daemon
 import db_operations
-from psycopg2.errors import UniqueViolation
-from psycopg2 import connect, OperationalError
+import profiling
+import replicas
+import session
+import shards
+import storage
 from crypto import check_password, hash_password
 
 parser = argparse.ArgumentParser()
@@ -11,8 +23,31 @@ parser.add_argument('-n', '--new_pass', help='new password')
 parser.add_argument('-e', '--edit', help='edit user', action="store_true")
 parser.add_argument('-s', '--show', help='show all users', action="store_true")
 parser.add_argument('-d', '--delete', help='delete account', action="store_true")
-
-args = parser.parse_args()
+parser.add_argument('--import', dest='import_file', help='create users from a username,password CSV file ("-" for stdin)')
+parser.add_argument('--export', help='write user_id,username of all users as CSV to a file ("-" for stdout)')
+parser.add_argument('--purge', help='remove the messages and rows of deleted accounts in small batches (flag)',
+                    action="store_true")
+parser.add_argument('--batch-size', help=f'messages deleted per batch by --purge (default {config.PURGE_BATCH_SIZE})',
+                    type=int, default=config.PURGE_BATCH_SIZE)
+parser.add_argument('--pause', help=f'seconds to sleep between two --purge batches (default {config.PURGE_PAUSE})',
+                    type=float, default=config.PURGE_PAUSE)
+parser.add_argument('--create-group', help='create a group owned by the user, with the --add-member users',
+                    metavar='NAME')
+parser.add_argument('--group', help='list the members of this group, or edit them with --add-member/--remove-member',
+                    metavar='NAME')
+parser.add_argument('--add-member', help='user to add to the group, may be repeated (group owner only)',
+                    action='append', metavar='USERNAME')
+parser.add_argument('--remove-member', help='user to remove from the group, may be repeated '
+                                            '(group owner only, members can remove themselves)',
+                    action='append', metavar='USERNAME')
+parser.add_argument('--profile', help='print where the time went: per-statement database timings and '
+                                      'phase timings, as a table (default) or as json, to stderr',
+                    nargs='?', const='table', choices=['table', 'json'])
+
+IMPORT_CHUNK = 20000
+"""
+IMPORT_CHUNK is the number of CSV rows hashed and copied into the database together.
+"""
 
 
 def create_user(cursor, username, password):
@@ -36,10 +71,14 @@ def create_user(cursor, username, password):
         """
     if len(password) >= 8:
         try:
-            user = db_operations.User(username, password)
-            user.save_to_db(cursor)
+            with profiling.phase("hashing"):
+                user = db_operations.User(username, password)
+            if db_operations.SHARDS is not None:
+                db_operations.SHARDS.create_user(user)
+            else:
+                user.save_to_db(cursor)
             print(f"User Created: Nice to meet you {username}!")
-        except UniqueViolation:
+        except storage.INTEGRITY_ERRORS:
             print(f"User with username {username} already exists !")
     else:
         print("Password is too short, please use at least 8 characters")
@@ -65,20 +104,21 @@ def edit_password(cursor, username, password, new_pass):
         is the same as the old password, it prints an error message. If the current password
         is incorrect, it prints an error message. If the user does not exist, it prints an
         error message. If the new password is too short (less than 8 characters), it prints
-        an error message.
+        an error message. A successful change revokes all session tokens of the user.
 
         """
     user = db_operations.User.load_user_by_username(cursor, username)
-    user_hashed = user.hashed_password
 
     if user:
-        if check_password(password, user_hashed):
+        if check_password(password, user.hashed_password):
             if new_pass == password:
                 print("New password cannot be the same as old password")
             else:
                 if len(new_pass) >= 8:
-                    user_hashed = new_pass
+                    with profiling.phase("hashing"):
+                        user.new_password(new_pass)
                     user.save_to_db(cursor)
+                    session.revoke(username)
                     print("Password changed!")
                 else:
                     print("New password is too short, please use at least 8 characters")
@@ -106,7 +146,8 @@ def delete_user(cursor, username, password):
 
         Prints a success message if the user account is deleted successfully. If the provided
         password is incorrect, it prints an error message. If the user does not exist, it
-        prints an error message.
+        prints an error message. Deleting the account revokes all its session tokens.
+        The account is closed at once; its messages are removed later by --purge.
 
         """
 
@@ -120,11 +161,183 @@ def delete_user(cursor, username, password):
     if user:
         if check_password(password, user_hashed):
             user.delete_user(cursor, user_id)
+            session.revoke(username)
             print("Your account has been deleted ! ")
         else:
             print('Incorrect password !')
 
 
+def purge_deleted_users(cursor, batch_size=config.PURGE_BATCH_SIZE, pause=config.PURGE_PAUSE):
+
+    """Remove the messages and rows of all deleted accounts.
+
+        Args:
+            cursor: The database cursor object.
+            batch_size (int, optional): The number of messages deleted per batch.
+            pause (float, optional): The number of seconds to sleep between two batches.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        Meant to run in the background (cron, nohup). Prints the progress of
+        every account; an interrupted purge simply continues on the next run.
+
+        """
+    users = db_operations.User.load_deleted_users(cursor)
+    if not users:
+        print("No deleted accounts to purge.")
+        return
+
+    for user in users:
+        started = time.perf_counter()
+        deleted = 0
+        for count in user.purge(cursor, batch_size):
+            deleted += count
+            rate = deleted / (time.perf_counter() - started)
+            print(f"\r{user.username}: deleted {deleted} messages ({rate:,.0f} messages/s)", end="", flush=True)
+            time.sleep(pause)
+        print(f"\rPurged {user.username}: {deleted} messages in {time.perf_counter() - started:.1f} s" + " " * 20)
+
+
+def purge_shards(shard_set, batch_size=config.PURGE_BATCH_SIZE, pause=config.PURGE_PAUSE):
+
+    """Remove the messages and rows of all deleted accounts from every shard.
+
+        Args:
+            shard_set (shards.ShardSet): The shards.
+            batch_size (int, optional): The number of messages deleted per batch.
+            pause (float, optional): The number of seconds to sleep between two batches.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        The remote copies of the deleted accounts are marked deleted first,
+        so every shard also purges the messages they sent to its users.
+        Shards are purged one after the other, to keep the load low.
+
+        """
+    shard_set.propagate_deletions()
+    for number in range(len(shard_set)):
+        print(f"Shard {number}:")
+        with shard_set.cursor(number) as cursor:
+            purge_deleted_users(cursor, batch_size, pause)
+
+
+def create_group(cursor, username, password, name, members=()):
+
+    """Create a group owned by the user, who becomes its first member.
+
+        Args:
+            cursor: The database cursor object.
+            username (str): The username of the owner.
+            password (str): The password of the owner, None to use the cached session token.
+            name (str): The name of the group, with or without the leading @.
+            members (list, optional): Usernames of the other first members.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        Prints a success message with the number of members added. If a group
+        with the same name already exists, it prints an error message.
+
+        """
+    user = session.authenticate(cursor, username, password)
+    if not user:
+        return
+
+    group = db_operations.Group(name.lstrip('@'), user.id)
+    try:
+        group.save_to_db(cursor)
+    except storage.INTEGRITY_ERRORS:
+        print(f"Group with name {group.name} already exists !")
+        return
+    added = group.add_members(cursor, members) if members else 0
+    print(f"Group Created: send to it with -t @{group.name}, {added + 1} members.")
+
+
+def edit_group(cursor, username, password, name, add=(), remove=()):
+
+    """Add and remove members of a group.
+
+        Args:
+            cursor: The database cursor object.
+            username (str): The username of the user editing the group.
+            password (str): The password of the user, None to use the cached session token.
+            name (str): The name of the group, with or without the leading @.
+            add (list, optional): Usernames of the users to add.
+            remove (list, optional): Usernames of the members to remove.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        Only the owner of the group can add and remove members; a member can
+        only remove themselves, i.e. leave the group. Any member can manage a
+        group left without an owner. Prints the number of members added and
+        removed.
+
+        """
+    user = session.authenticate(cursor, username, password)
+    if not user:
+        return
+
+    group = db_operations.Group.load_group_by_name(cursor, name.lstrip('@'))
+    if not group:
+        print(f"There is no group named {name.lstrip('@')}")
+        return
+    # purges hand a group to its oldest member; one left with no member, or orphaned before, has none
+    manager = group.owner_id == user.id or group.owner_id is None and group.is_member(cursor, user.id)
+    if not manager and (add or set(remove) != {user.username}):
+        print(f"Only the owner of @{group.name} can add or remove other members")
+        return
+
+    added = group.add_members(cursor, add) if add else 0
+    removed = group.remove_members(cursor, remove) if remove else 0
+    print(f"@{group.name}: added {added} members, removed {removed}.")
+
+
+def show_group(cursor, username, password, name):
+
+    """Display the members of a group the user is a member of.
+
+        Args:
+            cursor: The database cursor object.
+            username (str): The username of the user.
+            password (str): The password of the user, None to use the cached session token.
+            name (str): The name of the group, with or without the leading @.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        """
+    user = session.authenticate(cursor, username, password)
+    if not user:
+        return
+
+    group = db_operations.Group.load_group_by_name(cursor, name.lstrip('@'))
+    if not group or not group.is_member(cursor, user.id):
+        print(f"There is no group named {name.lstrip('@')} you are a member of")
+        return
+
+    for counter, (member_id, member, joined) in enumerate(group.load_members(cursor), 1):
+        owner = " (owner)" if member_id == group.owner_id else ""
+        print(f"{counter}. USERNAME: {member}{owner}, JOINED: {joined}")
+
+
 def show_users(cursor):
 
     """Display a list of all users.
@@ -139,32 +352,203 @@ def show_users(cursor):
             None
 
         Prints a numbered list of all users, including their ID and username.
+        Users are streamed from the database, so printing starts with the
+        first row and memory use does not grow with the number of users.
+        On a sharded database all shards are read at once and merged by ID.
 
         """
-    users = db_operations.User.load_all_users(cursor)
+    if db_operations.SHARDS is not None:
+        users = db_operations.SHARDS.iter_all_users()
+    else:
+        users = db_operations.User.iter_all_users(cursor)
     counter = 1
-    for i in users:
-        print(f"{counter}. ID: {i.id}, USERNAME: {i.username}")
-        counter += 1
+    # users are fetched while they are printed, so this includes the fetching
+    with profiling.phase("render"):
+        for i in users:
+            print(f"{counter}. ID: {i.id}, USERNAME: {i.username}")
+            counter += 1
 
 
-if __name__ == '__main__':
+def import_users(cursor, rows):
+
+    """Create many users at once from username, password rows.
+
+        Passwords are hashed in parallel on all cores and the users are
+        loaded with COPY in a single transaction. Usernames that already
+        exist are skipped; rows with a password shorter than 8 characters
+        or a wrong number of columns are rejected.
+
+        Args:
+            cursor: The database cursor object.
+            rows (iterable): CSV rows, lists of username and password. A first
+                row of exactly "username", "password" is treated as a header.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        Prints every rejected row and a summary with the throughput.
+
+        """
+    started = time.perf_counter()
+    numbered = enumerate(rows, 1)
+    created = 0
+    skipped = 0
+    rejected = 0
+
+    with ProcessPoolExecutor() as pool, db_operations.transaction(cursor):
+        while True:
+            chunk = list(itertools.islice(numbered, IMPORT_CHUNK))
+            if not chunk:
+                break
+
+            usernames = []
+            passwords = []
+            for row_no, row in chunk:
+                if row_no == 1 and row == ['username', 'password']:
+                    continue
+                if len(row) != 2 or not row[0]:
+                    print(f"Rejected row {row_no}: expected username,password")
+                    rejected += 1
+                elif len(row[1]) < 8:
+                    print(f"Rejected row {row_no}: password of {row[0]} is too short")
+                    rejected += 1
+                else:
+                    usernames.append(row[0])
+                    passwords.append(row[1])
+
+            if not usernames:
+                continue
+            with profiling.phase("hashing"):
+                hashed = list(pool.map(hash_password, passwords, chunksize=max(1, len(passwords) // 64)))
+
+            staged = io.StringIO()
+            csv.writer(staged).writerows(zip(usernames, hashed))
+            staged.seek(0)
+
+            inserted = db_operations.User.copy_from_csv(cursor, staged)
+            created += inserted
+            skipped += len(usernames) - inserted
+
+    elapsed = time.perf_counter() - started
+    print(f"Created {created} users in {elapsed:.2f} s ({created / elapsed:.0f} users/s), "
+          f"skipped {skipped} existing, rejected {rejected}.")
+
+
+def export_users(cursor, out):
+
+    """Write the ID and username of all users to `out` as CSV.
+
+        The rows are streamed by the database with COPY and never loaded
+        into Python objects. On a sharded database they are streamed from
+        all shards at once and merged by ID instead.
+
+        Args:
+            cursor: The database cursor object.
+            out: A writable file-like object.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        """
+    if db_operations.SHARDS is not None:
+        writer = csv.writer(out)
+        writer.writerow(("user_id", "username"))
+        writer.writerows((user.id, user.username) for user in db_operations.SHARDS.iter_all_users())
+        return
+    db_operations.User.copy_to_csv(cursor, out)
+
+
+def run(cursor, args):
+
+    """Dispatch the parsed command line arguments to the matching command.
+
+        Args:
+            cursor: The database cursor object.
+            args (argparse.Namespace): The parsed command line arguments.
+
+        Returns:
+            None
+
+        """
+    if db_operations.SHARDS is not None and (args.import_file or args.create_group or args.group):
+        print("Groups and imports are not available on a sharded database.")
+    elif args.import_file:
+        if args.import_file == '-':
+            import_users(cursor, csv.reader(sys.stdin))
+        else:
+            with open(args.import_file, newline='', encoding='utf-8') as users:
+                import_users(cursor, csv.reader(users))
+    elif args.purge and db_operations.SHARDS is not None:
+        purge_shards(db_operations.SHARDS, args.batch_size, args.pause)
+    elif args.purge:
+        purge_deleted_users(cursor, args.batch_size, args.pause)
+    elif args.export:
+        if args.export == '-':
+            export_users(cursor, sys.stdout)
+        else:
+            with open(args.export, 'w', newline='', encoding='utf-8') as out:
+                export_users(cursor, out)
+    elif args.username and args.create_group:
+        create_group(cursor, args.username, args.password, args.create_group, args.add_member or ())
+    elif args.username and args.group and (args.add_member or args.remove_member):
+        edit_group(cursor, args.username, args.password, args.group, args.add_member or (), args.remove_member or ())
+    elif args.username and args.group:
+        show_group(cursor, args.username, args.password, args.group)
+    elif args.username and args.password and args.edit and args.new_pass:
+        edit_password(cursor, args.username, args.password, args.new_pass)
+    elif args.username and args.password and args.delete:
+        delete_user(cursor, args.username, args.password)
+    elif args.username and args.password:
+        create_user(cursor, args.username, args.password)
+    elif args.show:
+        show_users(cursor)
+    else:
+        parser.print_help()
+
+
+def main(argv=None):
+
+    """Run the command given on the command line, through the daemon if one is running.
+
+        Args:
+            argv (list, optional): The command line arguments. Defaults to sys.argv[1:].
+
+        Returns:
+            None
+
+        """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+
+    # imports and exports work on local files, a purge is a long background
+    # job, and a profile has to measure this process, so they always run here
+    if not (args.import_file or args.export or args.purge or args.profile) and daemon.forward('user_app', argv):
+        return
+
+    if args.profile:
+        profiling.enable()
+
     try:
-        connection = connect(user='postgres', password='coderslab', host='localhost', database='messanger_db')
+        with profiling.phase("connect"):
+            connection = shards.connect(args.username)
         connection.autocommit = True
-        cursor = connection.cursor()
-
-        if args.username and args.password and args.edit and args.new_pass:
-            edit_password(cursor, args.username, args.password, args.new_pass)
-        elif args.username and args.password and args.delete:
-            delete_user(cursor, args.username, args.password)
-        elif args.username and args.password:
-            create_user(cursor, args.username, args.password)
-        elif args.show:
-            show_users(cursor)
-        else:
-            parser.print_help()
+        cursor = replicas.route(connection.cursor(), args.username)
+        run(cursor, args)
+        cursor.close()
         connection.close()
-    except OperationalError as opt_err:
+    except storage.CONNECTION_ERRORS as opt_err:
         print("Connection Error: ", opt_err)
+    finally:
+        shards.close()
+
+    profiling.report(args.profile)
 
+
+if __name__ == '__main__':
+    main()
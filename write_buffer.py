@@ -0,0 +1,199 @@
+"""
+Write-behind buffer with group commit for new messages.
+
+In autocommit mode every Message.save_to_db is a transaction of its own and
+pays a WAL flush. A BufferedMessageWriter owned by a long-lived process (the
+daemon, a load test, an importer) queues the messages of all its threads
+instead, and a background thread inserts them with Message.save_many in one
+transaction as soon as config.WRITE_BUFFER_MAX_ROWS messages are waiting or
+the oldest has waited config.WRITE_BUFFER_MAX_DELAY seconds. One commit, and
+one flush, then covers the whole batch.
+
+    writer = BufferedMessageWriter()
+    future = writer.submit(Message(from_id, to_id, "Hi"))
+    message_id, creation_date = future.result()
+    ...
+    writer.close()  # writes whatever is still queued
+
+Callers that need the message stored before they go on (a CLI printing
+"Message sent !") wait on the future, or use save(); the wait is at most
+WRITE_BUFFER_MAX_DELAY plus the batch insert. When the queue holds
+config.WRITE_BUFFER_QUEUE_SIZE messages, submit() blocks until the writer
+catches up, so a burst slows its producers down instead of growing the
+queue without bound.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from psycopg2 import InterfaceError
+
+import config
+import db_operations
+import storage
+
+
+_STOP = object()
+
+_BROKEN = storage.CONNECTION_ERRORS + (InterfaceError,)
+"""
+_BROKEN are the errors after which the writer's connection is not used again.
+"""
+
+
+class BufferedMessageWriter:
+    """Queues new messages and inserts them in batches, one transaction per batch, on its own connection."""
+
+    def __init__(self, connect=storage.connect, max_rows=config.WRITE_BUFFER_MAX_ROWS,
+                 max_delay=config.WRITE_BUFFER_MAX_DELAY, queue_size=config.WRITE_BUFFER_QUEUE_SIZE):
+        """Start the writer thread.
+
+            Args:
+                connect (callable, optional): Opens the connection the writer uses. Defaults to storage.connect.
+                max_rows (int, optional): The most messages per batch. Defaults to config.WRITE_BUFFER_MAX_ROWS.
+                max_delay (float, optional): The most seconds a message waits for more to join its batch.
+                    Defaults to config.WRITE_BUFFER_MAX_DELAY.
+                queue_size (int, optional): The most messages waiting before submit() blocks.
+                    Defaults to config.WRITE_BUFFER_QUEUE_SIZE.
+            """
+        self._connect = connect
+        self._connection = None
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._queue = queue.Queue(queue_size)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, message, timeout=None):
+        """Queue a new message for the next batch.
+
+            Args:
+                message (db_operations.Message): An unsaved message.
+                timeout (float, optional): The most seconds to wait while the queue is full, None to wait as
+                    long as it takes.
+
+            Returns:
+                concurrent.futures.Future: Resolves to the (message_id, creation_date) of the message once its
+                batch is committed, which are also set on the message; or to the error that kept it from being
+                saved.
+
+            Raises:
+                RuntimeError: If the writer is closed.
+                queue.Full: If the queue stayed full for `timeout` seconds.
+            """
+        future = Future()
+        # under the lock, so close() cannot queue its stop marker in between
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The message writer is closed")
+            self._queue.put((message, future), timeout=timeout)
+        return future
+
+    def save(self, message, timeout=None):
+        """Queue a new message and wait until its batch is committed.
+
+            Args:
+                message (db_operations.Message): An unsaved message.
+                timeout (float, optional): The most seconds to wait for the queue and the commit.
+
+            Returns:
+                bool: True once the message is saved, like Message.save_to_db.
+
+            Raises:
+                One of storage.DATABASE_ERRORS: If the message could not be saved.
+            """
+        self.submit(message, timeout).result(timeout)
+        return True
+
+    def close(self):
+        """Stop accepting messages, write the queued ones and close the connection.
+
+            Returns:
+                None
+            """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # every accepted message is queued before the stop marker
+        self._queue.put((_STOP, None))
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if item[0] is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_rows:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            # a caller may have given up on its message while it waited
+            batch = [(message, future) for message, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as err:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(err)
+
+        if self._connection is not None:
+            self._connection.close()
+
+    def _write(self, batch):
+        """Insert a batch in one transaction; if that fails, retry its messages one by one."""
+        try:
+            cursor = self._cursor()
+            with db_operations.transaction(cursor):
+                db_operations.Message.save_many(cursor, [message for message, _ in batch], self.max_rows)
+        except _BROKEN as err:
+            # the next batch reconnects
+            self._discard_connection()
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        except storage.DATABASE_ERRORS as err:
+            if len(batch) == 1:
+                batch[0][1].set_exception(err)
+                return
+            # one bad message (e.g. to a user purged meanwhile) must not sink the others
+            for item in batch:
+                self._write([item])
+            return
+
+        for message, future in batch:
+            future.set_result((message.id, message._creation_date))
+
+    def _cursor(self):
+        if self._connection is None:
+            self._connection = self._connect()
+            self._connection.autocommit = True
+        return self._connection.cursor()
+
+    def _discard_connection(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.close()
+        except storage.DATABASE_ERRORS:
+            pass
+        self._connection = None